@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Ilya Shoshin (Galarius)'
+
+import random
+import threading
+import time
+from timeit import default_timer
+import numpy as np
+import pyaudio
+import audio_helper as ah
+from wave_mmap import MappedWaveReader, open_wave_file
+from resampler import ResamplingReader
+
+# synthetic sources of the simulated backend
+SOURCE_SINE    = 'sine'
+SOURCE_NOISE   = 'noise'
+SOURCE_SILENCE = 'silence'
+
+
+class AudioBackend:
+    """
+    Interface between AudioSession and an audio system.
+    Streams returned by `open` follow the PyAudio Stream interface
+    (start_stream, stop_stream, close, is_active, get_input_latency,
+    get_output_latency) and call `stream_callback` like PortAudio does.
+    """
+    name = ''
+
+    def device_index(self, device_name):
+        """
+        :return: device index or -1
+        """
+        raise NotImplementedError
+
+    def is_format_supported(self, fmt, channels, rate, input_device):
+        raise NotImplementedError
+
+    def open(self, format, channels, rate, frames_per_buffer, input, output,
+             input_device_index, output_device_index, stream_callback):
+        raise NotImplementedError
+
+    def print_stat(self):
+        pass
+
+
+class PyAudioBackend(AudioBackend):
+    """
+    PortAudio devices through the shared PyAudio instance of the device registry
+    """
+    name = 'pyaudio'
+
+    def __init__(self, registry):
+        """
+        :param registry: DeviceRegistry
+        """
+        self.registry = registry
+
+    def device_index(self, device_name):
+        return self.registry.find(device_name)
+
+    def is_format_supported(self, fmt, channels, rate, input_device):
+        try:
+            return self.registry.p_audio.is_format_supported(
+                input_format=fmt,
+                input_channels=channels,
+                rate=rate,
+                input_device=input_device)
+        except ValueError:
+            return False
+
+    def open(self, format, channels, rate, frames_per_buffer, input, output,
+             input_device_index, output_device_index, stream_callback):
+        try:
+            # channels in device order
+            stream_info = pyaudio.PaMacCoreStreamInfo(
+                flags=pyaudio.PaMacCoreStreamInfo.paMacCorePlayNice,  # default
+                channel_map=tuple(range(channels)))
+        except AttributeError:
+            # not on OS X, the host API default channel order is used
+            stream_info = None
+        return self.registry.p_audio.open(format=format,
+                                          channels=channels,
+                                          rate=rate,
+                                          frames_per_buffer=frames_per_buffer,
+                                          input=input,
+                                          output=output,
+                                          output_host_api_specific_stream_info=stream_info,
+                                          input_device_index=input_device_index,
+                                          output_device_index=output_device_index,
+                                          stream_callback=stream_callback)
+
+
+class SimulatedStream:
+    """
+    Stream driven by a virtual clock on its own thread.
+    Every period of frames_per_buffer / rate the callback receives the next
+    input block and its output is passed to the sink; in real-time mode the
+    thread sleeps until the virtual time of the block, otherwise blocks
+    follow each other as fast as possible. Random scheduling jitter is added
+    before each callback and a callback that finishes after its deadline
+    is counted and reported to the next callback as an xrun, like PortAudio does.
+    """
+    def __init__(self, backend, format, channels, rate, frames_per_buffer, input, output, stream_callback):
+        self.format = format
+        self.channels = channels
+        self.rate = rate
+        self.frame_size = frames_per_buffer
+        self.input = input
+        self.output = output
+        self.callback = stream_callback
+        self.realtime = backend.realtime
+        self.duration = backend.duration
+        self.jitter = backend.jitter
+        self.dtype = np.dtype(ah.py_audio_format_to_numpy(format))
+        self.source = backend.source_frames(channels, rate, self.dtype) if input else None
+        self.sink = backend.open_sink(channels, rate, self.dtype) if output else None
+        self.__block = np.zeros((frames_per_buffer, channels), dtype=self.dtype)
+        self.__position = 0
+        self.__thread = None
+        self.active = False
+        self.virtual_time = 0.0
+        self.wall_time = 0.0
+        self.callback_count = 0
+        self.deadline_misses = 0
+        self.max_jitter = 0.0
+        self.min_headroom = float('inf')
+
+    def __next_input(self):
+        source, block = self.source, self.__block
+        filled = 0
+        while filled < len(block):
+            count = min(len(block) - filled, len(source) - self.__position)
+            block[filled:filled + count] = source[self.__position:self.__position + count]
+            filled += count
+            self.__position = (self.__position + count) % len(source)
+        return block.tobytes()
+
+    def __run(self):
+        try:
+            self.__clock()
+        finally:
+            self.active = False
+
+    def __clock(self):
+        deadline = float(self.frame_size) / self.rate
+        status = 0
+        start = default_timer()
+        while self.active and (not self.duration or self.virtual_time < self.duration):
+            jitter = abs(random.gauss(0.0, self.jitter)) if self.jitter else 0.0
+            self.max_jitter = max(self.max_jitter, jitter)
+            if self.realtime:
+                delay = start + self.virtual_time + jitter - default_timer()
+                if delay > 0:
+                    time.sleep(delay)
+            in_data = self.__next_input() if self.input else None
+            time_info = {'input_buffer_adc_time': self.virtual_time,
+                         'current_time': self.virtual_time,
+                         'output_buffer_dac_time': self.virtual_time + deadline}
+            begin = default_timer()
+            out_data, flag = self.callback(in_data, self.frame_size, time_info, status)
+            end = default_timer()
+            self.callback_count += 1
+            if self.realtime:
+                late = end - start > self.virtual_time + deadline
+            else:
+                late = jitter + end - begin > deadline
+            self.min_headroom = min(self.min_headroom, deadline / max(jitter + end - begin, 1e-9))
+            status = 0
+            if late:
+                self.deadline_misses += 1
+                if self.input:
+                    status |= pyaudio.paInputOverflow
+                if self.output:
+                    status |= pyaudio.paOutputUnderflow
+            if self.sink and out_data:
+                self.sink.writeframes(out_data)
+            self.virtual_time += deadline
+            if flag != pyaudio.paContinue:
+                break
+        self.wall_time = default_timer() - start
+
+    def start_stream(self):
+        self.active = True
+        self.__thread = threading.Thread(target=self.__run, name='SimulatedStream')
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop_stream(self):
+        self.active = False
+        if self.__thread:
+            self.__thread.join()
+            self.__thread = None
+
+    def close(self):
+        self.stop_stream()
+        if self.sink:
+            self.sink.close()
+            self.sink = None
+
+    def is_active(self):
+        return self.active
+
+    def get_input_latency(self):
+        return 0.0
+
+    def get_output_latency(self):
+        return 0.0
+
+    def print_stat(self):
+        print "Simulated: %0.1f s of audio in %0.2f s (%s), %i callbacks" % (
+            self.virtual_time, self.wall_time, 'real time' if self.realtime else 'as fast as possible',
+            self.callback_count)
+        print "Deadline misses (with jitter): %i, max jitter: %0.2f ms, min headroom: %0.1fx" % (
+            self.deadline_misses, 1000.0 * self.max_jitter,
+            self.min_headroom if self.callback_count else 0.0)
+
+
+class SimulatedBackend(AudioBackend):
+    """
+    Headless backend for load testing without audio hardware.
+    Every device name resolves to a virtual device; input comes from
+    a synthetic signal or a (looped) wave file and output goes to a wave file
+    or is discarded.
+    """
+    name = 'simulated'
+
+    def __init__(self, realtime=False, duration=10.0, jitter=0.0, source=SOURCE_SINE, sink=''):
+        """
+        Init backend
+        :param realtime: pace callbacks by the virtual clock (False - as fast as possible)
+        :param duration: seconds of audio to simulate (0 - until the session stops)
+        :param jitter: standard deviation of the scheduling jitter in seconds
+        :param source: 'sine', 'noise', 'silence' or a wave file
+        :param sink: output wave file ('' - discard)
+        """
+        self.realtime = realtime
+        self.duration = duration
+        self.jitter = jitter
+        self.source = source
+        self.sink = sink
+        self.streams = []
+
+    @staticmethod
+    def from_settings(settings):
+        """
+        :param settings: AudioSettings with the `simulation_*` fields
+        """
+        return SimulatedBackend(settings.simulation_realtime,
+                                settings.simulation_duration,
+                                settings.simulation_jitter_ms / 1000.0,
+                                settings.simulation_source,
+                                settings.simulation_sink)
+
+    def device_index(self, device_name):
+        return 0
+
+    def is_format_supported(self, fmt, channels, rate, input_device):
+        try:
+            ah.py_audio_format_to_numpy(fmt)
+        except TypeError:
+            return False
+        return channels > 0 and rate > 0
+
+    def source_frames(self, channels, rate, dtype):
+        """
+        :return: (frames x channels) input signal in the stream format, played in a loop
+        """
+        if self.source in (SOURCE_SINE, SOURCE_NOISE, SOURCE_SILENCE):
+            # one second, whole periods of every sine
+            t = np.arange(rate)[:, np.newaxis] / float(rate)
+            if self.source == SOURCE_SINE:
+                signal = 0.5 * np.sin(2 * np.pi * 220.0 * (1 + np.arange(channels)) * t)
+            elif self.source == SOURCE_NOISE:
+                signal = 0.1 * np.random.randn(rate, channels)
+            else:
+                signal = np.zeros((rate, channels))
+        else:
+            source = MappedWaveReader(self.source)
+            if source.rate != rate:
+                source = ResamplingReader(source, rate)
+            frames = ah.to_float32(source.read(source.getnframes()))
+            source.close()
+            signal = frames[:, np.arange(channels) % frames.shape[1]]
+        return ah.from_float32(signal, dtype)
+
+    def open_sink(self, channels, rate, dtype):
+        """
+        :return: wave writer or None
+        """
+        if not self.sink:
+            return None
+        return open_wave_file(self.sink, channels, rate, dtype)
+
+    def open(self, format, channels, rate, frames_per_buffer, input, output,
+             input_device_index, output_device_index, stream_callback):
+        stream = SimulatedStream(self, format, channels, rate, frames_per_buffer, input, output, stream_callback)
+        self.streams.append(stream)
+        return stream
+
+    def print_stat(self):
+        for stream in self.streams:
+            stream.print_stat()
@@ -5,13 +5,16 @@ __author__ = 'Ilya Shoshin (Galarius)'
 import numpy as np
 import pyaudio
 
+# packed 24 bit samples (3 little-endian bytes), as delivered by paInt24 and 24 bit wave files
+INT24 = np.dtype('V3')
+
 def py_audio_format_to_numpy(fmt):
     if fmt == pyaudio.paFloat32:
         return np.float32
     elif fmt == pyaudio.paInt32:
         return np.int32
     elif fmt == pyaudio.paInt24:
-        raise TypeError("Unsupported audio Int24 format.")
+        return INT24
     elif fmt == pyaudio.paInt16:
         return np.int16
     elif fmt == pyaudio.paInt8:
@@ -23,6 +26,23 @@ def py_audio_format_to_numpy(fmt):
     else:
         raise TypeError("Unsupported audio format.")
 
+def numpy_to_py_audio_format(dtype):
+    dtype = np.dtype(dtype)
+    if dtype == np.float32:
+        return pyaudio.paFloat32
+    elif dtype == np.int32:
+        return pyaudio.paInt32
+    elif dtype == INT24:
+        return pyaudio.paInt24
+    elif dtype == np.int16:
+        return pyaudio.paInt16
+    elif dtype == np.int8:
+        return pyaudio.paInt8
+    elif dtype == np.uint8:
+        return pyaudio.paUInt8
+    else:
+        raise TypeError("Unsupported audio format.")
+
 def py_audio_format_desc(fmt):
     if fmt == pyaudio.paFloat32:
         return "32 bit float"
@@ -110,16 +130,209 @@ def float2pcm(sig, dtype='int16'):
     return (sig * abs_max + offset).clip(i.min, i.max).astype(dtype)
 
 def audio_decode(in_data, channels, dtype=np.float32):
-    signal = np.fromstring(in_data, dtype=dtype)
-    if dtype == np.float32:
-        signal = float2pcm(signal, np.int16)
-    chunk_length = len(signal) / channels
-    output = np.reshape(signal, (chunk_length, channels))
-    return output[:, 0], output[:, 1]
+    """
+    Decode interleaved samples of the given format
+    :return: (frames x channels) float32 array in range [-1, 1)
+    """
+    return to_float32(np.frombuffer(in_data, dtype=dtype).reshape(-1, channels))
 
 def audio_encode(signal, dtype=np.float32):
-    interleaved = np.array(signal).flatten('F')
-    if dtype == np.float32:
-        signal = pcm2float(signal, np.float32)
-    out_data = interleaved.astype(dtype).tostring()
-    return out_data
\ No newline at end of file
+    """
+    Encode float frames in range [-1, 1) as interleaved samples of the given format
+    """
+    return from_float32(signal, dtype).tobytes()
+
+def to_float32(frames):
+    """
+    :param frames: (frames x channels) samples of any supported format
+    :return: new (frames x channels) float32 array in range [-1, 1)
+    """
+    frames = np.asarray(frames)
+    out = np.zeros(frames.shape, dtype=np.float32)
+    SampleConverter(frames.dtype).to_float(frames, out)
+    return out
+
+def from_float32(signal, dtype):
+    """
+    :param signal: (frames x channels) float array in range [-1, 1)
+    :param dtype: sample format
+    :return: new (frames x channels) array of `dtype`, rounded and clipped
+    """
+    signal = np.asarray(signal)
+    out = np.zeros(signal.shape, dtype=dtype)
+    SampleConverter(dtype).from_float(signal, out)
+    return out
+
+
+class SampleConverter:
+    """
+    Vectorized conversion between a sample format and float32 in range [-1, 1).
+    Integers are scaled like pcm2float/float2pcm, but rounded instead of truncated;
+    packed 24 bit samples are widened to int32 by a byte shuffle.
+    Scratch buffers grow on demand and are reused, so converting blocks of
+    a steady size doesn't allocate.
+    """
+    def __init__(self, dtype):
+        """
+        :param dtype: sample format (float32, uint8, int8, int16, INT24 or int32)
+        """
+        self.dtype = np.dtype(dtype)
+        self.packed = self.dtype == INT24
+        if self.dtype.kind == 'f':
+            self.scale, self.offset = 1.0, 0.0
+        elif self.packed:
+            self.scale, self.offset = 2.0 ** 23, 0.0
+            self.min, self.max = -2 ** 23, 2 ** 23 - 1
+        elif self.dtype.kind in 'iu':
+            info = np.iinfo(self.dtype)
+            self.scale = 2.0 ** (info.bits - 1)
+            self.offset = info.min + self.scale
+            self.min, self.max = info.min, info.max
+        else:
+            raise TypeError("Unsupported sample format {}.".format(self.dtype))
+        # float32 can't represent the int32 limits, clip in double precision
+        self.work_dtype = np.float64 if self.dtype.itemsize == 4 and self.dtype.kind == 'i' else np.float32
+        self.__wide = np.zeros((0, 4), dtype=np.uint8)
+        self.__work = np.zeros(0, dtype=self.work_dtype)
+        self.__ints = np.zeros(0, dtype='<i4')
+
+    def __wide_buffer(self, size):
+        if len(self.__wide) < size:
+            # the low byte stays zero: 24 bit samples end up in the top of an int32
+            self.__wide = np.zeros((size, 4), dtype=np.uint8)
+        return self.__wide[:size]
+
+    def to_float(self, frames, out):
+        """
+        :param frames: (frames x channels) samples
+        :param out: (frames x channels) float32 array
+        """
+        if self.dtype.kind == 'f':
+            out[...] = frames
+        elif self.packed:
+            raw = np.ascontiguousarray(frames).view(np.uint8).reshape(-1, 3)
+            wide = self.__wide_buffer(len(raw))
+            wide[:, 1:] = raw
+            np.multiply(wide.view('<i4').reshape(out.shape), 1.0 / 2 ** 31, out=out)
+        else:
+            out[...] = frames
+            if self.offset:
+                out -= self.offset
+            out *= 1.0 / self.scale
+
+    def from_float(self, signal, out):
+        """
+        :param signal: (frames x channels) float array
+        :param out: (frames x channels) array of the sample format, C-contiguous
+        """
+        if self.dtype.kind == 'f':
+            out[...] = signal
+            return
+        if len(self.__work) < signal.size:
+            self.__work = np.zeros(signal.size, dtype=self.work_dtype)
+        work = self.__work[:signal.size].reshape(signal.shape)
+        np.multiply(signal, self.scale, out=work)
+        if self.offset:
+            work += self.offset
+        np.rint(work, out=work)
+        np.clip(work, self.min, self.max, out=work)
+        if self.packed:
+            if len(self.__ints) < signal.size:
+                self.__ints = np.zeros(signal.size, dtype='<i4')
+            ints = self.__ints[:signal.size]
+            ints[:] = work.reshape(-1)
+            # the three low bytes of a little-endian int32
+            out.view(np.uint8).reshape(-1, 3)[:] = ints.view(np.uint8).reshape(-1, 4)[:, :3]
+        else:
+            out[...] = work
+
+
+class AudioCodec:
+    """
+    Buffer-pool based decoder/encoder of interleaved audio data.
+    Processing always works on float32 frames in range [-1, 1); samples are
+    converted exactly once on the way in and once on the way out, matching
+    the device or file format (8/16/24/32 bit integers or float32).
+    float32 data is decoded without copying and every other format is
+    converted into preallocated buffers, so no arrays are allocated per callback.
+    """
+    def __init__(self, frame_size, channels, dtype=np.float32):
+        """
+        Init codec
+        :param frame_size: maximum number of frames per block
+        :param channels: number of interleaved channels
+        :param dtype: sample format of the interleaved data
+        """
+        self.channels = channels
+        self.dtype = np.dtype(dtype)
+        self.converter = SampleConverter(self.dtype)
+        self.frame_size = 0
+        self.__allocate(frame_size)
+
+    def __allocate(self, frame_size):
+        self.frame_size = frame_size
+        self.in_frames = np.zeros((frame_size, self.channels), dtype=np.float32)
+        self.out_frames = np.zeros((frame_size, self.channels), dtype=np.float32)
+        self.out_buffer = np.zeros(frame_size * self.channels, dtype=self.dtype)
+
+    def decode(self, in_data):
+        """
+        Decode interleaved data
+        :param in_data: buffer with interleaved samples
+        :return: (frames x channels) float32 frames (valid until the next call)
+        """
+        return self.decode_frames(np.frombuffer(in_data, dtype=self.dtype).reshape(-1, self.channels))
+
+    def decode_frames(self, frames):
+        """
+        :param frames: (frames x channels) samples in the codec format, e.g. a memmap view,
+                       or float32 frames already decoded (e.g. by a ResamplingReader)
+        :return: (frames x channels) float32 frames (valid until the next call)
+        """
+        if frames.dtype == np.float32:
+            return frames
+        frame_count = len(frames)
+        if frame_count > self.frame_size:
+            self.__allocate(frame_count)
+        signal = self.in_frames[:frame_count]
+        self.converter.to_float(frames, signal)
+        return signal
+
+    def output_frames(self, frame_count):
+        """
+        Preallocated float32 output block to be filled in place
+        :param frame_count: number of frames
+        :return: (frames x channels) view of the output block
+        """
+        if frame_count > self.frame_size:
+            self.__allocate(frame_count)
+        return self.out_frames[:frame_count]
+
+    def output_data(self, frame_count):
+        """
+        Convert the output block to the codec format
+        :param frame_count: number of frames
+        :return: buffer with interleaved samples (valid until the next call)
+        """
+        out = self.out_buffer[:frame_count * self.channels]
+        self.converter.from_float(self.out_frames[:frame_count], out.reshape(frame_count, self.channels))
+        return out.data
+
+    def encode(self, signal):
+        """
+        Convert float frames into the preallocated output buffer
+        :param signal: (frames x channels) float array
+        :return: buffer with interleaved samples (valid until the next call)
+        """
+        frame_count = len(signal)
+        if frame_count > self.frame_size:
+            self.__allocate(frame_count)
+        out = self.out_buffer[:frame_count * self.channels]
+        self.converter.from_float(signal, out.reshape(frame_count, self.channels))
+        return out.data
+
+    def encode_frames(self, signal, out):
+        """
+        Convert float frames into an array of the codec format, e.g. a memmap view
+        """
+        self.converter.from_float(signal, out)
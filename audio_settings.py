@@ -5,16 +5,53 @@ __author__ = 'Ilya Shoshin (Galarius)'
 import os
 import json
 import pyaudio
+from device_registry import shared_registry
 
 SETTINGS_FILE_NAME = 'settings.json'
 SETTINGS_KEY_FRAME_SIZE      = 'frame_size'
+SETTINGS_KEY_CHANNELS        = 'channels'
 # unsupported for now
-#SETTINGS_KEY_CHANNELS        = 'channels'
 #SETTINGS_KEY_FORMAT          = 'pyaudio_format'
 SETTINGS_KEY_RATE            = 'rate'
 SETTINGS_KEY_BUILD_IN_INPUT  = 'build_in_input_audio_device_name'
 SETTINGS_KEY_BUILD_IN_OUTPUT = 'build_in_output_audio_device_name'
 SETTINGS_KEY_VIRTUAL_DEVICE  = 'virtual_audio_device_name'
+SETTINGS_KEY_OFFLINE_BLOCK_SIZE = 'offline_block_size'
+SETTINGS_KEY_THREADED_PROCESSING = 'threaded_processing'
+SETTINGS_KEY_WORKER_LATENCY_FRAMES = 'worker_latency_frames'
+SETTINGS_KEY_WRITER_QUEUE_BLOCKS = 'writer_queue_blocks'
+SETTINGS_KEY_WRITER_BATCH_BLOCKS = 'writer_batch_blocks'
+SETTINGS_KEY_WRITER_FSYNC_INTERVAL = 'writer_fsync_interval'
+SETTINGS_KEY_SEGMENT_FRAMES = 'segment_frames'
+SETTINGS_KEY_SEGMENT_WARMUP_FRAMES = 'segment_warmup_frames'
+SETTINGS_KEY_SEGMENT_CROSSFADE_FRAMES = 'segment_crossfade_frames'
+SETTINGS_KEY_STATS_FILE = 'stats_file'
+SETTINGS_KEY_STATS_INTERVAL = 'stats_interval'
+SETTINGS_KEY_PROCESSING_GRAPH = 'processing_graph'
+SETTINGS_KEY_OFFLINE_RATE = 'offline_rate'
+SETTINGS_KEY_RESAMPLER_TAPS = 'resampler_taps'
+SETTINGS_KEY_DEVICE_CACHE_FILE = 'device_cache_file'
+SETTINGS_KEY_SIMULATION_REALTIME = 'simulation_realtime'
+SETTINGS_KEY_SIMULATION_DURATION = 'simulation_duration'
+SETTINGS_KEY_SIMULATION_JITTER_MS = 'simulation_jitter_ms'
+SETTINGS_KEY_SIMULATION_SOURCE = 'simulation_source'
+SETTINGS_KEY_SIMULATION_SINK = 'simulation_sink'
+SETTINGS_KEY_AUTOTUNE_LOAD = 'autotune_load'
+SETTINGS_KEY_AUTOTUNE_DURATION = 'autotune_duration'
+SETTINGS_KEY_RECORDING_PREALLOCATE_MB = 'recording_preallocate_mb'
+SETTINGS_KEY_RECORDING_SEGMENT_SECONDS = 'recording_segment_seconds'
+SETTINGS_KEY_RECORDING_SEGMENT_MB = 'recording_segment_mb'
+SETTINGS_KEY_NETWORK_PROTOCOL = 'network_protocol'
+SETTINGS_KEY_NETWORK_PACKET_FRAMES = 'network_packet_frames'
+SETTINGS_KEY_NETWORK_MIN_LATENCY_MS = 'network_min_latency_ms'
+SETTINGS_KEY_NETWORK_MAX_LATENCY_MS = 'network_max_latency_ms'
+SETTINGS_KEY_METERING = 'metering'
+SETTINGS_KEY_METER_FFT_SIZE = 'meter_fft_size'
+SETTINGS_KEY_METER_SPECTRUM_BANDS = 'meter_spectrum_bands'
+SETTINGS_KEY_STATS_ADDRESS = 'stats_address'
+SETTINGS_KEY_PROFILING = 'profiling'
+SETTINGS_KEY_PROFILING_STACKS_FILE = 'profiling_stacks_file'
+SETTINGS_KEY_PROFILING_SAMPLE_INTERVAL_MS = 'profiling_sample_interval_ms'
 
 
 class StreamMode:
@@ -29,6 +66,10 @@ class StreamMode:
     * File2BuildInOut: (file) -> [process] -> (build-in output)
     * VD2File:         (virtual device input) -> [process] -> (file)
     * File2VD:         (file) -> [process] -> (virtual device output)
+    * BuildInIn2Net:   (build-in input) -> [process] -> (network)
+    * VD2Net:          (virtual device input) -> [process] -> (network)
+    * Net2BuildInOut:  (network) -> [process] -> (build-in output)
+    * Net2VD:          (network) -> [process] -> (virtual device output)
     """
     BuildInIn2Out      = 0
     BuildInIn2VD       = 1
@@ -38,6 +79,10 @@ class StreamMode:
     File2BuildInOut    = 5
     VD2File            = 6
     File2VD            = 7
+    BuildInIn2Net      = 8
+    VD2Net             = 9
+    Net2BuildInOut     = 10
+    Net2VD             = 11
 
 
 class AudioSettings:
@@ -59,128 +104,250 @@ class AudioSettings:
         self.build_in_input_audio_device_name = "Built-in Input"
         self.build_in_output_audio_device_name = "Built-in Output"
         self.virtual_audio_device_name = "Soundflower (2ch)"
+        # frames per block in the device-free (file) -> (file) mode
+        self.offline_block_size = 65536
+        # process on a worker thread with extra latency (frames)
+        # to absorb slow blocks instead of dropping out
+        self.threaded_processing = False
+        self.worker_latency_frames = 2048
+        # background wave writer of the *2File modes:
+        # queue capacity and write size in blocks, seconds between fsyncs
+        self.writer_queue_blocks = 256
+        self.writer_batch_blocks = 32
+        self.writer_fsync_interval = 1.0
+        # parallel (file) -> (file): segment length (0 - one per process),
+        # warm-up region before each segment (its output is discarded),
+        # crossfade with the previous segment after the warm-up (0 - none)
+        self.segment_frames = 0
+        self.segment_warmup_frames = 44100
+        self.segment_crossfade_frames = 0
+        # JSON file for callback statistics ('' - disabled), seconds between dumps
+        self.stats_file = ''
+        self.stats_interval = 10.0
+        # processing graph description (None - AudioSession.__processing template)
+        self.processing_graph = None
+        # sample rate of (file) -> (file) output (0 - rate of the input file);
+        # files feeding a device are converted to `rate`
+        self.offline_rate = 0
+        # resampler filter taps per input sample, more when decimating (quality vs. speed)
+        self.resampler_taps = 32
+        # JSON file to persist the enumerated devices for fast startup ('' - disabled)
+        self.device_cache_file = ''
+        # simulated backend (-s): pace by the clock or run as fast as possible,
+        # seconds of audio (0 - until stopped), scheduling jitter (std, ms),
+        # input ('sine', 'noise', 'silence' or a wave file), output wave file ('' - discard)
+        self.simulation_realtime = False
+        self.simulation_duration = 10.0
+        self.simulation_jitter_ms = 0.0
+        self.simulation_source = 'sine'
+        self.simulation_sink = ''
+        # --autotune: allowed p99 callback time as a fraction of the deadline,
+        # seconds of audio per probed frame size
+        self.autotune_load = 0.5
+        self.autotune_duration = 3.0
+        # recordings of the *2File modes: file extension step (MB, 0 - none),
+        # roll over to numbered files after seconds or MB (0 - single file, RF64 past 4 GB)
+        self.recording_preallocate_mb = 64
+        self.recording_segment_seconds = 0
+        self.recording_segment_mb = 0
+        # network modes: 'udp' or 'tcp', frames per packet (0 - `frame_size`),
+        # bounds of the adaptive jitter buffer latency of the receiver
+        self.network_protocol = 'udp'
+        self.network_packet_frames = 0
+        self.network_min_latency_ms = 5.0
+        self.network_max_latency_ms = 200.0
+        # peak/RMS/LUFS and spectrum of the processed stream on an analyzer thread,
+        # spectrum frame size and number of log-spaced bands
+        self.metering = False
+        self.meter_fft_size = 2048
+        self.meter_spectrum_bands = 32
+        # '[host:]port' of the local HTTP/JSON statistics endpoint ('' - disabled)
+        self.stats_address = ''
+        # per-stage timings and GC pauses from the start (toggled at run time by SIGUSR1
+        # or POST /profile), collapsed stacks of the processing threads ('' - no sampling)
+        # and the sampling interval
+        self.profiling = False
+        self.profiling_stacks_file = ''
+        self.profiling_sample_interval_ms = 1.0
 
     def serialize(self):
         data = {SETTINGS_KEY_FRAME_SIZE: self.frame_size,
-                # SETTINGS_KEY_CHANNELS: self.channels,
+                SETTINGS_KEY_CHANNELS: self.channels,
                 # SETTINGS_KEY_FORMAT: self.format,
                 SETTINGS_KEY_RATE: self.rate,
                 SETTINGS_KEY_BUILD_IN_INPUT: self.build_in_input_audio_device_name,
                 SETTINGS_KEY_BUILD_IN_OUTPUT: self.build_in_output_audio_device_name,
-                SETTINGS_KEY_VIRTUAL_DEVICE: self.virtual_audio_device_name}
+                SETTINGS_KEY_VIRTUAL_DEVICE: self.virtual_audio_device_name,
+                SETTINGS_KEY_OFFLINE_BLOCK_SIZE: self.offline_block_size,
+                SETTINGS_KEY_THREADED_PROCESSING: self.threaded_processing,
+                SETTINGS_KEY_WORKER_LATENCY_FRAMES: self.worker_latency_frames,
+                SETTINGS_KEY_WRITER_QUEUE_BLOCKS: self.writer_queue_blocks,
+                SETTINGS_KEY_WRITER_BATCH_BLOCKS: self.writer_batch_blocks,
+                SETTINGS_KEY_WRITER_FSYNC_INTERVAL: self.writer_fsync_interval,
+                SETTINGS_KEY_SEGMENT_FRAMES: self.segment_frames,
+                SETTINGS_KEY_SEGMENT_WARMUP_FRAMES: self.segment_warmup_frames,
+                SETTINGS_KEY_SEGMENT_CROSSFADE_FRAMES: self.segment_crossfade_frames,
+                SETTINGS_KEY_STATS_FILE: self.stats_file,
+                SETTINGS_KEY_STATS_INTERVAL: self.stats_interval,
+                SETTINGS_KEY_PROCESSING_GRAPH: self.processing_graph,
+                SETTINGS_KEY_OFFLINE_RATE: self.offline_rate,
+                SETTINGS_KEY_RESAMPLER_TAPS: self.resampler_taps,
+                SETTINGS_KEY_DEVICE_CACHE_FILE: self.device_cache_file,
+                SETTINGS_KEY_SIMULATION_REALTIME: self.simulation_realtime,
+                SETTINGS_KEY_SIMULATION_DURATION: self.simulation_duration,
+                SETTINGS_KEY_SIMULATION_JITTER_MS: self.simulation_jitter_ms,
+                SETTINGS_KEY_SIMULATION_SOURCE: self.simulation_source,
+                SETTINGS_KEY_SIMULATION_SINK: self.simulation_sink,
+                SETTINGS_KEY_AUTOTUNE_LOAD: self.autotune_load,
+                SETTINGS_KEY_AUTOTUNE_DURATION: self.autotune_duration,
+                SETTINGS_KEY_RECORDING_PREALLOCATE_MB: self.recording_preallocate_mb,
+                SETTINGS_KEY_RECORDING_SEGMENT_SECONDS: self.recording_segment_seconds,
+                SETTINGS_KEY_RECORDING_SEGMENT_MB: self.recording_segment_mb,
+                SETTINGS_KEY_NETWORK_PROTOCOL: self.network_protocol,
+                SETTINGS_KEY_NETWORK_PACKET_FRAMES: self.network_packet_frames,
+                SETTINGS_KEY_NETWORK_MIN_LATENCY_MS: self.network_min_latency_ms,
+                SETTINGS_KEY_NETWORK_MAX_LATENCY_MS: self.network_max_latency_ms,
+                SETTINGS_KEY_METERING: self.metering,
+                SETTINGS_KEY_METER_FFT_SIZE: self.meter_fft_size,
+                SETTINGS_KEY_METER_SPECTRUM_BANDS: self.meter_spectrum_bands,
+                SETTINGS_KEY_STATS_ADDRESS: self.stats_address,
+                SETTINGS_KEY_PROFILING: self.profiling,
+                SETTINGS_KEY_PROFILING_STACKS_FILE: self.profiling_stacks_file,
+                SETTINGS_KEY_PROFILING_SAMPLE_INTERVAL_MS: self.profiling_sample_interval_ms}
         with open(SETTINGS_FILE_NAME, 'w+') as out_file:
-            json.dump(data, out_file)
+            json.dump(data, out_file, indent=4, sort_keys=True)
 
     def deserialize(self, filename=SETTINGS_FILE_NAME):
         if os.path.isfile(filename):
                 with open(filename, 'r') as in_file:
                     data = json.load(in_file)
                     self.frame_size = data[SETTINGS_KEY_FRAME_SIZE]
-                    # self.channels = data[SETTINGS_KEY_CHANNELS]
+                    self.channels = data.get(SETTINGS_KEY_CHANNELS, self.channels)
                     # self.format = data[SETTINGS_KEY_FORMAT]
                     self.rate = data[SETTINGS_KEY_RATE]
                     self.build_in_input_audio_device_name = data[SETTINGS_KEY_BUILD_IN_INPUT]
                     self.build_in_output_audio_device_name = data[SETTINGS_KEY_BUILD_IN_OUTPUT]
                     self.virtual_audio_device_name = data[SETTINGS_KEY_VIRTUAL_DEVICE]
+                    self.offline_block_size = data.get(SETTINGS_KEY_OFFLINE_BLOCK_SIZE, self.offline_block_size)
+                    self.threaded_processing = data.get(SETTINGS_KEY_THREADED_PROCESSING, self.threaded_processing)
+                    self.worker_latency_frames = data.get(SETTINGS_KEY_WORKER_LATENCY_FRAMES, self.worker_latency_frames)
+                    self.writer_queue_blocks = data.get(SETTINGS_KEY_WRITER_QUEUE_BLOCKS, self.writer_queue_blocks)
+                    self.writer_batch_blocks = data.get(SETTINGS_KEY_WRITER_BATCH_BLOCKS, self.writer_batch_blocks)
+                    self.writer_fsync_interval = data.get(SETTINGS_KEY_WRITER_FSYNC_INTERVAL, self.writer_fsync_interval)
+                    self.segment_frames = data.get(SETTINGS_KEY_SEGMENT_FRAMES, self.segment_frames)
+                    self.segment_warmup_frames = data.get(SETTINGS_KEY_SEGMENT_WARMUP_FRAMES, self.segment_warmup_frames)
+                    self.segment_crossfade_frames = data.get(SETTINGS_KEY_SEGMENT_CROSSFADE_FRAMES, self.segment_crossfade_frames)
+                    self.stats_file = data.get(SETTINGS_KEY_STATS_FILE, self.stats_file)
+                    self.stats_interval = data.get(SETTINGS_KEY_STATS_INTERVAL, self.stats_interval)
+                    self.processing_graph = data.get(SETTINGS_KEY_PROCESSING_GRAPH, self.processing_graph)
+                    self.offline_rate = data.get(SETTINGS_KEY_OFFLINE_RATE, self.offline_rate)
+                    self.resampler_taps = data.get(SETTINGS_KEY_RESAMPLER_TAPS, self.resampler_taps)
+                    self.device_cache_file = data.get(SETTINGS_KEY_DEVICE_CACHE_FILE, self.device_cache_file)
+                    self.simulation_realtime = data.get(SETTINGS_KEY_SIMULATION_REALTIME, self.simulation_realtime)
+                    self.simulation_duration = data.get(SETTINGS_KEY_SIMULATION_DURATION, self.simulation_duration)
+                    self.simulation_jitter_ms = data.get(SETTINGS_KEY_SIMULATION_JITTER_MS, self.simulation_jitter_ms)
+                    self.simulation_source = data.get(SETTINGS_KEY_SIMULATION_SOURCE, self.simulation_source)
+                    self.simulation_sink = data.get(SETTINGS_KEY_SIMULATION_SINK, self.simulation_sink)
+                    self.autotune_load = data.get(SETTINGS_KEY_AUTOTUNE_LOAD, self.autotune_load)
+                    self.autotune_duration = data.get(SETTINGS_KEY_AUTOTUNE_DURATION, self.autotune_duration)
+                    self.recording_preallocate_mb = data.get(SETTINGS_KEY_RECORDING_PREALLOCATE_MB, self.recording_preallocate_mb)
+                    self.recording_segment_seconds = data.get(SETTINGS_KEY_RECORDING_SEGMENT_SECONDS, self.recording_segment_seconds)
+                    self.recording_segment_mb = data.get(SETTINGS_KEY_RECORDING_SEGMENT_MB, self.recording_segment_mb)
+                    self.network_protocol = data.get(SETTINGS_KEY_NETWORK_PROTOCOL, self.network_protocol)
+                    self.network_packet_frames = data.get(SETTINGS_KEY_NETWORK_PACKET_FRAMES, self.network_packet_frames)
+                    self.network_min_latency_ms = data.get(SETTINGS_KEY_NETWORK_MIN_LATENCY_MS, self.network_min_latency_ms)
+                    self.network_max_latency_ms = data.get(SETTINGS_KEY_NETWORK_MAX_LATENCY_MS, self.network_max_latency_ms)
+                    self.metering = data.get(SETTINGS_KEY_METERING, self.metering)
+                    self.meter_fft_size = data.get(SETTINGS_KEY_METER_FFT_SIZE, self.meter_fft_size)
+                    self.meter_spectrum_bands = data.get(SETTINGS_KEY_METER_SPECTRUM_BANDS, self.meter_spectrum_bands)
+                    self.stats_address = data.get(SETTINGS_KEY_STATS_ADDRESS, self.stats_address)
+                    self.profiling = data.get(SETTINGS_KEY_PROFILING, self.profiling)
+                    self.profiling_stacks_file = data.get(SETTINGS_KEY_PROFILING_STACKS_FILE, self.profiling_stacks_file)
+                    self.profiling_sample_interval_ms = data.get(SETTINGS_KEY_PROFILING_SAMPLE_INTERVAL_MS, self.profiling_sample_interval_ms)
         else:
             print "{} couldn't be found. Applying default settings.".format(SETTINGS_FILE_NAME)
             self.serialize()
             self.deserialize()
 
+    def apply(self, data):
+        """
+        Override settings by a dictionary with `settings.json` keys
+        """
+        for key, value in data.items():
+            if key not in self.__dict__:
+                raise ValueError("Unknown setting '{}'".format(key))
+            setattr(self, key, value)
+
     def validate_stream_mode(self, stream_mode):
-        p_audio = pyaudio.PyAudio()
+        if stream_mode == StreamMode.File2File:
+            # processed offline, no audio devices are required
+            return True
+
         result = False
 
         if stream_mode == StreamMode.BuildInIn2Out:
-            result = self.detect_build_in_input_device_idx(p_audio) >= 0 and \
-                     self.detect_build_in_output_device_idx(p_audio) >= 0
+            result = self.detect_build_in_input_device_idx() >= 0 and \
+                     self.detect_build_in_output_device_idx() >= 0
         elif stream_mode == StreamMode.BuildInIn2VD:
-            result = self.detect_build_in_input_device_idx(p_audio) >= 0 and \
-                     self.detect_virtual_audio_device_idx(p_audio) >= 0
+            result = self.detect_build_in_input_device_idx() >= 0 and \
+                     self.detect_virtual_audio_device_idx() >= 0
         elif stream_mode == StreamMode.VD2BuildInOut:
-            result = self.detect_virtual_audio_device_idx(p_audio) >= 0 and \
-                     self.detect_build_in_output_device_idx(p_audio) >= 0
-        elif stream_mode == StreamMode.File2File:
-            result = self.detect_build_in_input_device_idx(p_audio) >= 0 and \
-                     self.detect_build_in_output_device_idx(p_audio) >= 0
+            result = self.detect_virtual_audio_device_idx() >= 0 and \
+                     self.detect_build_in_output_device_idx() >= 0
         elif stream_mode == StreamMode.BuildInIn2File:
-            result = self.detect_build_in_input_device_idx(p_audio) >= 0
+            result = self.detect_build_in_input_device_idx() >= 0
         elif stream_mode == StreamMode.File2BuildInOut:
-            result = self.detect_build_in_output_device_idx(p_audio) >= 0
+            result = self.detect_build_in_output_device_idx() >= 0
         elif stream_mode == StreamMode.VD2File:
-            result = self.detect_virtual_audio_device_idx(p_audio) >= 0
+            result = self.detect_virtual_audio_device_idx() >= 0
         elif stream_mode == StreamMode.File2VD:
-            result = self.detect_virtual_audio_device_idx(p_audio) >= 0
+            result = self.detect_virtual_audio_device_idx() >= 0
+        elif stream_mode == StreamMode.BuildInIn2Net:
+            result = self.detect_build_in_input_device_idx() >= 0
+        elif stream_mode == StreamMode.VD2Net:
+            result = self.detect_virtual_audio_device_idx() >= 0
+        elif stream_mode == StreamMode.Net2BuildInOut:
+            result = self.detect_build_in_output_device_idx() >= 0
+        elif stream_mode == StreamMode.Net2VD:
+            result = self.detect_virtual_audio_device_idx() >= 0
         else:
             print "Unsupported stream mode! [%i]" % stream_mode
-        
-        p_audio.terminate()
+
         return result
 
-    @staticmethod
-    def available_devices():
+    def device_registry(self):
         """
-        Get available audio devices
+        :return: DeviceRegistry shared by the sessions of this process
         """
-        names = []
-        p_audio = pyaudio.PyAudio()
-        for i in range(p_audio.get_device_count()):
-            info = p_audio.get_device_info_by_index(i)
-            names.append(info['name'])
-        p_audio.terminate()
-        return names
+        return shared_registry(self.device_cache_file)
 
     @staticmethod
-    def validate_audio_setup(p_audio, input_format, input_channels, rate, input_device):
+    def available_devices(cache_file=''):
         """
-        Validate pyaudio stream setup
-        :param p: PyAudio instance
-        ...
+        Get available audio devices
+        :param cache_file: device cache file of the registry
         """
-        is_supported = p_audio.is_format_supported(
-            input_format=input_format, 
-            input_channels=input_channels, 
-            rate=rate,
-            input_device=input_device)
-        return is_supported
-
-    def detect_virtual_audio_device_idx(self, p):
+        return shared_registry(cache_file).names()
+
+    def detect_virtual_audio_device_idx(self):
         """
         Detect virtual audio device index
-        :param p: PyAudio instance
         :return: device index
         """
-        return self.__detect_device_index(p, self.virtual_audio_device_name)
+        return self.device_registry().find(self.virtual_audio_device_name)
 
 
-    def detect_build_in_input_device_idx(self, p):
+    def detect_build_in_input_device_idx(self):
         """
         Detect Built-in input device index
-        :param p: PyAudio instance
         :return: device index
         """
-        return self.__detect_device_index(p, self.build_in_input_audio_device_name)
+        return self.device_registry().find(self.build_in_input_audio_device_name)
 
 
-    def detect_build_in_output_device_idx(self, p):
+    def detect_build_in_output_device_idx(self):
         """
         Detect Built-in Output device index
-        :param p: PyAudio instance
-        :return: device index
-        """
-        return self.__detect_device_index(p, self.build_in_output_audio_device_name)
-
-    def __detect_device_index(self, p, device_name):
-        """
-        Detect audio device index
-        :param p: PyAudio instance
-        :param device_name:
         :return: device index
         """
-        idx = -1
-        for i in range(p.get_device_count()):
-            info = p.get_device_info_by_index(i)
-            if info['name'] == device_name:
-                idx = info['index']
-                break
-        return idx
\ No newline at end of file
+        return self.device_registry().find(self.build_in_output_audio_device_name)
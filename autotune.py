@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Ilya Shoshin (Galarius)'
+
+import copy
+import time
+from audio_backend import SimulatedBackend
+from extensions import is_power2
+
+# candidate frame sizes, tried in ascending order
+AUTOTUNE_FRAME_SIZES = [32, 64, 128, 256, 512, 1024, 2048, 4096, 8192]
+
+
+class FrameSizeTuner:
+    """
+    Pick the smallest power-of-two frame size for the configured processing chain.
+    Every candidate runs a short probe stream (devices or the simulated
+    backend); the first one whose p99 callback time stays below
+    `autotune_load` of its deadline (frame_size / rate) wins.
+    """
+    def __init__(self, settings, stream_mode, simulate=False, frame_sizes=AUTOTUNE_FRAME_SIZES):
+        """
+        Init tuner
+        :param settings: AudioSettings, `frame_size` is updated by `run`
+        :param stream_mode: live StreamMode to probe
+        :param simulate: probe on the simulated backend as fast as possible instead of devices
+        :param frame_sizes: ascending candidates
+        """
+        for frame_size in frame_sizes:
+            if not is_power2(frame_size):
+                raise ValueError("Frame size {} is not a power of two".format(frame_size))
+        self.settings = settings
+        self.stream_mode = stream_mode
+        self.simulate = simulate
+        self.frame_sizes = sorted(frame_sizes)
+        self.target_load = settings.autotune_load
+        self.probe_duration = settings.autotune_duration
+        self.results = []
+
+    def __backend(self):
+        if not self.simulate:
+            return None
+        backend = SimulatedBackend.from_settings(self.settings)
+        backend.duration = self.probe_duration
+        backend.sink = ''
+        return backend
+
+    def probe(self, frame_size):
+        """
+        Run the processing chain with the given frame size
+        :return: CallbackStats of the probe
+        """
+        from py_streaming_dsp import AudioSession
+        settings = copy.copy(self.settings)
+        settings.frame_size = frame_size
+        session = AudioSession(self.stream_mode, settings, self.__backend())
+        session.open_stream()
+        try:
+            start = time.time()
+            while session.stream.is_active() and time.time() - start < self.probe_duration:
+                time.sleep(0.05)
+        finally:
+            session.close_stream()
+        return session.callback_stats
+
+    def run(self):
+        """
+        Probe candidates from the smallest one
+        :return: selected frame size or None if none is fast enough
+        """
+        self.results = []
+        for frame_size in self.frame_sizes:
+            stats = self.probe(frame_size)
+            p99 = stats.percentile(99)
+            passed = stats.count > 0 and p99 < self.target_load * stats.deadline
+            self.results.append((frame_size, p99, stats.deadline, passed))
+            if passed:
+                return frame_size
+        return None
+
+    def print_stat(self):
+        print "{:>10} {:>9} {:>12} {:>7}".format('frame_size', 'p99 ms', 'deadline ms', 'load')
+        for frame_size, p99, deadline, passed in self.results:
+            print "{:>10} {:>9.3f} {:>12.2f} {:>6.1f}% {}".format(
+                frame_size, 1000.0 * p99, 1000.0 * deadline, 100.0 * p99 / deadline,
+                'ok' if passed else '')
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Ilya Shoshin (Galarius)'
+
+import os
+import glob
+import multiprocessing
+import traceback
+from extensions import elapsed_timer
+
+# per-worker session, created once by the pool initializer
+_session = None
+
+
+def collect_files(source):
+    """
+    Collect wave files to process
+    :param source: directory or glob pattern
+    :return: sorted list of files
+    """
+    if os.path.isdir(source):
+        source = os.path.join(source, '*.wav')
+    return sorted(f for f in glob.glob(source) if os.path.isfile(f))
+
+
+def output_files(files, output_dir):
+    """
+    Map input files to output files, the directories of the inputs below
+    their common directory are kept, so files of the same name in
+    different directories don't overwrite each other
+    :param files: input files
+    :param output_dir: output directory
+    :return: list of output files
+    """
+    files = [os.path.abspath(f) for f in files]
+    # common prefix of the directories, cut back to a whole directory name
+    common = os.path.dirname(os.path.commonprefix([os.path.dirname(f) + os.sep for f in files]))
+    return [os.path.join(output_dir, os.path.relpath(f, common)) for f in files]
+
+
+def init_worker(settings):
+    """
+    Pool initializer, builds the per-worker File2File session
+    :param settings: AudioSettings
+    """
+    # deferred import, py_streaming_dsp is usually the __main__ module
+    from py_streaming_dsp import AudioSession
+    from audio_settings import StreamMode
+    global _session
+    _session = AudioSession(StreamMode.File2File, settings)
+
+
+def worker_session():
+    """
+    :return: AudioSession of the current worker process
+    """
+    return _session
+
+
+def _process_file(job):
+    in_file, out_file = job
+    try:
+        engine = _session.process_file(in_file, out_file)
+        return in_file, engine.frames, engine.rate, engine.elapsed_time, None
+    except Exception:
+        return in_file, 0, 0, 0.0, traceback.format_exc()
+
+
+class BatchProcessor:
+    """
+    Process many files (file) -> [process] -> (file) offline
+    on a pool of worker processes. Every worker builds one AudioSession
+    and reuses its processing chain for all of its files.
+    """
+    def __init__(self, settings, processes=None):
+        """
+        Init batch processor
+        :param settings: AudioSettings passed to the workers
+        :param processes: number of worker processes (default: number of cores)
+        """
+        self.settings = settings
+        self.processes = processes or multiprocessing.cpu_count()
+        self.file_count = 0
+        self.failed_count = 0
+        self.audio_duration = 0.0
+        self.elapsed_time = 0.0
+
+    def run(self, source, output_dir):
+        """
+        Process all files
+        :param source: directory or glob pattern of input wave files
+        :param output_dir: directory for processed files (same names and subdirectories)
+        :return: number of successfully processed files
+        """
+        files = collect_files(source)
+        jobs = [(i, o) for i, o in zip(files, output_files(files, output_dir))
+                if os.path.abspath(i) != os.path.abspath(o)]
+        for directory in set([output_dir] + [os.path.dirname(o) for _, o in jobs]):
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        print "Processing {} files on {} processes...".format(len(jobs), self.processes)
+
+        pool = multiprocessing.Pool(self.processes, init_worker, (self.settings,))
+        try:
+            with elapsed_timer() as elapsed:
+                for in_file, frames, rate, _, error in pool.imap_unordered(_process_file, jobs):
+                    if error:
+                        self.failed_count += 1
+                        print "Failed to process {}:\n{}".format(in_file, error)
+                    else:
+                        self.file_count += 1
+                        self.audio_duration += float(frames) / rate if rate else 0.0
+                self.elapsed_time = elapsed()
+            pool.close()
+        except KeyboardInterrupt:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        return self.file_count
+
+    def print_stat(self):
+        elapsed_time = self.elapsed_time or 1e-9
+        print "Processed: {} files ({} failed), {:0.2f} h of audio in {:0.1f} s".format(
+            self.file_count, self.failed_count, self.audio_duration / 3600.0, self.elapsed_time)
+        print "Throughput: {:0.1f} files/s, {:0.3f} audio-hours/s".format(
+            self.file_count / elapsed_time, self.audio_duration / 3600.0 / elapsed_time)
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+
+__author__ = 'Ilya Shoshin (Galarius)'
+
+import sys, getopt
+import gc
+import json
+import platform
+from timeit import default_timer
+import numpy as np
+import audio_helper as ah
+from audio_settings import StreamMode, AudioSettings
+
+FRAME_SIZES = [64, 128, 256, 512, 1024, 2048, 4096, 8192]
+FORMATS     = ['int16', 'int24', 'int32', 'float32']
+CHANNELS    = [1, 2, 8]
+RATE        = 44100
+# minimum duration of a timed run and number of runs (best is taken)
+MIN_RUN_TIME = 0.02
+REPEAT       = 5
+# calls averaged by the retained objects measurement
+RETAIN_CALLS = 100
+
+
+def synthetic_signal(frame_size, channels, dtype):
+    """
+    Sine per channel with a little noise, full scale -6 dB
+    :return: (frames x channels) array
+    """
+    t = np.arange(frame_size)[:, np.newaxis] / float(RATE)
+    freqs = 220.0 * (1 + np.arange(channels))[np.newaxis, :]
+    signal = 0.5 * np.sin(2 * np.pi * freqs * t) + 0.01 * np.random.randn(frame_size, channels)
+    return ah.from_float32(signal, dtype)
+
+
+def sample_dtype(fmt):
+    """
+    :param fmt: NumPy type name or 'int24' (packed)
+    """
+    return ah.INT24 if fmt == 'int24' else np.dtype(fmt)
+
+
+def time_per_call(func):
+    """
+    :return: best time of a single call in seconds
+    """
+    func()
+    number = 1
+    while True:
+        start = default_timer()
+        for _ in range(number):
+            func()
+        elapsed = default_timer() - start
+        if elapsed >= MIN_RUN_TIME:
+            break
+        number *= 2
+    best = elapsed
+    for _ in range(REPEAT - 1):
+        start = default_timer()
+        for _ in range(number):
+            func()
+        best = min(best, default_timer() - start)
+    return best / number
+
+
+def retained_count(func):
+    """
+    :return: growth of the generation 0 count over RETAIN_CALLS calls
+    """
+    gc.collect()
+    count = gc.get_count()[0]
+    for _ in range(RETAIN_CALLS):
+        func()
+    return gc.get_count()[0] - count
+
+
+def retained_objects_per_call(func):
+    """
+    Approximate number of objects tracked by the garbage collector
+    (containers) left alive by a call: the growth of the generation 0 count,
+    which allocations increment and deallocations decrement. Temporaries
+    freed within the call and NumPy array buffers are not counted, the
+    measure detects state growing per callback.
+    :return: mean number of retained objects per call
+    """
+    func()
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        # the measuring loop itself
+        baseline = retained_count(lambda: None)
+        return float(retained_count(func) - baseline) / RETAIN_CALLS
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def benchmark_cases(processing, frame_size, channels, fmt):
+    """
+    :return: list of (name, callable) measured for the given configuration
+    """
+    dtype = sample_dtype(fmt)
+    frames = synthetic_signal(frame_size, channels, dtype)
+    in_data = frames.tobytes()
+    codec = ah.AudioCodec(frame_size, channels, dtype)
+    # processing works on float32 whatever the stream format is
+    signal = ah.to_float32(frames)
+
+    def callback():
+        codec.encode(processing(codec.decode(in_data)))
+
+    cases = [('audio_decode', lambda: ah.audio_decode(in_data, channels, dtype)),
+             ('audio_encode', lambda: ah.audio_encode(signal, dtype)),
+             ('codec_decode', lambda: codec.decode(in_data)),
+             ('codec_encode', lambda: codec.encode(signal)),
+             ('processing', lambda: processing(signal)),
+             ('callback', callback)]
+    if dtype.kind == 'f':
+        cases.append(('float2pcm', lambda: ah.float2pcm(frames, np.int16)))
+    elif dtype != ah.INT24:
+        cases.append(('pcm2float', lambda: ah.pcm2float(frames, np.float32)))
+    return cases
+
+
+def run(session, frame_sizes=FRAME_SIZES, formats=FORMATS, channels_list=CHANNELS):
+    """
+    Run the benchmark sweep
+    :param session: AudioSession providing the processing chain
+    :return: list of result dictionaries
+    """
+    results = []
+    for fmt in formats:
+        for channels in channels_list:
+            # the chain is prepared for the channels of every case from a fresh state
+            session.prepare_for(channels, RATE)
+            processing = session.offline_engine.processing
+            for frame_size in frame_sizes:
+                deadline = float(frame_size) / RATE
+                for name, func in benchmark_cases(processing, frame_size, channels, fmt):
+                    elapsed = time_per_call(func)
+                    result = {'name': name,
+                              'format': fmt,
+                              'channels': channels,
+                              'frame_size': frame_size,
+                              'ns_per_sample': 1e9 * elapsed / (frame_size * channels),
+                              'headroom': deadline / elapsed if elapsed else float('inf'),
+                              'retained_objects': retained_objects_per_call(func)}
+                    results.append(result)
+                    print_result(result)
+    return results
+
+
+def print_result(result):
+    print "{format:>7} {channels:>2}ch {frame_size:>5} {name:<13} {ns_per_sample:>9.2f} ns/sample {headroom:>10.1f}x headroom {retained_objects:>7.2f} retained objects".format(
+        **result)
+
+
+def save(results, filename):
+    data = {'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'results': results}
+    with open(filename, 'w') as out_file:
+        json.dump(data, out_file, indent=4, sort_keys=True)
+
+
+def compare(base_filename, new_filename):
+    """
+    Print ns/sample of the new results relative to the base results
+    """
+    def load(filename):
+        with open(filename, 'r') as in_file:
+            results = json.load(in_file)['results']
+        return dict(((r['name'], r['format'], r['channels'], r['frame_size']), r) for r in results)
+    base, new = load(base_filename), load(new_filename)
+    print "{:>7} {:>4} {:>5} {:<13} {:>10} {:>10} {:>7}".format(
+        'format', 'ch', 'frame', 'name', 'base ns', 'new ns', 'ratio')
+    for key in sorted(set(base) & set(new), key=lambda k: (k[1], k[2], k[3], k[0])):
+        name, fmt, channels, frame_size = key
+        b, n = base[key]['ns_per_sample'], new[key]['ns_per_sample']
+        print "{:>7} {:>4} {:>5} {:<13} {:>10.2f} {:>10.2f} {:>6.2f}x".format(
+            fmt, channels, frame_size, name, b, n, n / b if b else float('inf'))
+
+
+def print_usage(name):
+    print """
+Benchmark of the codec and processing path, no audio devices are required.
+
+python {0} [-h] [-o <results.json>] [-f <frame sizes>] [-c <channels>] [-F <formats>]
+python {0} --compare <base.json> <new.json>
+
+Options:
+    -h print this help message
+    -o, --ofile= save results as JSON
+    -f, --frames= comma separated frame sizes (default: 64,...,8192)
+    -c, --channels= comma separated channel counts (default: 1,2,8)
+    -F, --formats= comma separated formats (default: int16,int24,int32,float32)
+    --compare compare two saved results (ns/sample, new / base)
+""".format(name)
+
+
+def main(opts, args):
+    from py_streaming_dsp import AudioSession
+
+    out_file = ''
+    frame_sizes, channels_list, formats = FRAME_SIZES, CHANNELS, FORMATS
+    for opt, arg in opts:
+        if opt == '-h':
+            print_usage(sys.argv[0])
+            sys.exit(0)
+        elif opt == '--compare':
+            if len(args) != 2:
+                print_usage(sys.argv[0])
+                sys.exit(2)
+            compare(args[0], args[1])
+            sys.exit(0)
+        elif opt in ("-o", "--ofile"):
+            out_file = arg
+        elif opt in ("-f", "--frames"):
+            frame_sizes = [int(v) for v in arg.split(',')]
+        elif opt in ("-c", "--channels"):
+            channels_list = [int(v) for v in arg.split(',')]
+        elif opt in ("-F", "--formats"):
+            formats = arg.split(',')
+
+    settings = AudioSettings()
+    settings.deserialize()
+    # a File2File session without files only provides its processing chain
+    session = AudioSession(StreamMode.File2File, settings)
+    results = run(session, frame_sizes, formats, channels_list)
+    if out_file:
+        save(results, out_file)
+        print "Results saved to {}".format(out_file)
+
+
+if __name__ == "__main__":
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "ho:f:c:F:",
+                                   ["ofile=", "frames=", "channels=", "formats=", "compare"])
+    except getopt.GetoptError:
+        print_usage(sys.argv[0])
+        sys.exit(2)
+
+    main(opts, args)
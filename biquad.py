@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Ilya Shoshin (Galarius)'
+
+import math
+import numpy as np
+from processing_graph import Processor
+
+try:
+    from scipy.signal import sosfilt
+except ImportError:
+    # blocks are filtered by matrix products of _SectionPlan
+    sosfilt = None
+
+BUTTERWORTH_Q = 1.0 / math.sqrt(2.0)
+# block filtering without SciPy: frames per chunk (length of the truncated impulse
+# response), chunks per matrix product and cached section plans
+PLAN_CHUNK_FRAMES = 64
+PLAN_CHUNKS = 64
+PLAN_CACHE_SIZE = 256
+
+SECTION_KEY_TYPE      = 'type'
+SECTION_KEY_FREQUENCY = 'frequency'
+SECTION_KEY_Q         = 'q'
+SECTION_KEY_GAIN_DB   = 'gain_db'
+
+FILTER_TYPES = ['lowpass', 'highpass', 'bandpass', 'notch', 'allpass', 'peaking', 'lowshelf', 'highshelf']
+
+
+def design_biquad(kind, frequency, rate, q=BUTTERWORTH_Q, gain_db=0.0):
+    """
+    Second-order section of the RBJ Audio EQ Cookbook
+    :param kind: one of FILTER_TYPES
+    :param frequency: cutoff or centre frequency in Hz
+    :param rate: sample rate
+    :param q: quality factor
+    :param gain_db: gain of peaking and shelving filters
+    :return: [b0, b1, b2, 1, a1, a2]
+    """
+    if not 0 < frequency < 0.5 * rate:
+        raise ValueError("Filter frequency {} Hz is out of range (0, {})".format(frequency, 0.5 * rate))
+    w0 = 2 * math.pi * frequency / rate
+    alpha = math.sin(w0) / (2 * q)
+    c = math.cos(w0)
+    a = 10 ** (gain_db / 40.0)
+    if kind == 'lowpass':
+        b, den = [(1 - c) / 2, 1 - c, (1 - c) / 2], [1 + alpha, -2 * c, 1 - alpha]
+    elif kind == 'highpass':
+        b, den = [(1 + c) / 2, -(1 + c), (1 + c) / 2], [1 + alpha, -2 * c, 1 - alpha]
+    elif kind == 'bandpass':
+        # 0 dB peak gain
+        b, den = [alpha, 0.0, -alpha], [1 + alpha, -2 * c, 1 - alpha]
+    elif kind == 'notch':
+        b, den = [1.0, -2 * c, 1.0], [1 + alpha, -2 * c, 1 - alpha]
+    elif kind == 'allpass':
+        b, den = [1 - alpha, -2 * c, 1 + alpha], [1 + alpha, -2 * c, 1 - alpha]
+    elif kind == 'peaking':
+        b, den = [1 + alpha * a, -2 * c, 1 - alpha * a], [1 + alpha / a, -2 * c, 1 - alpha / a]
+    elif kind == 'lowshelf':
+        s = 2 * math.sqrt(a) * alpha
+        b = [a * ((a + 1) - (a - 1) * c + s), 2 * a * ((a - 1) - (a + 1) * c), a * ((a + 1) - (a - 1) * c - s)]
+        den = [(a + 1) + (a - 1) * c + s, -2 * ((a - 1) + (a + 1) * c), (a + 1) + (a - 1) * c - s]
+    elif kind == 'highshelf':
+        s = 2 * math.sqrt(a) * alpha
+        b = [a * ((a + 1) + (a - 1) * c + s), -2 * a * ((a - 1) + (a + 1) * c), a * ((a + 1) + (a - 1) * c - s)]
+        den = [(a + 1) - (a - 1) * c + s, 2 * ((a - 1) - (a + 1) * c), (a + 1) - (a - 1) * c - s]
+    else:
+        raise ValueError("Unknown filter type '{}'".format(kind))
+    a0 = den[0]
+    return [b[0] / a0, b[1] / a0, b[2] / a0, 1.0, den[1] / a0, den[2] / a0]
+
+
+def design_sections(sections, rate):
+    """
+    :param sections: list of {"type": ..., "frequency": ..., "q": ..., "gain_db": ...}
+    :param rate: sample rate
+    :return: (sections x 6) second-order sections
+    """
+    return np.array([design_biquad(section[SECTION_KEY_TYPE], section[SECTION_KEY_FREQUENCY], rate,
+                                   section.get(SECTION_KEY_Q, BUTTERWORTH_Q),
+                                   section.get(SECTION_KEY_GAIN_DB, 0.0))
+                     for section in sections], dtype=np.float64).reshape(-1, 6)
+
+
+class _SectionPlan:
+    """
+    Filters blocks through one second-order section with matrix products
+    instead of a per-sample loop. In the state-space form of the transposed
+    direct form II (state s = [z1, z2], s' = A s + B x, y = s[0] + b0 x)
+    the output of a chunk of PLAN_CHUNK_FRAMES frames is its convolution
+    with the impulse response truncated to the chunk (exact within it)
+    plus the response to the state at the chunk start; the chunk start
+    states follow from the powers of A. The products run in BLAS without
+    the GIL and all channels are filtered at once.
+    """
+    def __init__(self, b0, b1, b2, a1, a2):
+        size, chunks = PLAN_CHUNK_FRAMES, PLAN_CHUNKS
+        a = np.array([[-a1, 1.0], [-a2, 0.0]])
+        b = np.array([b1 - a1 * b0, b2 - a2 * b0])
+        # A^n, n = 0..size
+        self.powers = np.empty((size + 1, 2, 2))
+        self.powers[0] = np.eye(2)
+        for n in range(size):
+            self.powers[n + 1] = np.dot(a, self.powers[n])
+        # A^n B, the response to an input sample after n + 1 frames
+        steps = np.dot(self.powers[:size], b)
+        impulse = np.concatenate(([b0], steps[:-1, 0]))
+        lags = np.arange(size)[:, np.newaxis] - np.arange(size)[np.newaxis, :]
+        # (chunk x chunk) lower triangular convolution matrix
+        self.convolution = np.where(lags >= 0, impulse[np.maximum(lags, 0)], 0.0)
+        # output row of A^n: response to the chunk start state
+        self.state_response = self.powers[:size, 0, :]
+        # contribution of every chunk frame to the next chunk start state
+        self.state_input = steps[::-1].T
+        # chunk start states: S_k = M^k s + sum(M^(k-1-j) U_j, j < k), M = A^size
+        chunk_powers = [np.eye(2)]
+        for _ in range(chunks):
+            chunk_powers.append(np.dot(self.powers[size], chunk_powers[-1]))
+        chunk_powers = np.array(chunk_powers)
+        self.chunk_state = chunk_powers[:chunks].reshape(2 * chunks, 2)
+        lags = np.arange(chunks)[:, np.newaxis] - np.arange(chunks)[np.newaxis, :] - 1
+        blocks = chunk_powers[np.maximum(lags, 0)] * (lags >= 0)[:, :, np.newaxis, np.newaxis]
+        self.chunk_input = blocks.transpose(0, 2, 1, 3).reshape(2 * chunks, 2 * chunks)
+
+    def filter(self, x, state):
+        """
+        Filter in place
+        :param x: C-contiguous (frames x channels) float64 block
+        :param state: (2 x channels) section state, updated in place
+        """
+        size = PLAN_CHUNK_FRAMES
+        channels = x.shape[1]
+        position = 0
+        while len(x) - position >= size:
+            count = min((len(x) - position) // size, PLAN_CHUNKS)
+            chunks = x[position:position + count * size].reshape(count, size, channels)
+            inputs = np.dot(self.state_input, chunks).transpose(1, 0, 2).reshape(2 * count, channels)
+            starts = (np.dot(self.chunk_state[:2 * count], state) +
+                      np.dot(self.chunk_input[:2 * count, :2 * count], inputs)).reshape(count, 2, channels)
+            out = np.dot(self.convolution, chunks) + np.dot(self.state_response, starts)
+            state[:] = np.dot(self.powers[size], starts[-1]) + inputs[-2:]
+            chunks[:] = out.transpose(1, 0, 2)
+            position += count * size
+        rest = len(x) - position
+        if rest:
+            tail = x[position:]
+            out = np.dot(self.convolution[:rest, :rest], tail) + np.dot(self.state_response[:rest], state)
+            state[:] = np.dot(self.powers[rest], state) + np.dot(self.state_input[:, size - rest:], tail)
+            tail[:] = out
+
+
+_section_plans = {}
+
+
+def _section_plan(section):
+    key = tuple(section)
+    plan = _section_plans.get(key)
+    if plan is None:
+        if len(_section_plans) >= PLAN_CACHE_SIZE:
+            _section_plans.clear()
+        b0, b1, b2, _, a1, a2 = key
+        plan = _section_plans[key] = _SectionPlan(b0, b1, b2, a1, a2)
+    return plan
+
+
+def _sosfilt(sos, block, zi):
+    """
+    :return: (filtered float64 block, final state)
+    """
+    if sosfilt is not None:
+        return sosfilt(sos, block, axis=0, zi=zi)
+    out = np.array(block, dtype=np.float64, order='C')
+    zi = zi.copy()
+    for section in range(len(sos)):
+        _section_plan(sos[section]).filter(out, zi[section])
+    return out, zi
+
+
+class BiquadCascade:
+    """
+    Cascade of second-order sections filtering all channels of a
+    (frames x channels) block in one call (scipy.signal.sosfilt when available,
+    block matrix products otherwise).
+    The section state is carried from block to block, so block boundaries
+    don't click. New coefficients are crossfaded in: during the ramp
+    the old and the new cascade both run and their outputs are mixed,
+    which avoids the zipper noise of switching coefficients abruptly.
+    A change requested during a ramp waits until the ramp finishes
+    (only the latest one is kept), so a ramp never restarts mid-way.
+    """
+    def __init__(self, sos, channels):
+        """
+        Init cascade
+        :param sos: (sections x 6) second-order sections [b0, b1, b2, 1, a1, a2]
+        :param channels: number of channels
+        """
+        self.channels = channels
+        self.sos = np.array(sos, dtype=np.float64).reshape(-1, 6)
+        self.zi = np.zeros((len(self.sos), 2, channels))
+        self.__old = None
+        self.__ramp_position = 0
+        self.__ramp_frames = 0
+        self.__queued = None
+
+    def reset(self):
+        self.__old = None
+        if self.__queued is not None:
+            self.__switch(self.__queued[0], 0)
+            self.__queued = None
+        self.zi[:] = 0
+
+    def set_coefficients(self, sos, ramp_frames=0):
+        """
+        Change the filter
+        :param sos: (sections x 6) second-order sections
+        :param ramp_frames: length of the crossfade from the current filter (0 - switch at once)
+        """
+        sos = np.array(sos, dtype=np.float64).reshape(-1, 6)
+        if ramp_frames and self.__old is not None:
+            # restarting the running ramp would jump, start after it
+            self.__queued = (sos, ramp_frames)
+            return
+        self.__queued = None
+        self.__switch(sos, ramp_frames)
+
+    def __switch(self, sos, ramp_frames):
+        if ramp_frames:
+            self.__old = (self.sos, self.zi.copy())
+            self.__ramp_position = 0
+            self.__ramp_frames = ramp_frames
+        if len(sos) != len(self.sos):
+            self.zi = np.zeros((len(sos), 2, self.channels))
+        self.sos = sos
+
+    @property
+    def ramping(self):
+        return self.__old is not None
+
+    def process(self, block):
+        """
+        Filter a block
+        :param block: (frames x channels) input
+        :return: (frames x channels) float64 output
+        """
+        out, self.zi = _sosfilt(self.sos, block, self.zi)
+        if self.__old is not None:
+            old_sos, old_zi = self.__old
+            old_out, old_zi = _sosfilt(old_sos, block, old_zi)
+            ramp = (self.__ramp_position + 1.0 + np.arange(len(block))) / self.__ramp_frames
+            np.minimum(ramp, 1.0, out=ramp)
+            out = old_out + (out - old_out) * ramp[:, np.newaxis]
+            self.__ramp_position += len(block)
+            self.__old = (old_sos, old_zi) if self.__ramp_position < self.__ramp_frames else None
+            if self.__old is None and self.__queued is not None:
+                sos, ramp_frames = self.__queued
+                self.__queued = None
+                self.__switch(sos, ramp_frames)
+        return out
+
+
+class Biquad(Processor):
+    """
+    Processing graph node for EQ: a biquad cascade described by sections
+    {"type": "peaking", "frequency": 1000, "q": 1.0, "gain_db": -3.0}.
+    Coefficients of named `presets` are computed once in `prepare`;
+    `select_preset` and `set_sections` may be called from any thread,
+    the change is applied with a `ramp_ms` crossfade at the next block.
+    """
+    formats = ('float32',)
+
+    def __init__(self, sections=None, presets=None, preset=None, ramp_ms=20.0):
+        """
+        :param sections: list of section descriptions (ignored if `preset` is given)
+        :param presets: {name: list of section descriptions}
+        :param preset: initial preset
+        :param ramp_ms: crossfade duration of coefficient changes
+        """
+        self.sections = sections or []
+        self.presets = presets or {}
+        self.preset = preset
+        if preset is not None and preset not in self.presets:
+            raise ValueError("Unknown preset '{}'".format(preset))
+        if not self.sections and preset is None:
+            raise ValueError("Biquad requires `sections` or `preset`")
+        self.ramp_ms = ramp_ms
+        self.cascade = None
+        self.__pending = None
+
+    def prepare(self, frame_size, channels, rate, dtype):
+        self.rate = rate
+        self.ramp_frames = int(self.ramp_ms * rate / 1000.0)
+        self.preset_sos = dict((name, design_sections(sections, rate))
+                               for name, sections in self.presets.items())
+        if self.preset is not None:
+            sos = self.preset_sos[self.preset]
+        else:
+            sos = design_sections(self.sections, rate)
+        self.cascade = BiquadCascade(sos, channels)
+        self.__pending = None
+
+    def select_preset(self, name):
+        """
+        Switch to precomputed coefficients
+        """
+        if name not in self.preset_sos:
+            raise ValueError("Unknown preset '{}'".format(name))
+        self.preset = name
+        self.__pending = self.preset_sos[name]
+
+    def set_sections(self, sections):
+        """
+        Switch to new section descriptions (coefficients are computed by the caller's thread)
+        """
+        self.__pending = design_sections(sections, self.rate)
+
+    def process(self, block):
+        pending = self.__pending
+        if pending is not None:
+            self.__pending = None
+            self.cascade.set_coefficients(pending, self.ramp_frames)
+        block[:] = self.cascade.process(block)
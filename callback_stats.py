@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Ilya Shoshin (Galarius)'
+
+import os
+import json
+import math
+import numpy as np
+import pyaudio
+
+# log-spaced histogram covers [HISTOGRAM_MIN_TIME, HISTOGRAM_RANGE * deadline),
+# faster and slower callbacks share the first and the last bin
+HISTOGRAM_BINS     = 2000
+HISTOGRAM_RANGE    = 2.0
+HISTOGRAM_MIN_TIME = 1e-6
+
+
+class CallbackStats:
+    """
+    Fixed-memory statistics of the audio callback.
+    Processing time is recorded into a log-spaced histogram up to twice
+    the callback deadline (frame_size / rate), so percentiles are available
+    at any time with a constant relative resolution (~0.5% at 1024 frames).
+    PortAudio status flags are counted as well.
+    """
+    def __init__(self, frame_size, rate):
+        """
+        Init statistics
+        :param frame_size: frames per callback
+        :param rate: sample rate
+        """
+        self.frame_size = frame_size
+        self.rate = rate
+        self.deadline = float(frame_size) / rate
+        self.log_bin_width = math.log(HISTOGRAM_RANGE * self.deadline / HISTOGRAM_MIN_TIME) / HISTOGRAM_BINS
+        self.histogram = np.zeros(HISTOGRAM_BINS + 1, dtype=np.int64)
+        self.reset()
+
+    def reset(self):
+        self.histogram[:] = 0
+        self.count = 0
+        self.total_time = 0.0
+        self.min_time = float('inf')
+        self.max_time = 0.0
+        self.max_load = 0.0
+        self.deadline_misses = 0
+        self.input_underflow_count = 0
+        self.input_overflow_count = 0
+        self.output_underflow_count = 0
+        self.output_overflow_count = 0
+        self.priming_output_count = 0
+
+    def record(self, elapsed, frame_count, status=0):
+        """
+        Record one callback (audio thread side, no allocations)
+        :param elapsed: processing time in seconds
+        :param frame_count: frames processed by the callback
+        :param status: PortAudio status flags
+        """
+        self.count += 1
+        self.total_time += elapsed
+        if elapsed < self.min_time:
+            self.min_time = elapsed
+        if elapsed > self.max_time:
+            self.max_time = elapsed
+        load = elapsed * self.rate / frame_count if frame_count else 0.0
+        if load > self.max_load:
+            self.max_load = load
+        if load > 1.0:
+            self.deadline_misses += 1
+        if elapsed > HISTOGRAM_MIN_TIME:
+            idx = min(int(math.log(elapsed / HISTOGRAM_MIN_TIME) / self.log_bin_width), HISTOGRAM_BINS)
+        else:
+            idx = 0
+        self.histogram[idx] += 1
+        if status:
+            if status & pyaudio.paInputUnderflow:
+                self.input_underflow_count += 1
+            if status & pyaudio.paInputOverflow:
+                self.input_overflow_count += 1
+            if status & pyaudio.paOutputUnderflow:
+                self.output_underflow_count += 1
+            if status & pyaudio.paOutputOverflow:
+                self.output_overflow_count += 1
+            if status & pyaudio.paPrimingOutput:
+                self.priming_output_count += 1
+
+    def percentile(self, q):
+        """
+        :param q: percentile in range [0, 100]
+        :return: upper edge of the histogram bin in seconds
+        """
+        if not self.count:
+            return 0.0
+        cumulative = np.cumsum(self.histogram)
+        idx = int(np.searchsorted(cumulative, q / 100.0 * self.count))
+        if idx >= HISTOGRAM_BINS:
+            return self.max_time
+        return min(HISTOGRAM_MIN_TIME * math.exp((idx + 1) * self.log_bin_width), self.max_time)
+
+    def to_dict(self):
+        mean_time = self.total_time / self.count if self.count else 0.0
+        return {
+            'callbacks': self.count,
+            'frame_size': self.frame_size,
+            'rate': self.rate,
+            'deadline_ms': 1000.0 * self.deadline,
+            'min_ms': 1000.0 * self.min_time if self.count else 0.0,
+            'mean_ms': 1000.0 * mean_time,
+            'max_ms': 1000.0 * self.max_time,
+            'p50_ms': 1000.0 * self.percentile(50),
+            'p95_ms': 1000.0 * self.percentile(95),
+            'p99_ms': 1000.0 * self.percentile(99),
+            'p99.9_ms': 1000.0 * self.percentile(99.9),
+            'cpu_load_mean': mean_time / self.deadline,
+            'cpu_load_max': self.max_load,
+            'deadline_misses': self.deadline_misses,
+            'input_underflows': self.input_underflow_count,
+            'input_overflows': self.input_overflow_count,
+            'output_underflows': self.output_underflow_count,
+            'output_overflows': self.output_overflow_count,
+            'priming_output': self.priming_output_count,
+        }
+
+    def print_stat(self):
+        stats = self.to_dict()
+        print "Processing time: min %0.2f ms, p50 %0.2f ms, p99 %0.2f ms, max %0.2f ms (deadline %0.2f ms)" % (
+            stats['min_ms'], stats['p50_ms'], stats['p99_ms'], stats['max_ms'], stats['deadline_ms'])
+        print "CPU load: mean %0.1f%%, max %0.1f%%, deadline misses: %i" % (
+            100.0 * stats['cpu_load_mean'], 100.0 * stats['cpu_load_max'], stats['deadline_misses'])
+        print "Input overflows: %i, output underflows: %i" % (
+            stats['input_overflows'], stats['output_underflows'])
+
+
+def dump_stats(stats, filename):
+    """
+    Atomically write statistics as JSON
+    :param stats: dictionary
+    :param filename: output file
+    """
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as out_file:
+        json.dump(stats, out_file, indent=4, sort_keys=True)
+    os.rename(tmp_filename, filename)
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Ilya Shoshin (Galarius)'
+
+import hashlib
+import numpy as np
+import audio_helper as ah
+from processing_graph import Processor
+from wave_mmap import MappedWaveReader
+
+# IR spectra shared by all convolvers, keyed by IR digest and partition size
+_SPECTRA_CACHE = {}
+
+
+def ir_spectra(ir, partition_size):
+    """
+    Spectra of the zero-padded IR partitions
+    :param ir: (taps x channels) impulse response
+    :param partition_size: partition length
+    :return: (partitions x partition_size + 1 x channels) complex array, read-only
+    """
+    ir = np.ascontiguousarray(ir, dtype=np.float64)
+    key = (hashlib.sha1(ir.tobytes()).hexdigest(), ir.shape, partition_size)
+    spectra = _SPECTRA_CACHE.get(key)
+    if spectra is None:
+        taps, channels = ir.shape
+        partitions = max(-(-taps // partition_size), 1)
+        padded = np.zeros((partitions, 2 * partition_size, channels))
+        for p in range(partitions):
+            part = ir[p * partition_size:(p + 1) * partition_size]
+            padded[p, :len(part)] = part
+        spectra = np.fft.rfft(padded, axis=1).astype(np.complex64)
+        spectra.flags.writeable = False
+        _SPECTRA_CACHE[key] = spectra
+    return spectra
+
+
+class PartitionedConvolver:
+    """
+    Uniformly partitioned overlap-save convolution for long FIR filters.
+    The IR is split into partitions of `partition_size` taps whose spectra
+    are cached; every full input block is transformed once, pushed into
+    a frequency-domain delay line and multiplied with all partition spectra
+    in a single vectorized call across partitions and channels.
+    Blocks of any length are accepted, the latency is `partition_size` frames.
+    """
+    def __init__(self, ir, partition_size, channels):
+        """
+        Init convolver
+        :param ir: (taps,) or (taps x channels) impulse response
+        :param partition_size: partition length, normally the stream frame size
+        :param channels: number of channels, a mono IR is applied to all of them
+        """
+        ir = np.asarray(ir, dtype=np.float64)
+        if ir.ndim == 1:
+            ir = ir[:, np.newaxis]
+        if ir.shape[1] == 1 and channels > 1:
+            ir = np.repeat(ir, channels, axis=1)
+        elif ir.shape[1] != channels:
+            raise ValueError("IR has {} channels, expected 1 or {}".format(ir.shape[1], channels))
+        self.partition_size = partition_size
+        self.channels = channels
+        self.taps = len(ir)
+        # reversed, so that it pairs with the oldest-first delay line window
+        self.spectra = ir_spectra(ir, partition_size)[::-1]
+        self.partitions = len(self.spectra)
+        bins = partition_size + 1
+        # delay line is stored twice so that the last `partitions` spectra are contiguous
+        self.__fdl = np.zeros((2 * self.partitions, bins, channels), dtype=np.complex64)
+        self.__position = 0
+        self.__accumulator = np.zeros((bins, channels), dtype=np.complex64)
+        self.__time = np.zeros((2 * partition_size, channels), dtype=np.float32)
+        self.__in_block = np.zeros((partition_size, channels), dtype=np.float32)
+        self.__out_block = np.zeros((partition_size, channels), dtype=np.float32)
+        self.__fill = 0
+
+    def reset(self):
+        self.__fdl[:] = 0
+        self.__time[:] = 0
+        self.__out_block[:] = 0
+        self.__fill = 0
+
+    def __convolve_block(self):
+        size = self.partition_size
+        self.__time[:size] = self.__time[size:]
+        self.__time[size:] = self.__in_block
+        spectrum = np.fft.rfft(self.__time, axis=0)
+        self.__position = (self.__position + 1) % self.partitions
+        position = self.__position
+        self.__fdl[position] = spectrum
+        self.__fdl[position + self.partitions] = spectrum
+        window = self.__fdl[position + 1:position + 1 + self.partitions]
+        np.einsum('pkc,pkc->kc', window, self.spectra, out=self.__accumulator)
+        self.__out_block[:] = np.fft.irfft(self.__accumulator, 2 * size, axis=0)[size:]
+
+    def process(self, block, out):
+        """
+        Convolve a block
+        :param block: (frames x channels) input
+        :param out: (frames x channels) output, may be the input array
+        """
+        size = self.partition_size
+        done = 0
+        while done < len(block):
+            count = min(len(block) - done, size - self.__fill)
+            fill = self.__fill
+            self.__in_block[fill:fill + count] = block[done:done + count]
+            out[done:done + count] = self.__out_block[fill:fill + count]
+            self.__fill += count
+            done += count
+            if self.__fill == size:
+                self.__convolve_block()
+                self.__fill = 0
+
+
+def load_ir(filename):
+    """
+    Load an impulse response from a wave file
+    :return: (taps x channels) float array in range [-1, 1)
+    """
+    source = MappedWaveReader(filename)
+    ir = ah.to_float32(source.frames).astype(np.float64)
+    source.close()
+    return ir
+
+
+class Convolver(Processor):
+    """
+    Processing graph node for long FIR filters (room correction, reverb).
+    The IR is given by `ir_file` (wave) or inline by `ir` ([taps] or [taps][channels]).
+    """
+    def __init__(self, ir_file=None, ir=None, gain=1.0, partition_size=None):
+        if ir_file:
+            ir = load_ir(ir_file)
+        if ir is None:
+            raise ValueError("Convolver requires `ir_file` or `ir`")
+        self.ir = gain * np.asarray(ir, dtype=np.float64)
+        self.partition_size = partition_size
+        self.convolver = None
+
+    def prepare(self, frame_size, channels, rate, dtype):
+        self.convolver = PartitionedConvolver(self.ir, self.partition_size or frame_size, channels)
+        self.__out = np.zeros((frame_size, channels), dtype=np.float32)
+
+    def process(self, block):
+        if len(block) > len(self.__out):
+            self.__out = np.zeros((len(block), block.shape[1]), dtype=np.float32)
+        out = self.__out[:len(block)]
+        self.convolver.process(block, out)
+        block[:] = out
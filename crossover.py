@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Ilya Shoshin (Galarius)'
+
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from processing_graph import Processor, create_processor, NODE_KEY_TYPE, NODE_KEY_PARAMS
+from biquad import BiquadCascade, design_biquad, sosfilt
+
+
+class CrossoverFilterBank:
+    """
+    Linkwitz-Riley (4th order, 24 dB/octave) crossover tree.
+    The signal is split at every crossover frequency into the band below it
+    and the rest above it. Low and high outputs of an LR4 crossover sum to
+    an allpass, so every band is compensated by the allpasses of the crossovers
+    above it and the sum of all bands is the input with a flat magnitude response
+    (phase-coherent reconstruction).
+    """
+    def __init__(self, frequencies, rate, channels):
+        """
+        Init filter bank
+        :param frequencies: ascending crossover frequencies in Hz
+        :param rate: sample rate
+        :param channels: number of channels
+        """
+        self.frequencies = list(frequencies)
+        if self.frequencies != sorted(self.frequencies) or \
+           any(not 0 < f < 0.5 * rate for f in self.frequencies):
+            raise ValueError("Crossover frequencies must be ascending and below {} Hz".format(0.5 * rate))
+        # LR4: two cascaded Butterworth sections
+        self.lowpass = [BiquadCascade([design_biquad('lowpass', f, rate)] * 2, channels)
+                        for f in self.frequencies]
+        self.highpass = [BiquadCascade([design_biquad('highpass', f, rate)] * 2, channels)
+                         for f in self.frequencies]
+        self.allpass = [[BiquadCascade([design_biquad('allpass', f, rate)], channels)
+                         for f in self.frequencies[k + 1:]]
+                        for k in range(self.band_count)]
+
+    @property
+    def band_count(self):
+        return len(self.frequencies) + 1
+
+    def split(self, block, bands):
+        """
+        Split a block
+        :param block: (frames x channels) input
+        :param bands: (bands x frames x channels) output, not compensated yet
+        """
+        rest = block
+        for k in range(len(self.frequencies)):
+            bands[k] = self.lowpass[k].process(rest)
+            rest = self.highpass[k].process(rest)
+        bands[-1] = rest
+
+    def compensate(self, k, band):
+        """
+        Align the phase of band `k` with the bands above it in place
+        """
+        for allpass in self.allpass[k]:
+            band[:] = allpass.process(band)
+
+
+# pools shared by all multiband nodes, keyed by number of workers
+_pools = {}
+
+
+def band_pool(workers):
+    """
+    :return: persistent ThreadPool with `workers` threads
+    """
+    pool = _pools.get(workers)
+    if pool is None:
+        pool = _pools[workers] = ThreadPool(workers)
+    return pool
+
+
+class Multiband(Processor):
+    """
+    Processing graph node for multi-band dynamics and EQ.
+    The block is split by a Linkwitz-Riley crossover, a chain of processors
+    per band runs concurrently on a persistent thread pool (NumPy and SciPy
+    release the GIL in heavy calls) and the bands are summed back.
+    Without SciPy the bands run one after another in the calling thread:
+    the filter fallback makes many small NumPy calls holding the GIL,
+    so threads would only add switching overhead.
+    {"type": "multiband", "params": {"frequencies": [200, 2000],
+     "bands": [{"type": "gain", "params": {"gain": 0.5}}, null, [<processors>]], "workers": 0}}
+    """
+    formats = ('float32',)
+
+    def __init__(self, frequencies, bands=None, workers=0):
+        """
+        :param frequencies: crossover frequencies in Hz
+        :param bands: per band a processor description, a list of them or None (unprocessed)
+        :param workers: pool threads (0 - one per band, ignored without SciPy)
+        """
+        self.frequencies = sorted(frequencies)
+        band_count = len(self.frequencies) + 1
+        bands = bands or [None] * band_count
+        if len(bands) != band_count:
+            raise ValueError("{} crossover frequencies split into {} bands, {} given".format(
+                len(self.frequencies), band_count, len(bands)))
+        self.chains = []
+        for spec in bands:
+            specs = [] if spec is None else spec if isinstance(spec, list) else [spec]
+            self.chains.append([create_processor(s[NODE_KEY_TYPE], s.get(NODE_KEY_PARAMS, {})) for s in specs])
+        self.workers = workers or band_count
+        self.filter_bank = None
+
+    def prepare(self, frame_size, channels, rate, dtype):
+        for chain in self.chains:
+            for processor in chain:
+                if not processor.in_place or processor.input_count != 1:
+                    raise ValueError("Band processors must work in place on one input")
+                if processor.channels is not None and processor.channels != channels:
+                    raise ValueError("Band processor requires {} channels".format(processor.channels))
+                processor.prepare(frame_size, channels, rate, dtype)
+        self.filter_bank = CrossoverFilterBank(self.frequencies, rate, channels)
+        self.bands = np.zeros((len(self.chains), frame_size, channels), dtype=np.float32)
+        self.pool = band_pool(self.workers) if sosfilt is not None else None
+        self.__frames = 0
+
+    def __process_band(self, k):
+        band = self.bands[k, :self.__frames]
+        self.filter_bank.compensate(k, band)
+        for processor in self.chains[k]:
+            processor.process(band)
+
+    def process(self, block):
+        frames = len(block)
+        if frames > self.bands.shape[1]:
+            self.bands = np.zeros((len(self.chains), frames, block.shape[1]), dtype=np.float32)
+        self.__frames = frames
+        bands = self.bands[:, :frames]
+        self.filter_bank.split(block, bands)
+        if self.pool is not None:
+            self.pool.map(self.__process_band, range(len(self.chains)))
+        else:
+            for k in range(len(self.chains)):
+                self.__process_band(k)
+        np.sum(bands, axis=0, out=block)
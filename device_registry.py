@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Ilya Shoshin (Galarius)'
+
+import os
+import json
+import pyaudio
+
+# rates probed for every device during enumeration
+STANDARD_RATES = [8000, 11025, 16000, 22050, 32000, 44100, 48000, 88200, 96000, 176400, 192000]
+
+DEVICE_KEY_INDEX           = 'index'
+DEVICE_KEY_NAME            = 'name'
+DEVICE_KEY_HOST_API        = 'host_api'
+DEVICE_KEY_INPUT_CHANNELS  = 'max_input_channels'
+DEVICE_KEY_OUTPUT_CHANNELS = 'max_output_channels'
+DEVICE_KEY_DEFAULT_RATE    = 'default_sample_rate'
+DEVICE_KEY_RATES           = 'supported_rates'
+
+
+class DeviceRegistry:
+    """
+    Audio devices enumerated once and indexed by name.
+    All sessions share a single PortAudio instance; the enumeration
+    may be persisted to a cache file so that startup doesn't have to
+    query the host audio system. Cached indices are checked against
+    PortAudio before a stream is opened, call `invalidate` when devices change.
+    """
+    def __init__(self, cache_file=''):
+        """
+        Init registry
+        :param cache_file: JSON file to persist the enumeration ('' - disabled)
+        """
+        self.cache_file = cache_file
+        self.__p_audio = None
+        self.__devices = None
+        self.__by_name = {}
+        self.__from_cache = False
+        self.enumeration_count = 0
+
+    @property
+    def p_audio(self):
+        """
+        Shared PyAudio instance (created on first use)
+        """
+        if self.__p_audio is None:
+            self.__p_audio = pyaudio.PyAudio()
+        return self.__p_audio
+
+    def devices(self):
+        """
+        :return: list of device dictionaries in PortAudio order
+        """
+        if self.__devices is None:
+            devices = self.__load_cache()
+            self.__from_cache = devices is not None
+            if devices is None:
+                devices = self.__enumerate()
+                self.__save_cache(devices)
+            self.__devices = devices
+            self.__by_name = {}
+            for device in devices:
+                # the first of equally named devices wins, as in a linear scan
+                self.__by_name.setdefault(device[DEVICE_KEY_NAME], device)
+        return self.__devices
+
+    def __enumerate(self):
+        p_audio = self.p_audio
+        self.enumeration_count += 1
+        devices = []
+        for i in range(p_audio.get_device_count()):
+            info = p_audio.get_device_info_by_index(i)
+            device = {DEVICE_KEY_INDEX: info['index'],
+                      DEVICE_KEY_NAME: info['name'],
+                      DEVICE_KEY_HOST_API: p_audio.get_host_api_info_by_index(info['hostApi'])['name'],
+                      DEVICE_KEY_INPUT_CHANNELS: info['maxInputChannels'],
+                      DEVICE_KEY_OUTPUT_CHANNELS: info['maxOutputChannels'],
+                      DEVICE_KEY_DEFAULT_RATE: info['defaultSampleRate']}
+            device[DEVICE_KEY_RATES] = self.__probe_rates(p_audio, device)
+            devices.append(device)
+        return devices
+
+    @staticmethod
+    def __probe_rates(p_audio, device):
+        rates = []
+        for rate in STANDARD_RATES:
+            kwargs = {'rate': rate}
+            if device[DEVICE_KEY_INPUT_CHANNELS]:
+                kwargs.update(input_device=device[DEVICE_KEY_INDEX], input_channels=1,
+                              input_format=pyaudio.paInt16)
+            elif device[DEVICE_KEY_OUTPUT_CHANNELS]:
+                kwargs.update(output_device=device[DEVICE_KEY_INDEX], output_channels=1,
+                              output_format=pyaudio.paInt16)
+            else:
+                break
+            try:
+                if p_audio.is_format_supported(**kwargs):
+                    rates.append(rate)
+            except ValueError:
+                pass
+        return rates
+
+    def __load_cache(self):
+        if not self.cache_file or not os.path.isfile(self.cache_file):
+            return None
+        try:
+            with open(self.cache_file, 'r') as in_file:
+                return json.load(in_file)
+        except ValueError:
+            # corrupted cache, enumerate again
+            return None
+
+    def __save_cache(self, devices):
+        if not self.cache_file:
+            return
+        tmp_filename = self.cache_file + '.tmp'
+        with open(tmp_filename, 'w') as out_file:
+            json.dump(devices, out_file, indent=4, sort_keys=True)
+        os.rename(tmp_filename, self.cache_file)
+
+    def device(self, name):
+        """
+        :return: device dictionary or None
+        """
+        self.devices()
+        return self.__by_name.get(name)
+
+    def find(self, name):
+        """
+        Detect audio device index.
+        Once PortAudio is running, a cached index is checked and
+        the devices are enumerated again if it doesn't match.
+        :param name: device name
+        :return: device index or -1
+        """
+        device = self.device(name)
+        if self.__from_cache and self.__p_audio is not None and not self.__is_current(device, name):
+            # the running instance is current, enumerate it
+            self.invalidate()
+            device = self.device(name)
+        return device[DEVICE_KEY_INDEX] if device else -1
+
+    def __is_current(self, device, name):
+        if device is None:
+            return False
+        try:
+            info = self.__p_audio.get_device_info_by_index(device[DEVICE_KEY_INDEX])
+        except IOError:
+            return False
+        return info['name'] == name
+
+    def names(self):
+        """
+        :return: device names in PortAudio order
+        """
+        return [device[DEVICE_KEY_NAME] for device in self.devices()]
+
+    def invalidate(self, restart=False):
+        """
+        Forget the enumeration (and its cache file), e.g. after devices were plugged in
+        :param restart: terminate the shared PortAudio instance as well, it only sees
+                        new devices after a restart (no stream may be open)
+        """
+        self.__devices = None
+        self.__by_name = {}
+        self.__from_cache = False
+        if self.cache_file and os.path.isfile(self.cache_file):
+            os.remove(self.cache_file)
+        if restart:
+            self.terminate()
+
+    def terminate(self):
+        """
+        Release the shared PortAudio instance
+        """
+        if self.__p_audio is not None:
+            self.__p_audio.terminate()
+            self.__p_audio = None
+
+
+# registries shared within the process, keyed by cache file
+_registries = {}
+
+
+def shared_registry(cache_file=''):
+    """
+    :param cache_file: JSON file to persist the enumeration ('' - disabled)
+    :return: DeviceRegistry of this process
+    """
+    registry = _registries.get(cache_file)
+    if registry is None:
+        registry = _registries[cache_file] = DeviceRegistry(cache_file)
+    return registry
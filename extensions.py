@@ -19,3 +19,6 @@ def elapsed_timer():
     end = default_timer()
     elapser = lambda: end-start
 
+def is_power2(num):
+    "if a number is a power of two"
+    return num and not num & (num - 1)
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Ilya Shoshin (Galarius)'
+
+import math
+import threading
+import time
+import numpy as np
+from ring_buffer import RingBuffer
+from biquad import BiquadCascade, sosfilt
+
+# meters are updated every 100 ms, the block step of ITU-R BS.1770 gating
+METER_HOP_SECONDS = 0.1
+# BS.1770 windows in hops: momentary 400 ms, short-term 3 s
+MOMENTARY_HOPS = 4
+SHORT_TERM_HOPS = 30
+# integrated loudness gates
+ABSOLUTE_GATE_LUFS = -70.0
+RELATIVE_GATE_LU = -10.0
+# gating blocks above the absolute gate are kept in a fixed histogram (as libebur128 does)
+# of 0.1 LU bins, louder blocks share the last bin
+HISTOGRAM_STEP_LU = 0.1
+HISTOGRAM_BINS = 1000
+# time constant of the spectrum average
+SPECTRUM_AVERAGE_SECONDS = 1.0
+SPECTRUM_MIN_FREQUENCY = 20.0
+# reported instead of -inf (silence), JSON has no infinity
+MIN_DB = -120.0
+
+# analog prototype of the BS.1770 K-weighting (shelving and RLB high-pass),
+# the 48 kHz coefficients of the standard are reproduced at any rate
+K_SHELF_FREQUENCY = 1681.974450955533
+K_SHELF_GAIN_DB = 3.999843853973347
+K_SHELF_Q = 0.7071752369554196
+K_SHELF_BAND_EXPONENT = 0.4996667741545416
+K_HIGHPASS_FREQUENCY = 38.13547087602444
+K_HIGHPASS_Q = 0.5003270373238773
+
+
+def k_weighting_sections(rate):
+    """
+    :param rate: sample rate
+    :return: (2 x 6) second-order sections of the K-weighting filter
+    """
+    k = math.tan(math.pi * K_SHELF_FREQUENCY / rate)
+    vh = 10 ** (K_SHELF_GAIN_DB / 20.0)
+    vb = vh ** K_SHELF_BAND_EXPONENT
+    a0 = 1 + k / K_SHELF_Q + k * k
+    shelf = [(vh + vb * k / K_SHELF_Q + k * k) / a0, 2 * (k * k - vh) / a0, (vh - vb * k / K_SHELF_Q + k * k) / a0,
+             1.0, 2 * (k * k - 1) / a0, (1 - k / K_SHELF_Q + k * k) / a0]
+    k = math.tan(math.pi * K_HIGHPASS_FREQUENCY / rate)
+    a0 = 1 + k / K_HIGHPASS_Q + k * k
+    highpass = [1.0, -2.0, 1.0, 1.0, 2 * (k * k - 1) / a0, (1 - k / K_HIGHPASS_Q + k * k) / a0]
+    return [shelf, highpass]
+
+
+def to_db(power):
+    """
+    :param power: power (mean square) value or array
+    :return: level in dB, at least MIN_DB
+    """
+    return np.maximum(10.0 * np.log10(np.maximum(power, 1e-30)), MIN_DB)
+
+
+def loudness(power):
+    """
+    :param power: sum of K-weighted channel mean squares
+    :return: loudness in LUFS
+    """
+    return max(-0.691 + 10.0 * math.log10(power), MIN_DB) if power > 0 else MIN_DB
+
+
+class Meter:
+    """
+    Level, loudness and spectrum meters computed off the audio thread.
+    The callback only copies each processed block into a lock-free
+    single-producer/single-consumer snapshot buffer (blocks that don't fit
+    are dropped and counted). An analyzer thread consumes it in 100 ms hops
+    and publishes a new dictionary of readings per hop:
+    peak and RMS per channel, momentary, short-term and gated integrated
+    loudness (BS.1770, every channel weighted 1) and an exponentially
+    averaged power spectrum of the channel mix in log-spaced bands.
+    Loudness requires SciPy: the K-weighting fallback makes many small
+    NumPy calls holding the GIL, which would take time from the audio
+    callback. Without SciPy loudness readings are None.
+    """
+    def __init__(self, channels, rate, fft_size=2048, spectrum_bands=32):
+        """
+        Init meter
+        :param channels: number of channels
+        :param rate: sample rate
+        :param fft_size: spectrum frame size
+        :param spectrum_bands: number of log-spaced spectrum bands
+        """
+        self.channels = channels
+        self.rate = rate
+        self.hop = int(METER_HOP_SECONDS * rate)
+        self.fft_size = fft_size
+        self.snapshots = RingBuffer(max(rate, 4 * fft_size), channels, np.float32)
+        self.dropped_frames = 0
+        self.k_weighting = BiquadCascade(k_weighting_sections(rate), channels) if sosfilt is not None else None
+        self.window = np.hanning(fft_size)
+        # bins hold mean square, a band reads the power of the tones in it like `rms_db`
+        self.spectrum_scale = 2.0 / (fft_size * np.square(self.window).sum())
+        self.spectrum_alpha = 1.0 - math.exp(-METER_HOP_SECONDS / SPECTRUM_AVERAGE_SECONDS)
+        self.__prepare_bands(spectrum_bands)
+        self.__block = np.zeros((self.hop, channels), dtype=np.float32)
+        self.__history = np.zeros(fft_size)
+        self.__spectrum = None
+        self.__hop_powers = []
+        # count and power sum of the gating blocks per loudness bin
+        self.__gating_counts = np.zeros(HISTOGRAM_BINS, dtype=np.int64)
+        self.__gating_powers = np.zeros(HISTOGRAM_BINS)
+        self.__max_peak = np.zeros(channels)
+        self.analyzed_frames = 0
+        self.readings = {}
+        self.__running = False
+        self.__thread = None
+
+    @staticmethod
+    def from_settings(channels, rate, settings):
+        """
+        :param settings: AudioSettings with the `meter_*` fields
+        """
+        return Meter(channels, rate, settings.meter_fft_size, settings.meter_spectrum_bands)
+
+    def __prepare_bands(self, band_count):
+        nyquist = 0.5 * self.rate
+        edges = np.logspace(math.log10(SPECTRUM_MIN_FREQUENCY), math.log10(nyquist), band_count + 1)
+        bin_width = float(self.rate) / self.fft_size
+        lo = np.clip(np.round(edges[:-1] / bin_width).astype(int), 1, self.fft_size // 2)
+        hi = np.clip(np.round(edges[1:] / bin_width).astype(int), 1, self.fft_size // 2 + 1)
+        # narrow low bands take at least one bin
+        self.band_lo = lo
+        self.band_hi = np.maximum(hi, lo + 1)
+        self.band_frequencies = np.sqrt(edges[:-1] * edges[1:])
+
+    def start(self):
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__run, name='Meter')
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        self.__running = False
+        if self.__thread:
+            self.__thread.join()
+            self.__thread = None
+
+    def publish(self, frames):
+        """
+        Copy a processed block for analysis (audio callback, never blocks)
+        :param frames: (frames x channels) float32 array
+        """
+        if self.snapshots.free() < len(frames):
+            self.dropped_frames += len(frames)
+            return
+        self.snapshots.write(frames)
+
+    def __run(self):
+        while self.__running:
+            while self.snapshots.available() >= self.hop:
+                self.snapshots.read(self.__block)
+                self.__analyze(self.__block)
+            time.sleep(0.5 * METER_HOP_SECONDS)
+
+    def __analyze(self, block):
+        squares = np.square(block, dtype=np.float64)
+        mean_square = squares.mean(axis=0)
+        peak = np.abs(block).max(axis=0)
+        np.maximum(self.__max_peak, peak, out=self.__max_peak)
+        # loudness
+        momentary = short_term = integrated = None
+        if self.k_weighting is not None:
+            weighted = self.k_weighting.process(block)
+            self.__hop_powers.append(float(np.square(weighted).mean(axis=0).sum()))
+            del self.__hop_powers[:-SHORT_TERM_HOPS]
+            momentary_power = np.mean(self.__hop_powers[-MOMENTARY_HOPS:])
+            if len(self.__hop_powers) >= MOMENTARY_HOPS:
+                # 400 ms gating blocks overlapping by 75%
+                self.__add_gating_block(momentary_power)
+            momentary = loudness(momentary_power)
+            short_term = loudness(np.mean(self.__hop_powers))
+            integrated = self.integrated_loudness()
+        # spectrum of the latest fft_size frames
+        mono = block.mean(axis=1)
+        history = self.__history
+        if len(mono) >= len(history):
+            history[:] = mono[-len(history):]
+        else:
+            history[:-len(mono)] = history[len(mono):]
+            history[-len(mono):] = mono
+        power = np.square(np.abs(np.fft.rfft(history * self.window))) * self.spectrum_scale
+        if self.__spectrum is None:
+            self.__spectrum = power
+        else:
+            self.__spectrum += self.spectrum_alpha * (power - self.__spectrum)
+        cumulative = np.concatenate(([0.0], np.cumsum(self.__spectrum)))
+        bands = cumulative[self.band_hi] - cumulative[self.band_lo]
+        self.analyzed_frames += len(block)
+        # replaced as a whole, readers never see a partial update
+        self.readings = {'peak_db': to_db(np.square(peak)).tolist(),
+                         'max_peak_db': to_db(np.square(self.__max_peak)).tolist(),
+                         'rms_db': to_db(mean_square).tolist(),
+                         'momentary_lufs': momentary,
+                         'short_term_lufs': short_term,
+                         'integrated_lufs': integrated,
+                         'spectrum': {'frequencies': self.band_frequencies.tolist(),
+                                      'db': to_db(bands).tolist()},
+                         'analyzed_seconds': float(self.analyzed_frames) / self.rate,
+                         'dropped_frames': self.dropped_frames}
+
+    def __add_gating_block(self, power):
+        level = loudness(power)
+        if level <= ABSOLUTE_GATE_LUFS:
+            return
+        index = min(int((level - ABSOLUTE_GATE_LUFS) / HISTOGRAM_STEP_LU), HISTOGRAM_BINS - 1)
+        self.__gating_counts[index] += 1
+        self.__gating_powers[index] += power
+
+    def integrated_loudness(self):
+        """
+        Gated loudness of the whole stream, the relative gate is resolved
+        to the histogram bin (0.1 LU); constant time at any stream length
+        :return: loudness in LUFS
+        """
+        count = self.__gating_counts.sum()
+        if not count:
+            return MIN_DB
+        relative_gate = loudness(self.__gating_powers.sum() / count) + RELATIVE_GATE_LU
+        start = max(int(math.ceil((relative_gate - ABSOLUTE_GATE_LUFS) / HISTOGRAM_STEP_LU)), 0)
+        count = self.__gating_counts[start:].sum()
+        return loudness(self.__gating_powers[start:].sum() / count) if count else MIN_DB
+
+    def print_stat(self):
+        readings = self.readings
+        if not readings:
+            print "Meter: no audio analyzed"
+            return
+        integrated = readings['integrated_lufs']
+        print "Meter: max peak {} dBFS, integrated {}, {:0.1f} s analyzed, {} dropped frames".format(
+            ', '.join('{:0.1f}'.format(db) for db in readings['max_peak_db']),
+            'n/a (requires SciPy)' if integrated is None else '{:0.1f} LUFS'.format(integrated),
+            readings['analyzed_seconds'], readings['dropped_frames'])
@@ -0,0 +1,573 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Ilya Shoshin (Galarius)'
+
+import errno
+import socket
+import struct
+import threading
+import time
+from timeit import default_timer
+import numpy as np
+import audio_helper as ah
+from ring_buffer import RingBuffer
+
+PROTOCOL_UDP = 'udp'
+PROTOCOL_TCP = 'tcp'
+
+# magic, version, PyAudio sample format, channels, frames, rate, sequence number,
+# stream position of the first frame
+PACKET_HEADER = struct.Struct('<2sBBHHIIQ')
+PACKET_MAGIC = b'PS'
+PACKET_VERSION = 1
+# largest UDP payload over IPv4
+MAX_DATAGRAM_SIZE = 65507
+# datagrams drained from the socket per wake-up
+RECEIVE_BATCH = 16
+# seconds a blocking socket call waits before checking for shutdown
+SOCKET_TIMEOUT = 0.1
+# seconds a send may block before the packet is given up (a stalled TCP receiver)
+SEND_TIMEOUT = 1.0
+
+
+def parse_address(address, default_host=''):
+    """
+    :param address: 'host:port' or 'port'
+    :return: (host, port)
+    """
+    host, _, port = str(address).rpartition(':')
+    return host or default_host, int(port)
+
+
+class JitterBuffer:
+    """
+    Adaptive playout buffer of a network stream.
+    Packets are placed by their stream position, so reordered packets
+    are put back in order and missing frames are played as silence
+    (counted as lost). Playback starts once `target` frames are buffered;
+    the target follows the interarrival jitter (RFC 3550 estimate) between
+    `min_latency` and `max_latency`, and frames buffered beyond it are
+    skipped to bring the latency back down. After an underrun the buffer
+    is primed again. The audio callback never waits for the network thread:
+    a block read while a packet is being stored is played as silence.
+    """
+    def __init__(self, channels, rate, min_latency, max_latency):
+        """
+        Init jitter buffer
+        :param channels: number of channels
+        :param rate: sample rate
+        :param min_latency: lowest target latency in frames
+        :param max_latency: highest target latency in frames
+        """
+        self.channels = channels
+        self.rate = rate
+        self.min_latency = min_latency
+        self.max_latency = max(max_latency, min_latency)
+        self.capacity = 2 * self.max_latency + rate
+        self.buffer = np.zeros((self.capacity, channels), dtype=np.float32)
+        self.valid = np.zeros(self.capacity, dtype=bool)
+        self.lock = threading.Lock()
+        self.target = min_latency
+        # interarrival jitter in seconds
+        self.jitter = 0.0
+        self.read_position = None
+        self.end_position = 0
+        self.priming = True
+        self.__transit = None
+        self.__packet_frames = 0
+        self.packets = 0
+        self.late_packets = 0
+        self.lost_frames = 0
+        self.skipped_frames = 0
+        self.underruns = 0
+        self.resyncs = 0
+        self.busy_reads = 0
+        self.latency_sum = 0.0
+        self.latency_count = 0
+        self.max_buffered = 0
+
+    def __slices(self, position, count):
+        """
+        :return: ring slices holding `count` frames from `position` and their offsets
+        """
+        start = position % self.capacity
+        first = min(count, self.capacity - start)
+        return [(slice(start, start + first), 0), (slice(0, count - first), first)]
+
+    def __update_target(self, position, frames, arrival_time):
+        transit = arrival_time - float(position) / self.rate
+        if self.__transit is not None:
+            self.jitter += (abs(transit - self.__transit) - self.jitter) / 16.0
+        self.__transit = transit
+        self.__packet_frames = max(self.__packet_frames, frames)
+        target = self.__packet_frames + int(4 * self.jitter * self.rate)
+        self.target = min(max(target, self.min_latency), self.max_latency)
+
+    def write(self, position, frames, arrival_time):
+        """
+        Store received frames (network thread)
+        :param position: stream position of the first frame
+        :param frames: (frames x channels) float32 array
+        :param arrival_time: receive time in seconds
+        """
+        count = len(frames)
+        with self.lock:
+            self.packets += 1
+            self.__update_target(position, count, arrival_time)
+            if self.read_position is None:
+                self.read_position = position
+            end = position + count
+            if end <= self.read_position:
+                self.late_packets += 1
+                return
+            if end - self.read_position > self.capacity:
+                # sender restarted or was far ahead, start over
+                self.resyncs += 1
+                self.valid[:] = False
+                self.read_position = max(position, end - self.target)
+                self.end_position = self.read_position
+                self.priming = True
+            skip = max(self.read_position - position, 0)
+            for ring, offset in self.__slices(position + skip, count - skip):
+                self.buffer[ring] = frames[skip + offset:skip + offset + ring.stop - ring.start]
+                self.valid[ring] = True
+            self.end_position = max(self.end_position, end)
+
+    def read(self, out):
+        """
+        Fill a block for playback (audio callback)
+        :param out: (frames x channels) float32 array
+        :return: number of received frames in the block
+        """
+        if not self.lock.acquire(False):
+            # the playout position stays, the extra latency is skipped later
+            out[:] = 0
+            self.busy_reads += 1
+            return 0
+        try:
+            return self.__read(out)
+        finally:
+            self.lock.release()
+
+    def __read(self, out):
+        count = len(out)
+        buffered = self.end_position - self.read_position if self.read_position is not None else 0
+        if self.priming:
+            if buffered < self.target:
+                out[:] = 0
+                return 0
+            self.priming = False
+        if buffered > self.target + count:
+            # latency grew above the target, drop the oldest frames
+            skip = buffered - self.target
+            for ring, _ in self.__slices(self.read_position, skip):
+                self.valid[ring] = False
+            self.read_position += skip
+            self.skipped_frames += skip
+            buffered -= skip
+        self.latency_sum += buffered
+        self.latency_count += 1
+        self.max_buffered = max(self.max_buffered, buffered)
+        received = 0
+        for ring, offset in self.__slices(self.read_position, count):
+            block = out[offset:offset + ring.stop - ring.start]
+            valid = self.valid[ring]
+            block[:] = self.buffer[ring]
+            block[~valid] = 0
+            received += int(np.count_nonzero(valid))
+            self.valid[ring] = False
+        # frames past the newest packet are an underrun, gaps before it are lost
+        self.lost_frames += min(count, buffered) - received
+        self.read_position += count
+        if self.read_position >= self.end_position:
+            self.underruns += 1
+            self.priming = True
+            self.end_position = self.read_position
+        return received
+
+    def stats(self):
+        with self.lock:
+            return {'target_ms': 1000.0 * self.target / self.rate,
+                    'mean_latency_ms': 1000.0 * self.latency_sum / self.latency_count / self.rate
+                                       if self.latency_count else 0.0,
+                    'max_latency_ms': 1000.0 * self.max_buffered / self.rate,
+                    'jitter_ms': 1000.0 * self.jitter,
+                    'packets': self.packets,
+                    'late_packets': self.late_packets,
+                    'lost_frames': self.lost_frames,
+                    'skipped_frames': self.skipped_frames,
+                    'underruns': self.underruns,
+                    'resyncs': self.resyncs,
+                    'busy_reads': self.busy_reads}
+
+
+class NetworkSink:
+    """
+    Sends a stream to a NetworkSource over UDP or TCP.
+    The audio callback only queues blocks; a sender thread cuts the queue
+    into packets of `packet_frames` (one header each, samples in the stream
+    format) and sends everything queued per wake-up. TCP connections are
+    re-established when they drop.
+    """
+    def __init__(self, address, channels, rate, dtype, protocol=PROTOCOL_UDP,
+                 packet_frames=1024, queue_frames=65536):
+        """
+        Init sink
+        :param address: 'host:port' of the receiver
+        :param channels: number of channels
+        :param rate: sample rate
+        :param dtype: sample format of the queued data
+        :param protocol: 'udp' or 'tcp'
+        :param packet_frames: frames per packet
+        :param queue_frames: capacity of the send queue
+        """
+        self.address = parse_address(address, 'localhost')
+        self.protocol = protocol
+        self.channels = channels
+        self.rate = rate
+        self.dtype = np.dtype(dtype)
+        self.format = ah.numpy_to_py_audio_format(self.dtype)
+        block_align = channels * self.dtype.itemsize
+        if protocol == PROTOCOL_UDP:
+            packet_frames = min(packet_frames, (MAX_DATAGRAM_SIZE - PACKET_HEADER.size) // block_align)
+        self.packet_frames = min(packet_frames, 0xFFFF)
+        self.packet = bytearray(PACKET_HEADER.size + self.packet_frames * block_align)
+        self.packet_view = memoryview(self.packet)
+        self.packet_frames_view = np.frombuffer(self.packet, dtype=self.dtype,
+                                                offset=PACKET_HEADER.size).reshape(-1, channels)
+        self.queue = RingBuffer(max(queue_frames, self.packet_frames), channels, self.dtype)
+        self.poll_interval = 0.25 * self.packet_frames / rate
+        self.sequence = 0
+        self.position = 0
+        self.sent_packets = 0
+        self.sent_bytes = 0
+        self.dropped_blocks = 0
+        self.send_errors = 0
+        self.connections = 0
+        self.socket = None
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__run, name='NetworkSink')
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    @staticmethod
+    def from_settings(address, channels, rate, dtype, settings):
+        """
+        :param settings: AudioSettings with the `network_*` fields
+        """
+        packet_frames = settings.network_packet_frames or settings.frame_size
+        return NetworkSink(address, channels, rate, dtype, settings.network_protocol, packet_frames,
+                           int(settings.network_max_latency_ms * rate / 1000.0) + 8 * packet_frames)
+
+    def write(self, data):
+        """
+        Queue interleaved data (audio callback side)
+        :param data: buffer with interleaved samples
+        """
+        frames = np.frombuffer(data, dtype=self.dtype).reshape(-1, self.channels)
+        if self.queue.free() < len(frames):
+            self.dropped_blocks += 1
+            return
+        self.queue.write(frames)
+
+    def __connect(self):
+        if self.protocol == PROTOCOL_UDP:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.socket.settimeout(SEND_TIMEOUT)
+            self.socket.connect(self.address)
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.settimeout(SOCKET_TIMEOUT)
+            try:
+                sock.connect(self.address)
+            except socket.error:
+                sock.close()
+                raise
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            # socket.timeout is a socket.error, a stalled receiver never blocks `close`
+            sock.settimeout(SEND_TIMEOUT)
+            self.socket = sock
+        self.connections += 1
+
+    def __send_packet(self, frame_count):
+        PACKET_HEADER.pack_into(self.packet, 0, PACKET_MAGIC, PACKET_VERSION, self.format, self.channels,
+                                frame_count, self.rate, self.sequence & 0xFFFFFFFF, self.position)
+        size = PACKET_HEADER.size + frame_count * self.channels * self.dtype.itemsize
+        if self.protocol == PROTOCOL_UDP:
+            self.socket.send(self.packet_view[:size])
+        else:
+            self.socket.sendall(self.packet_view[:size])
+        self.sent_packets += 1
+        self.sent_bytes += size
+
+    def __run(self):
+        while self.__running or self.queue.available():
+            if self.queue.available() < self.packet_frames and self.__running:
+                time.sleep(self.poll_interval)
+                continue
+            # send everything queued
+            while self.queue.available() >= self.packet_frames or \
+                  (not self.__running and self.queue.available()):
+                frame_count = self.queue.read(self.packet_frames_view)
+                try:
+                    if self.socket is None:
+                        self.__connect()
+                    self.__send_packet(frame_count)
+                except socket.error:
+                    # the frames are lost, the receiver sees a gap; a timed out
+                    # TCP packet may be partially sent, the connection is dropped
+                    self.send_errors += 1
+                    if self.protocol == PROTOCOL_TCP and self.socket is not None:
+                        self.socket.close()
+                        self.socket = None
+                    if not self.__running:
+                        # closing: the rest of the queue is given up rather than
+                        # waiting for a failing receiver packet by packet
+                        while self.queue.available():
+                            self.queue.read(self.packet_frames_view)
+                self.sequence += 1
+                self.position += frame_count
+
+    def close(self):
+        """
+        Send the queued frames and close the connection
+        """
+        self.__running = False
+        self.__thread.join()
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+    def stats(self):
+        return {'sent_packets': self.sent_packets,
+                'sent_bytes': self.sent_bytes,
+                'dropped_blocks': self.dropped_blocks,
+                'send_errors': self.send_errors,
+                'connections': self.connections}
+
+    def print_stat(self):
+        print "Network sink: {} {}:{}, {} packets ({:0.1f} MB), {} dropped blocks, {} send errors".format(
+            self.protocol, self.address[0], self.address[1], self.sent_packets,
+            self.sent_bytes / 1048576.0, self.dropped_blocks, self.send_errors)
+
+
+class NetworkSource:
+    """
+    Receives a stream sent by a NetworkSink into a JitterBuffer.
+    A receiver thread drains all pending datagrams per wake-up (UDP) or
+    reads the framed stream of one connection at a time (TCP), checks
+    sequence numbers for loss, reordering and duplicates and converts
+    the samples to float32 once. `read` is called by the audio callback.
+    """
+    def __init__(self, address, channels, rate, protocol=PROTOCOL_UDP,
+                 min_latency_ms=5.0, max_latency_ms=200.0):
+        """
+        Init source
+        :param address: '[host:]port' to listen on
+        :param channels: number of channels of the stream
+        :param rate: sample rate of the stream
+        :param protocol: 'udp' or 'tcp'
+        :param min_latency_ms: lowest jitter buffer latency
+        :param max_latency_ms: highest jitter buffer latency
+        """
+        self.address = parse_address(address)
+        self.protocol = protocol
+        self.channels = channels
+        self.rate = rate
+        self.jitter_buffer = JitterBuffer(channels, rate, int(min_latency_ms * rate / 1000.0),
+                                          int(max_latency_ms * rate / 1000.0))
+        self.converters = {}
+        self.buffers = [bytearray(MAX_DATAGRAM_SIZE) for _ in range(RECEIVE_BATCH)]
+        self.__out = np.zeros((0, channels), dtype=np.float32)
+        self.__signal = np.zeros((0, channels), dtype=np.float32)
+        self.received_packets = 0
+        self.received_bytes = 0
+        self.lost_packets = 0
+        self.reordered_packets = 0
+        self.duplicate_packets = 0
+        self.invalid_packets = 0
+        self.receive_errors = 0
+        self.connections = 0
+        self.__sequence = None
+        if protocol == PROTOCOL_UDP:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        else:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(self.address)
+        if protocol == PROTOCOL_TCP:
+            self.socket.listen(1)
+        self.socket.settimeout(SOCKET_TIMEOUT)
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__run, name='NetworkSource')
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    @staticmethod
+    def from_settings(address, channels, rate, settings):
+        """
+        :param settings: AudioSettings with the `network_*` fields
+        """
+        return NetworkSource(address, channels, rate, settings.network_protocol,
+                             settings.network_min_latency_ms, settings.network_max_latency_ms)
+
+    def read(self, frame_count):
+        """
+        :return: (frames x channels) float32 block (valid until the next call)
+        """
+        if len(self.__out) < frame_count:
+            self.__out = np.zeros((frame_count, self.channels), dtype=np.float32)
+        out = self.__out[:frame_count]
+        self.jitter_buffer.read(out)
+        return out
+
+    def __track_sequence(self, sequence):
+        if self.__sequence is None:
+            self.__sequence = sequence
+            return True
+        # distance modulo 2^32
+        delta = (sequence - self.__sequence) & 0xFFFFFFFF
+        if delta == 0:
+            self.duplicate_packets += 1
+            return False
+        if delta < 0x80000000:
+            self.lost_packets += delta - 1
+            self.__sequence = sequence
+        else:
+            # arrived after a later packet, it was counted as lost
+            self.reordered_packets += 1
+            self.lost_packets -= 1
+        return True
+
+    def __handle_packet(self, buffer, size, arrival_time):
+        if size < PACKET_HEADER.size:
+            self.invalid_packets += 1
+            return
+        magic, version, fmt, channels, frames, rate, sequence, position = \
+            PACKET_HEADER.unpack_from(buffer)
+        converter = self.converters.get(fmt)
+        if converter is None and magic == PACKET_MAGIC:
+            try:
+                converter = self.converters[fmt] = ah.SampleConverter(ah.py_audio_format_to_numpy(fmt))
+            except TypeError:
+                pass
+        if magic != PACKET_MAGIC or version != PACKET_VERSION or converter is None or \
+           channels != self.channels or rate != self.rate or \
+           size < PACKET_HEADER.size + frames * channels * converter.dtype.itemsize:
+            self.invalid_packets += 1
+            return
+        self.received_packets += 1
+        self.received_bytes += size
+        if not self.__track_sequence(sequence):
+            return
+        samples = np.frombuffer(buffer, dtype=converter.dtype, count=frames * channels,
+                                offset=PACKET_HEADER.size).reshape(frames, channels)
+        if len(self.__signal) < frames:
+            self.__signal = np.zeros((frames, channels), dtype=np.float32)
+        signal = self.__signal[:frames]
+        converter.to_float(samples, signal)
+        self.jitter_buffer.write(position, signal, arrival_time)
+
+    def __receive_datagrams(self):
+        try:
+            size = self.socket.recv_into(self.buffers[0])
+        except socket.timeout:
+            return
+        sizes = [size]
+        arrival_time = default_timer()
+        # drain what is already queued without blocking
+        self.socket.setblocking(False)
+        try:
+            while len(sizes) < len(self.buffers):
+                sizes.append(self.socket.recv_into(self.buffers[len(sizes)]))
+        except socket.error as e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                # the datagrams received so far are still handled
+                self.receive_errors += 1
+        finally:
+            self.socket.settimeout(SOCKET_TIMEOUT)
+        for buffer, size in zip(self.buffers, sizes):
+            self.__handle_packet(buffer, size, arrival_time)
+
+    def __receive_exactly(self, connection, view):
+        received = 0
+        while received < len(view):
+            try:
+                count = connection.recv_into(view[received:])
+            except socket.timeout:
+                if not self.__running:
+                    return False
+                continue
+            if not count:
+                return False
+            received += count
+        return True
+
+    def __receive_stream(self):
+        try:
+            connection, _ = self.socket.accept()
+        except socket.timeout:
+            return
+        self.connections += 1
+        connection.settimeout(SOCKET_TIMEOUT)
+        buffer = self.buffers[0]
+        view = memoryview(buffer)
+        try:
+            while self.__running:
+                if not self.__receive_exactly(connection, view[:PACKET_HEADER.size]):
+                    break
+                magic, _, fmt, channels, frames, _, _, _ = PACKET_HEADER.unpack_from(buffer)
+                try:
+                    payload = frames * channels * np.dtype(ah.py_audio_format_to_numpy(fmt)).itemsize
+                except TypeError:
+                    payload = -1
+                if magic != PACKET_MAGIC or not 0 <= payload <= len(buffer) - PACKET_HEADER.size:
+                    # framing is lost, drop the connection
+                    self.invalid_packets += 1
+                    break
+                if not self.__receive_exactly(connection, view[PACKET_HEADER.size:PACKET_HEADER.size + payload]):
+                    break
+                self.__handle_packet(buffer, PACKET_HEADER.size + payload, default_timer())
+        finally:
+            connection.close()
+
+    def __run(self):
+        while self.__running:
+            try:
+                if self.protocol == PROTOCOL_UDP:
+                    self.__receive_datagrams()
+                else:
+                    self.__receive_stream()
+            except socket.error:
+                # e.g. ICMP errors reported to UDP or a reset connection,
+                # the receiver keeps listening
+                self.receive_errors += 1
+                time.sleep(SOCKET_TIMEOUT)
+
+    def close(self):
+        self.__running = False
+        self.__thread.join()
+        self.socket.close()
+
+    def stats(self):
+        stats = self.jitter_buffer.stats()
+        stats.update({'received_packets': self.received_packets,
+                      'received_bytes': self.received_bytes,
+                      'lost_packets': self.lost_packets,
+                      'reordered_packets': self.reordered_packets,
+                      'duplicate_packets': self.duplicate_packets,
+                      'invalid_packets': self.invalid_packets,
+                      'receive_errors': self.receive_errors,
+                      'connections': self.connections})
+        return stats
+
+    def print_stat(self):
+        stats = self.stats()
+        print "Network source: {} {}:{}, {} packets, lost: {}, reordered: {}, late: {}, invalid: {}, errors: {}".format(
+            self.protocol, self.address[0] or '*', self.address[1], stats['received_packets'],
+            stats['lost_packets'], stats['reordered_packets'], stats['late_packets'], stats['invalid_packets'],
+            stats['receive_errors'])
+        print "Jitter buffer: target %0.1f ms, mean %0.1f ms, max %0.1f ms, jitter %0.2f ms, " \
+              "lost frames: %i, skipped frames: %i, underruns: %i, busy reads: %i" % (
+                  stats['target_ms'], stats['mean_latency_ms'], stats['max_latency_ms'], stats['jitter_ms'],
+                  stats['lost_frames'], stats['skipped_frames'], stats['underruns'], stats['busy_reads'])
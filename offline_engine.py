@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Ilya Shoshin (Galarius)'
+
+import audio_helper as ah
+from extensions import elapsed_timer
+
+# frames per block read from the source file
+DEFAULT_BLOCK_SIZE = 65536
+
+
+class OfflineEngine:
+    """
+    Device-free (file) -> [process] -> (file) engine.
+    Audio is read, processed and written in large blocks
+    as fast as the CPU allows, no audio device is opened.
+    """
+    def __init__(self, processing, block_size=DEFAULT_BLOCK_SIZE):
+        """
+        Init engine
+        :param processing: callable with the signature of AudioSession.__processing
+        :param block_size: number of frames to process at once
+        """
+        self.processing = processing
+        self.block_size = block_size
+        self.frames = 0
+        self.rate = 0
+        self.elapsed_time = 0.0
+        self.codec = None
+
+    def __codec(self, channels, dtype):
+        if not self.codec or self.codec.channels != channels or self.codec.dtype != dtype:
+            self.codec = ah.AudioCodec(self.block_size, channels, dtype)
+        return self.codec
+
+    def run(self, file_source, output_wave_file):
+        """
+        Process the whole source file
+        :param file_source: MappedWaveReader
+        :param output_wave_file: wave writer
+        :return: number of processed frames
+        """
+        codec = self.__codec(file_source.getnchannels(), file_source.dtype)
+        self.rate = file_source.getframerate()
+        self.frames = 0
+        with elapsed_timer() as elapsed:
+            while True:
+                frames = file_source.read(self.block_size)
+                if not len(frames):
+                    break
+                signal = self.processing(codec.decode_frames(frames))
+                output_wave_file.writeframes(codec.encode(signal))
+                self.frames += len(frames)
+            self.elapsed_time = elapsed()
+        return self.frames
+
+    def process_frames(self, frames, out):
+        """
+        Process frames already in memory (e.g. a memmap segment)
+        :param frames: (frames x channels) input array
+        :param out: (frames x channels) output array of the same shape,
+                    in the sample format of `frames` or float32
+        """
+        codec = self.__codec(frames.shape[1], frames.dtype)
+        for start in range(0, len(frames), self.block_size):
+            end = min(start + self.block_size, len(frames))
+            signal = self.processing(codec.decode_frames(frames[start:end]))
+            if out.dtype == codec.dtype:
+                codec.encode_frames(signal, out[start:end])
+            else:
+                out[start:end] = signal
+
+    @property
+    def duration(self):
+        """
+        Duration of the processed audio in seconds
+        """
+        return float(self.frames) / self.rate if self.rate else 0.0
+
+    @property
+    def real_time_factor(self):
+        """
+        Processing time divided by audio duration (< 1 is faster than real time)
+        """
+        return self.elapsed_time / self.duration if self.duration else 0.0
+
+    def print_stat(self):
+        print "Processed: %0.1f s of audio in %0.2f s" % (self.duration, self.elapsed_time)
+        if self.real_time_factor:
+            print "Real-time factor: %0.4f (%0.1fx faster than real time)" % (
+                self.real_time_factor, 1.0 / self.real_time_factor)
@@ -0,0 +1,347 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Ilya Shoshin (Galarius)'
+
+import importlib
+from timeit import default_timer
+import numpy as np
+
+GRAPH_INPUT = 'input'
+
+GRAPH_KEY_NODES  = 'nodes'
+GRAPH_KEY_OUTPUT = 'output'
+NODE_KEY_NAME    = 'name'
+NODE_KEY_TYPE    = 'type'
+NODE_KEY_INPUTS  = 'inputs'
+NODE_KEY_PARAMS  = 'params'
+
+
+class Processor:
+    """
+    Base class of processing graph nodes.
+    A processor works in place on a preallocated (frames x channels) buffer
+    shared with its input whenever the graph allows it.
+    Processors that combine or reshape channels set `in_place = False`
+    and implement `process_inputs` instead of `process`.
+    """
+    # required number of input channels (None - any)
+    channels = None
+    # supported sample formats, e.g. ('float32',) (None - any)
+    formats = None
+    # number of inputs (None - any)
+    input_count = 1
+    in_place = True
+
+    def output_channels(self, input_channels):
+        """
+        :param input_channels: channel count of every input
+        :return: number of output channels
+        """
+        return input_channels[0]
+
+    def prepare(self, frame_size, channels, rate, dtype):
+        """
+        Allocate state before streaming
+        :param frame_size: nominal number of frames per block
+        :param channels: number of input channels
+        :param rate: sample rate
+        :param dtype: sample format
+        """
+        pass
+
+    def process(self, block):
+        """
+        Process a (frames x channels) block in place
+        """
+        raise NotImplementedError
+
+    def process_inputs(self, inputs, out):
+        """
+        Combine (frames x channels) input blocks into `out`
+        """
+        raise NotImplementedError
+
+
+class Gain(Processor):
+    """
+    Multiply all channels by `gain`
+    """
+    def __init__(self, gain=1.0):
+        self.gain = gain
+
+    def process(self, block):
+        np.multiply(block, self.gain, out=block, casting='unsafe')
+
+
+class ReverseChannels(Processor):
+    """
+    Reverse channel order (swap left and right for stereo)
+    """
+    def process(self, block):
+        block[:] = block[:, ::-1]
+
+
+class Select(Processor):
+    """
+    Split: pick a subset of channels of the input
+    """
+    in_place = False
+
+    def __init__(self, channels):
+        self.selected = list(channels)
+
+    def output_channels(self, input_channels):
+        if max(self.selected) >= input_channels[0]:
+            raise ValueError("Channel {} is out of range".format(max(self.selected)))
+        return len(self.selected)
+
+    def process_inputs(self, inputs, out):
+        np.take(inputs[0], self.selected, axis=1, out=out)
+
+
+class Mix(Processor):
+    """
+    Merge: sum the inputs, all inputs have the same channel count
+    """
+    in_place = False
+    input_count = None
+
+    def output_channels(self, input_channels):
+        if len(set(input_channels)) != 1:
+            raise ValueError("Mixed inputs must have the same number of channels")
+        return input_channels[0]
+
+    def process_inputs(self, inputs, out):
+        out[:] = inputs[0]
+        for block in inputs[1:]:
+            np.add(out, block, out=out, casting='unsafe')
+
+
+class Concat(Processor):
+    """
+    Merge: stack the channels of the inputs
+    """
+    in_place = False
+    input_count = None
+
+    def output_channels(self, input_channels):
+        return sum(input_channels)
+
+    def process_inputs(self, inputs, out):
+        channel = 0
+        for block in inputs:
+            out[:, channel:channel + block.shape[1]] = block
+            channel += block.shape[1]
+
+
+# processor classes or dotted paths of processors from other modules
+PROCESSOR_TYPES = {
+    'gain': Gain,
+    'reverse_channels': ReverseChannels,
+    'select': Select,
+    'mix': Mix,
+    'concat': Concat,
+    'convolver': 'convolution.Convolver',
+    'stft': 'stft.Stft',
+    'multiband': 'crossover.Multiband',
+    'biquad': 'biquad.Biquad',
+}
+
+
+def register_processor(type_name, processor_class):
+    """
+    Make a processor available in `settings.json` graphs by name
+    """
+    PROCESSOR_TYPES[type_name] = processor_class
+
+
+def create_processor(type_name, params):
+    """
+    :param type_name: registered name or dotted path `module.Class`
+    :param params: keyword arguments of the constructor
+    :return: Processor
+    """
+    processor_class = PROCESSOR_TYPES.get(type_name, type_name)
+    if isinstance(processor_class, basestring):
+        if '.' not in processor_class:
+            raise ValueError("Unknown processor type '{}'".format(type_name))
+        module_name, class_name = processor_class.rsplit('.', 1)
+        processor_class = getattr(importlib.import_module(module_name), class_name)
+    return processor_class(**params)
+
+
+class Node:
+    def __init__(self, name, processor, inputs):
+        self.name = name
+        self.processor = processor
+        self.inputs = inputs
+        self.consumers = 0
+        self.channels = 0
+        self.buffer = None
+        # own buffer or the buffer of the single input
+        self.shares_input = False
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        # stage name reported to the profiler
+        self.stage = 'graph/' + name
+
+
+class ProcessingGraph:
+    """
+    DAG of block processors.
+    Nodes run in topological order on preallocated buffers; a node whose
+    input has no other consumers processes that input's buffer in place,
+    so a chain pays for a single copy of the incoming block.
+    Per-node processing time is recorded.
+    """
+    def __init__(self, nodes, output=None):
+        """
+        Init graph
+        :param nodes: list of (name, processor, input names) in any order
+        :param output: name of the output node (default: last node)
+        """
+        self.nodes = {}
+        for name, processor, inputs in nodes:
+            if name in self.nodes or name == GRAPH_INPUT:
+                raise ValueError("Duplicate node name '{}'".format(name))
+            self.nodes[name] = Node(name, processor, list(inputs))
+        self.output = output or nodes[-1][0]
+        self.order = self.__topological_order()
+        self.frame_size = 0
+        self.dtype = None
+        self.input_node = Node(GRAPH_INPUT, None, [])
+        # profiling.Profiler receiving node timings (None - disabled)
+        self.profiler = None
+
+    @staticmethod
+    def from_config(config):
+        """
+        Build graph from a `settings.json` description:
+        {"nodes": [{"name": ..., "type": ..., "params": {...}, "inputs": [...]}, ...],
+         "output": ...}
+        Nodes without inputs are fed by the previous node (the first one by the input).
+        """
+        nodes = []
+        previous = GRAPH_INPUT
+        for node in config[GRAPH_KEY_NODES]:
+            name = node[NODE_KEY_NAME]
+            processor = create_processor(node[NODE_KEY_TYPE], node.get(NODE_KEY_PARAMS, {}))
+            inputs = node.get(NODE_KEY_INPUTS, [previous])
+            nodes.append((name, processor, inputs))
+            previous = name
+        return ProcessingGraph(nodes, config.get(GRAPH_KEY_OUTPUT))
+
+    def __topological_order(self):
+        order, visiting, done = [], set(), set()
+
+        def visit(name):
+            if name == GRAPH_INPUT or name in done:
+                return
+            if name not in self.nodes:
+                raise ValueError("Unknown node '{}'".format(name))
+            if name in visiting:
+                raise ValueError("Processing graph has a cycle at '{}'".format(name))
+            visiting.add(name)
+            for input_name in self.nodes[name].inputs:
+                visit(input_name)
+            visiting.remove(name)
+            done.add(name)
+            order.append(self.nodes[name])
+
+        visit(self.output)
+        return order
+
+    def __node(self, name):
+        return self.input_node if name == GRAPH_INPUT else self.nodes[name]
+
+    def prepare(self, frame_size, channels, rate, dtype):
+        """
+        Validate requirements, allocate buffers and processor state
+        :param frame_size: maximum number of frames per block
+        :param channels: number of input channels
+        :param rate: sample rate
+        :param dtype: sample format
+        """
+        dtype = np.dtype(dtype)
+        self.frame_size = frame_size
+        self.dtype = dtype
+        self.channels = channels
+        self.rate = rate
+        self.input_node.channels = channels
+        self.input_node.consumers = 0
+        for node in self.order:
+            node.consumers = 0
+        for node in self.order:
+            for input_name in node.inputs:
+                self.__node(input_name).consumers += 1
+
+        for node in self.order:
+            processor = node.processor
+            inputs = [self.__node(name) for name in node.inputs]
+            if processor.input_count is not None and len(inputs) != processor.input_count:
+                raise ValueError("Node '{}' expects {} input(s)".format(node.name, processor.input_count))
+            if processor.formats is not None and dtype.name not in processor.formats:
+                raise TypeError("Node '{}' doesn't support {} samples".format(node.name, dtype.name))
+            if processor.channels is not None and inputs[0].channels != processor.channels:
+                raise ValueError("Node '{}' requires {} channels".format(node.name, processor.channels))
+            node.channels = processor.output_channels([i.channels for i in inputs])
+            processor.prepare(frame_size, inputs[0].channels, rate, dtype)
+        self.__allocate(frame_size)
+
+    def __allocate(self, frame_size):
+        self.frame_size = frame_size
+        self.input_node.buffer = np.zeros((frame_size, self.channels), dtype=self.dtype)
+        for node in self.order:
+            source = self.__node(node.inputs[0])
+            node.shares_input = node.processor.in_place and source.consumers == 1 and \
+                                source.channels == node.channels
+            if node.shares_input:
+                node.buffer = source.buffer
+            else:
+                node.buffer = np.zeros((frame_size, node.channels), dtype=self.dtype)
+
+    def run(self, signal):
+        """
+        Process one block
+        :param signal: (frames x channels) array
+        :return: (frames x channels) view of the output buffer (valid until the next call)
+        """
+        frame_count = len(signal)
+        if frame_count > self.frame_size:
+            self.__allocate(frame_count)
+        self.input_node.buffer[:frame_count] = signal
+        for node in self.order:
+            start = default_timer()
+            out = node.buffer[:frame_count]
+            if node.processor.in_place:
+                if not node.shares_input:
+                    out[:] = self.__node(node.inputs[0]).buffer[:frame_count]
+                node.processor.process(out)
+            else:
+                node.processor.process_inputs(
+                    [self.__node(name).buffer[:frame_count] for name in node.inputs], out)
+            elapsed = default_timer() - start
+            node.count += 1
+            node.total_time += elapsed
+            if elapsed > node.max_time:
+                node.max_time = elapsed
+            if self.profiler:
+                self.profiler.record(node.stage, elapsed)
+        return self.nodes[self.output].buffer[:frame_count]
+
+    def timings(self):
+        """
+        :return: per-node timing statistics
+        """
+        return dict((node.name, {'calls': node.count,
+                                 'mean_ms': 1000.0 * node.total_time / node.count if node.count else 0.0,
+                                 'max_ms': 1000.0 * node.max_time})
+                    for node in self.order)
+
+    def print_stat(self):
+        timings = self.timings()
+        for node in self.order:
+            timing = timings[node.name]
+            print "Node '{}': mean {:0.3f} ms, max {:0.3f} ms ({} calls)".format(
+                node.name, timing['mean_ms'], timing['max_ms'], timing['calls'])
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Ilya Shoshin (Galarius)'
+
+import gc
+import os
+import signal
+import sys
+import thread
+import threading
+import time
+from collections import defaultdict
+from timeit import default_timer
+from callback_stats import CallbackStats
+
+# stage of the garbage collector pauses
+STAGE_GC = 'gc'
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return '{} ({})'.format(code.co_name, os.path.basename(code.co_filename))
+
+
+def collapsed_stack(thread_name, frame):
+    """
+    :return: 'thread;outermost (file);...;innermost (file)', one line of a flamegraph input
+    """
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    labels.append(thread_name)
+    return ';'.join(reversed(labels))
+
+
+class Profiler:
+    """
+    On-demand profiler of a running session, switched on and off at run time.
+    While enabled:
+    - the callback marks the end of every stage (decode, process, encode, write)
+      and processing graph nodes report their time, each stage gets a timing
+      histogram (CallbackStats);
+    - the threads running the processing chain are sampled every
+      `sample_interval` seconds into collapsed stacks for flamegraph tools
+      (`stacks_file`, written when profiling stops);
+    - garbage collector pauses are timed (gc.callbacks, Python 3.3+) and those
+      overlapping a callback are counted. Without gc.callbacks only callbacks
+      during which a collection ran are detected: every collection changes
+      the counts of generations 1 and 2.
+    Disabled, a mark costs one attribute check.
+    """
+    def __init__(self, frame_size, rate, stacks_file='', sample_interval=0.001):
+        """
+        Init profiler
+        :param frame_size: frames per callback
+        :param rate: sample rate
+        :param stacks_file: collapsed stacks output ('' - no sampling)
+        :param sample_interval: seconds between stack samples
+        """
+        self.frame_size = frame_size
+        self.rate = rate
+        self.stacks_file = stacks_file
+        self.sample_interval = sample_interval
+        self.enabled = False
+        self.stages = {}
+        self.stage_order = []
+        self.stacks = defaultdict(int)
+        self.samples = 0
+        self.threads = {}
+        self.gc_pauses = 0
+        self.gc_overlaps = 0
+        self.gc_callbacks = getattr(gc, 'callbacks', None)
+        self.__mark = 0.0
+        self.__in_callback = False
+        self.__gc_counts = None
+        self.__gc_start = 0.0
+        self.__gc_start_in_callback = False
+        self.__sampler = None
+
+    @staticmethod
+    def from_settings(frame_size, rate, settings, stacks_file=None):
+        """
+        :param settings: AudioSettings with the `profiling_*` fields
+        :param stacks_file: overrides `profiling_stacks_file`
+        """
+        profiler = Profiler(frame_size, rate,
+                            settings.profiling_stacks_file if stacks_file is None else stacks_file,
+                            settings.profiling_sample_interval_ms / 1000.0)
+        if settings.profiling:
+            profiler.enable()
+        return profiler
+
+    def enable(self):
+        """
+        Start a new profile
+        """
+        if self.enabled:
+            return
+        self.stages = {}
+        self.stage_order = []
+        self.stacks = defaultdict(int)
+        self.samples = 0
+        self.gc_pauses = 0
+        self.gc_overlaps = 0
+        if self.gc_callbacks is not None:
+            self.gc_callbacks.append(self.__on_gc)
+        self.enabled = True
+        if self.stacks_file and self.sample_interval > 0:
+            self.__sampler = threading.Thread(target=self.__sample, name='ProfilerSampler')
+            self.__sampler.daemon = True
+            self.__sampler.start()
+        print "Profiling started"
+
+    def disable(self):
+        """
+        Stop profiling, the collected profile stays available
+        """
+        if not self.enabled:
+            return
+        self.enabled = False
+        if self.gc_callbacks is not None:
+            self.gc_callbacks.remove(self.__on_gc)
+        if self.__sampler:
+            self.__sampler.join()
+            self.__sampler = None
+            self.write_stacks()
+        print "Profiling stopped"
+        self.print_stat()
+
+    def toggle(self):
+        """
+        :return: new state, used as a control command
+        """
+        if self.enabled:
+            self.disable()
+        else:
+            self.enable()
+        return {'profiling': self.enabled}
+
+    def register_thread(self):
+        """
+        Sample the calling thread (called by the processing chain)
+        """
+        if self.enabled:
+            ident = thread.get_ident()
+            if ident not in self.threads:
+                self.threads[ident] = threading.current_thread().name
+
+    def begin(self):
+        """
+        Callback started
+        """
+        if not self.enabled:
+            return
+        if self.gc_callbacks is None:
+            self.__gc_counts = gc.get_count()[1:]
+        self.__mark = default_timer()
+        # marks and end only count for callbacks that began while enabled
+        self.__in_callback = True
+
+    def mark(self, stage):
+        """
+        A callback stage finished, it took the time since the previous mark
+        """
+        if not self.__in_callback:
+            return
+        now = default_timer()
+        self.record(stage, now - self.__mark)
+        self.__mark = now
+
+    def end(self):
+        """
+        Callback finished
+        """
+        if not self.__in_callback:
+            return
+        self.__in_callback = False
+        if self.enabled and self.gc_callbacks is None and gc.get_count()[1:] != self.__gc_counts:
+            # a collection ran during the callback
+            self.gc_overlaps += 1
+
+    def record(self, stage, elapsed):
+        """
+        Record the time of a stage (any thread)
+        """
+        if not self.enabled:
+            return
+        stats = self.stages.get(stage)
+        if stats is None:
+            stats = self.stages[stage] = CallbackStats(self.frame_size, self.rate)
+            self.stage_order.append(stage)
+        stats.record(elapsed, self.frame_size)
+
+    def __on_gc(self, phase, info):
+        if phase == 'start':
+            self.__gc_start = default_timer()
+            self.__gc_start_in_callback = self.__in_callback
+        else:
+            self.gc_pauses += 1
+            if self.__gc_start_in_callback or self.__in_callback:
+                self.gc_overlaps += 1
+            self.record(STAGE_GC, default_timer() - self.__gc_start)
+
+    def __sample(self):
+        while self.enabled:
+            frames = sys._current_frames()
+            for ident, name in self.threads.items():
+                frame = frames.get(ident)
+                if frame is not None:
+                    self.stacks[collapsed_stack(name, frame)] += 1
+                    self.samples += 1
+            del frames
+            time.sleep(self.sample_interval)
+
+    def write_stacks(self):
+        """
+        Write the sampled stacks in the collapsed format ('frame;frame;frame count'),
+        input of flamegraph.pl, speedscope and similar tools
+        """
+        with open(self.stacks_file, 'w') as out_file:
+            for stack, count in sorted(self.stacks.items()):
+                out_file.write('{} {}\n'.format(stack, count))
+
+    def to_dict(self):
+        stages = {}
+        for stage in self.stage_order:
+            stats = self.stages[stage].to_dict()
+            stages[stage] = dict((key, stats[key]) for key in
+                                 ('callbacks', 'mean_ms', 'p50_ms', 'p99_ms', 'max_ms'))
+        return {'enabled': self.enabled,
+                'stages': stages,
+                'gc_pauses': self.gc_pauses if self.gc_callbacks is not None else None,
+                'gc_overlapping_callbacks': self.gc_overlaps,
+                'stack_samples': self.samples}
+
+    def print_stat(self):
+        for stage in self.stage_order:
+            stats = self.stages[stage].to_dict()
+            print "Stage '{}': mean {:0.3f} ms, p99 {:0.3f} ms, max {:0.3f} ms ({} calls)".format(
+                stage, stats['mean_ms'], stats['p99_ms'], stats['max_ms'], stats['callbacks'])
+        if self.gc_callbacks is not None:
+            print "GC pauses: {}, overlapping callbacks: {}".format(self.gc_pauses, self.gc_overlaps)
+        else:
+            print "Callbacks with a GC collection: {}".format(self.gc_overlaps)
+        if self.samples:
+            print "Stack samples: {} (written to {})".format(self.samples, self.stacks_file)
+
+
+def install_toggle_signal(toggle):
+    """
+    Toggle profiling on SIGUSR1 (`kill -USR1 <pid>`), where available
+    :param toggle: called without arguments in the main thread
+    :return: True if the handler is installed
+    """
+    signal_number = getattr(signal, 'SIGUSR1', None)
+    if signal_number is None:
+        return False
+    signal.signal(signal_number, lambda signum, frame: toggle())
+    return True
@@ -4,52 +4,139 @@
 __author__ = 'Ilya Shoshin (Galarius)'
 
 import sys, getopt
+import traceback
 import numpy as np
-import pyaudio, wave, time
+import pyaudio, time
 import audio_helper as ah
 from audio_settings import StreamMode, AudioSettings
 from extensions import elapsed_timer
+from offline_engine import OfflineEngine
+from threaded_processor import ThreadedProcessor
+from wave_writer import AsyncWaveWriter
+from recording_sink import RecordingSink
+from wave_mmap import MappedWaveReader, open_wave_file
+from batch_processing import BatchProcessor
+from segment_processing import SegmentedProcessor
+from callback_stats import CallbackStats, dump_stats
+from processing_graph import ProcessingGraph
+from resampler import ResamplingReader
+from audio_backend import PyAudioBackend, SimulatedBackend
+from autotune import FrameSizeTuner
+from session_host import SessionHost
+from network_endpoint import NetworkSink, NetworkSource
+from metering import Meter
+from stats_server import StatsServer
+from profiling import Profiler, install_toggle_signal
 
 # Keys
 KEY_INPUT_FILE_NAME  = 'input_key'
 KEY_OUTPUT_FILE_NAME = 'output_key'
-
-def is_power2(num):
-    "if a number is a power of two"
-    return num and not num & (num - 1)
+KEY_NETWORK_ADDRESS  = 'network_address_key'
 
 class AudioSession:
     """
     """
-    def __init__(self, stream_mode, settings, **kwargs):
+    def __init__(self, stream_mode, settings, backend=None, pool=None, stacks_file=None, **kwargs):
         """
         Init session
         :param stream_mode:
+        :param settings: AudioSettings
+        :param backend: AudioBackend (default: PortAudio devices)
+        :param pool: ThreadPool for threaded processing shared with other sessions
+                     (None - own worker thread)
+        :param stacks_file: profiler stacks file (None - `profiling_stacks_file`)
         :param kwargs:
         :return:
         """
-        self.min_elapsed_time = 100.0
-        self.max_elapsed_time = 0.0
         self.stream_mode = stream_mode
         self.settings = settings
+        self.backend = backend or PyAudioBackend(settings.device_registry())
+        self.pool = pool
+        self.error = None
         self.stream = None
+        self.threaded_processor = None
+        self.offline_engine = OfflineEngine(self.__processing, self.settings.offline_block_size)
+        self.processing_graph = None
+        if self.settings.processing_graph:
+            self.processing_graph = ProcessingGraph.from_config(self.settings.processing_graph)
         self.format = self.settings.format
         self.channels = self.settings.channels 
         self.rate = self.settings.rate
+        self.file_rate = 0
         self.__configure_for_stream_mode(**kwargs)
+        self.codec = ah.AudioCodec(self.settings.frame_size, self.channels,
+                                   ah.py_audio_format_to_numpy(self.format))
+        self.callback_stats = CallbackStats(self.settings.frame_size, self.rate)
+        self.meter = Meter.from_settings(self.channels, self.rate, self.settings) if self.settings.metering else None
+        self.stats_server = None
+        self.profiler = Profiler.from_settings(self.settings.frame_size, self.rate, self.settings, stacks_file)
+        if self.processing_graph:
+            self.processing_graph.profiler = self.profiler
+        self.__prepare_processing()
+        self.last_stats_dump = time.time()
 
     def __configure_input_file(self, **kwargs):
         in_file = kwargs[KEY_INPUT_FILE_NAME]
-        self.file_source = wave.open(in_file, 'rb')
-        self.format = pyaudio.get_format_from_width(self.file_source.getsampwidth())
+        self.file_source = MappedWaveReader(in_file)
+        self.file_rate = self.file_source.getframerate()
+        if self.stream_mode == StreamMode.File2File:
+            rate = self.settings.offline_rate
+        else:
+            # devices run at the configured rate
+            rate = self.settings.rate
+        if rate and rate != self.file_rate:
+            self.file_source = ResamplingReader(self.file_source, rate, self.settings.resampler_taps)
+        self.format = self.file_source.getformat()
         self.channels = self.file_source.getnchannels()
         self.rate = self.file_source.getframerate()
 
     def __configure_output_file(self, **kwargs):
-        self.output_wave_file = wave.open(kwargs[KEY_OUTPUT_FILE_NAME], 'wb')
-        self.output_wave_file.setnchannels(self.channels)
-        self.output_wave_file.setsampwidth(pyaudio.get_sample_size(self.format))
-        self.output_wave_file.setframerate(self.rate)
+        self.output_wave_file = open_wave_file(kwargs[KEY_OUTPUT_FILE_NAME], self.channels, self.rate,
+                                               ah.py_audio_format_to_numpy(self.format))
+
+    def __configure_output_writer(self, **kwargs):
+        sink = RecordingSink.from_settings(kwargs[KEY_OUTPUT_FILE_NAME],
+                                           self.channels,
+                                           self.rate,
+                                           ah.py_audio_format_to_numpy(self.format),
+                                           self.settings)
+        self.output_writer = AsyncWaveWriter(sink,
+                                             self.settings.frame_size,
+                                             self.settings.writer_queue_blocks,
+                                             self.settings.writer_batch_blocks,
+                                             self.settings.writer_fsync_interval)
+
+    def __configure_network_sink(self, **kwargs):
+        self.network_sink = NetworkSink.from_settings(kwargs[KEY_NETWORK_ADDRESS],
+                                                      self.channels,
+                                                      self.rate,
+                                                      ah.py_audio_format_to_numpy(self.format),
+                                                      self.settings)
+
+    def __configure_network_source(self, **kwargs):
+        self.network_source = NetworkSource.from_settings(kwargs[KEY_NETWORK_ADDRESS],
+                                                          self.channels,
+                                                          self.rate,
+                                                          self.settings)
+
+    def __prepare_processing(self):
+        """
+        Allocate processing buffers and state for the current stream format,
+        processing always runs on float32 samples
+        """
+        if self.processing_graph:
+            self.processing_graph.prepare(self.settings.frame_size, self.channels, self.rate, np.float32)
+
+    def prepare_for(self, channels, rate):
+        """
+        Prepare the processing chain for a stream of another format
+        (resets the processing state), e.g. by a segment worker
+        :param channels: number of channels
+        :param rate: sample rate
+        """
+        self.channels = channels
+        self.rate = rate
+        self.__prepare_processing()
 
     def __configure_for_stream_mode(self, **kwargs):
         """
@@ -71,162 +158,272 @@ class AudioSession:
             pass
         elif stream_mode == StreamMode.File2File:
             # (file) -> [process] -> (file)
-            self.__configure_input_file(**kwargs)
-            self.__configure_output_file(**kwargs)
+            # without files the session is reused with `process_file`
+            if KEY_INPUT_FILE_NAME in kwargs:
+                self.__configure_input_file(**kwargs)
+                self.__configure_output_file(**kwargs)
         elif stream_mode == StreamMode.BuildInIn2File:
             # (build-in input) -> [process] -> (file)
-            self.__configure_output_file(**kwargs)
+            self.__configure_output_writer(**kwargs)
         elif stream_mode == StreamMode.File2BuildInOut:
             # (file) -> [process] -> (build-in output)
             self.__configure_input_file(**kwargs)
-        elif stream_mode == StreamMode.BuildInIn2File:
+        elif stream_mode == StreamMode.VD2File:
             # (virtual device input) -> [process] -> (file)
-            self.__configure_output_file(**kwargs)
-        elif stream_mode == StreamMode.File2BuildInOut:
+            self.__configure_output_writer(**kwargs)
+        elif stream_mode == StreamMode.File2VD:
             # (file) -> [process] -> (virtual device output)
             self.__configure_input_file(**kwargs)
+        elif stream_mode == StreamMode.BuildInIn2Net:
+            # (build-in input) -> [process] -> (network)
+            self.__configure_network_sink(**kwargs)
+        elif stream_mode == StreamMode.VD2Net:
+            # (virtual device input) -> [process] -> (network)
+            self.__configure_network_sink(**kwargs)
+        elif stream_mode == StreamMode.Net2BuildInOut:
+            # (network) -> [process] -> (build-in output)
+            self.__configure_network_source(**kwargs)
+        elif stream_mode == StreamMode.Net2VD:
+            # (network) -> [process] -> (virtual device output)
+            self.__configure_network_source(**kwargs)
         else:
             print "Unsupported stream mode! [{}]".format(stream_mode)
 
     def __recording_callback(self, in_data, frame_count, time_info, status):
+        try:
+            return self.__stream_callback(in_data, frame_count, time_info, status)
+        except Exception:
+            # only this stream stops, the error is reported on close
+            self.error = traceback.format_exc()
+            return '', pyaudio.paAbort
+
+    def __stream_callback(self, in_data, frame_count, time_info, status):
         stream_mode = self.stream_mode
+        profiler = self.profiler
         with elapsed_timer() as elapsed:
+            profiler.begin()
             if stream_mode == StreamMode.BuildInIn2Out or \
                stream_mode == StreamMode.BuildInIn2VD or \
                stream_mode == StreamMode.VD2BuildInOut:
                 # (build-in input) -> [process] -> (build-in output)
                 # (build-in input) -> [process] -> (virtual device output)
                 # (virtual device input) -> [process] -> (build-in output)
-                signal = ah.audio_decode(in_data, self.settings.channels)
-                signal = self.__processing(signal)
-                processed_data = ah.audio_encode(signal)
-            elif stream_mode == StreamMode.File2File or \
-                 stream_mode == StreamMode.File2BuildInOut or \
+                frames = self.codec.decode(in_data)
+                profiler.mark('decode')
+                processed_data = self.__process_block(frames, frame_count)
+            elif stream_mode == StreamMode.File2BuildInOut or \
                  stream_mode == StreamMode.File2VD:
-                # (file) -> [process] -> (file)
                 # (file) -> [process] -> (build-in output)
-                in_data = self.file_source.readframes(frame_count)
-                if not in_data:
-                    return in_data, pyaudio.paComplete
-                else:
-                    signal = ah.audio_decode(in_data, self.file_source.getnchannels(), np.int16)
-                    signal = self.__processing(signal)
-                    processed_data = ah.audio_encode(signal, np.int16)
-                    if stream_mode == StreamMode.File2File:
-                        self.output_wave_file.writeframes(processed_data)
+                # (file) -> [process] -> (virtual device output)
+                frames = self.codec.decode_frames(self.file_source.read(frame_count))
+                profiler.mark('decode')
+                if not len(frames) and not self.threaded_processor:
+                    return '', pyaudio.paComplete
+                elif not len(frames):
+                    # let the worker flush the queued blocks
+                    self.threaded_processor.finish()
+                    if self.threaded_processor.drained():
+                        return '', pyaudio.paComplete
+                processed_data = self.__process_block(frames, frame_count)
             elif stream_mode == StreamMode.BuildInIn2File or \
                  stream_mode == StreamMode.VD2File:
                 # (build-in input) -> [process] -> (file)
                 # (virtual device input) -> [process] -> (file)
-                signal = ah.audio_decode(in_data, self.settings.channels)
-                signal = self.__processing(signal)
-                processed_data = ah.audio_encode(signal)
-                self.output_wave_file.writeframes(processed_data)
+                frames = self.codec.decode(in_data)
+                profiler.mark('decode')
+                processed_data = self.__process_block(frames, frame_count)
+                self.output_writer.write(processed_data)
+                profiler.mark('write')
+            elif stream_mode == StreamMode.BuildInIn2Net or \
+                 stream_mode == StreamMode.VD2Net:
+                # (build-in input) -> [process] -> (network)
+                # (virtual device input) -> [process] -> (network)
+                frames = self.codec.decode(in_data)
+                profiler.mark('decode')
+                processed_data = self.__process_block(frames, frame_count)
+                self.network_sink.write(processed_data)
+                profiler.mark('write')
+            elif stream_mode == StreamMode.Net2BuildInOut or \
+                 stream_mode == StreamMode.Net2VD:
+                # (network) -> [process] -> (build-in output)
+                # (network) -> [process] -> (virtual device output)
+                # received samples are float32 already
+                frames = self.network_source.read(frame_count)
+                profiler.mark('decode')
+                processed_data = self.__process_block(frames, frame_count)
             else:
                 print "Unsupported stream mode! [{}]".format(stream_mode)
                 processed_data = in_data
-        elapsed = elapsed()        
-        if elapsed < self.min_elapsed_time:
-            self.min_elapsed_time = elapsed
-        if elapsed > self.max_elapsed_time:
-            self.max_elapsed_time = elapsed
+            profiler.end()
+        self.callback_stats.record(elapsed(), frame_count, status)
         #-----------------------------------------------------------------------
         return processed_data, pyaudio.paContinue
 
+    def __process_block(self, frames, frame_count):
+        """
+        Process one block of frames
+        :param frames: (frames x channels) float32 input (empty at the end of a file)
+        :param frame_count: number of frames requested by the stream
+        :return: interleaved processed data
+        """
+        if self.threaded_processor:
+            # only copy into and out of the worker's ring buffers
+            if len(frames):
+                self.threaded_processor.push(frames)
+            signal = self.codec.output_frames(frame_count)
+            self.threaded_processor.pull(signal)
+            self.profiler.mark('process')
+            if self.meter:
+                self.meter.publish(signal)
+                self.profiler.mark('meter')
+            data = self.codec.output_data(frame_count)
+            self.profiler.mark('encode')
+            return data
+        signal = self.__processing(frames)
+        self.profiler.mark('process')
+        if self.meter:
+            # analyzed on the meter thread
+            self.meter.publish(signal)
+            self.profiler.mark('meter')
+        data = self.codec.encode(signal)
+        self.profiler.mark('encode')
+        return data
+
     def __processing(self, signal):
+        # the stacks of threads running the chain are sampled while profiling
+        self.profiler.register_thread()
+        if self.processing_graph:
+            # processing chain configured in `settings.json`
+            return self.processing_graph.run(signal)
         #-----------------------------------------------------------------------
         # Perform processing here
+        # `signal` is a read-only (frames x channels) float32 view in range
+        # [-1, 1) whatever the device or file format is, process all channels
+        # at once with vectorized NumPy calls; the returned (frames x channels)
+        # array is converted to the stream format in a preallocated output buffer.
         #-----------------------------------------------------------------------
-        left, right = signal
         # ...
         #-----------------------------------------------------------------------
-        return right, left
+        # reverse channel order (swap left and right for stereo)
+        return signal[:, ::-1]
 
     def __print_stat(self, input_dev_idx, output_dev_idx):
         src_latency = 1000.0 * self.stream.get_input_latency()
-        buffer_latency = 1000.0 * self.settings.frame_size / self.rate
+        buffer_frames = self.settings.frame_size
+        if self.threaded_processor:
+            buffer_frames += self.threaded_processor.latency_frames
+        buffer_latency = 1000.0 * buffer_frames / self.rate
         dst_latency = 1000.0 * self.stream.get_output_latency()
         total_latency = buffer_latency + dst_latency + src_latency
         print "Input device: {}".format(input_dev_idx+1)
         print "Output device: {}".format(output_dev_idx+1)
         print "Format: {0}, Channels: {1}, Rate: {2}, Frame size: {3}".format(ah.py_audio_format_desc(self.format), \
             self.channels, self.rate, self.settings.frame_size)
+        if self.file_rate and self.file_rate != self.rate:
+            print "File rate: {0} (resampled to {1})".format(self.file_rate, self.rate)
         print "Round-trip latency: %0.1f ms (src: %0.1f ms, buf: %0.1f ms, dst: %0.1f ms)" % (
                 total_latency, src_latency, buffer_latency, dst_latency)
 
     def open_stream(self):
-        self.p_audio = pyaudio.PyAudio()
         stream_mode = self.stream_mode
+        settings = self.settings
         if stream_mode == StreamMode.BuildInIn2Out:
             # (build-in input) -> [process] -> (build-in output)
             print "Opening (build-in input) -> [process] -> (build-in output) stream..."
-            input_dev_idx  = self.settings.detect_build_in_input_device_idx(self.p_audio)
-            output_dev_idx = self.settings.detect_build_in_output_device_idx(self.p_audio)
+            input_dev_idx  = self.backend.device_index(settings.build_in_input_audio_device_name)
+            output_dev_idx = self.backend.device_index(settings.build_in_output_audio_device_name)
             enable_input, enable_output = True, True
         elif stream_mode == StreamMode.BuildInIn2VD:
             # (build-in input) -> [process] -> (virtual device output)
             print "Opening (build-in input) -> [process] -> (virtual device output) stream..."
-            input_dev_idx  = self.settings.detect_build_in_input_device_idx(self.p_audio)
-            output_dev_idx = self.settings.detect_virtual_audio_device_idx(self.p_audio)
+            input_dev_idx  = self.backend.device_index(settings.build_in_input_audio_device_name)
+            output_dev_idx = self.backend.device_index(settings.virtual_audio_device_name)
             enable_input, enable_output = True, True
         elif stream_mode == StreamMode.VD2BuildInOut:
             # (virtual device input) -> [process] -> (build-in output)
             print "Opening (virtual device input) -> [process] -> (build-in output) stream..."
-            input_dev_idx = self.settings.detect_virtual_audio_device_idx(self.p_audio)
-            output_dev_idx = self.settings.detect_build_in_output_device_idx(self.p_audio)
+            input_dev_idx = self.backend.device_index(settings.virtual_audio_device_name)
+            output_dev_idx = self.backend.device_index(settings.build_in_output_audio_device_name)
             enable_input, enable_output = True, True
         elif stream_mode == StreamMode.File2File:
             # (file) -> [process] -> (file)
             print "Opening (file) -> [process] -> (file) stream..."
-            input_dev_idx  = self.settings.detect_build_in_input_device_idx(self.p_audio)
-            output_dev_idx = self.settings.detect_build_in_output_device_idx(self.p_audio)
+            input_dev_idx  = self.backend.device_index(settings.build_in_input_audio_device_name)
+            output_dev_idx = self.backend.device_index(settings.build_in_output_audio_device_name)
             enable_input, enable_output = True, False
         elif stream_mode == StreamMode.BuildInIn2File:
             # (build-in input) -> [process] -> (file)
             print "Opening (build-in input) -> [process] -> (file) stream..."
-            input_dev_idx = self.settings.detect_build_in_input_device_idx(self.p_audio)
-            output_dev_idx = self.settings.detect_build_in_output_device_idx(self.p_audio)
+            input_dev_idx = self.backend.device_index(settings.build_in_input_audio_device_name)
+            output_dev_idx = self.backend.device_index(settings.build_in_output_audio_device_name)
             enable_input, enable_output = True, False
         elif stream_mode == StreamMode.File2BuildInOut:
             # (file) -> [process] -> (build-in output)
             print "Opening (file) -> [process] -> (build-in output) stream..."
-            input_dev_idx  = self.settings.detect_build_in_input_device_idx(self.p_audio)
-            output_dev_idx = self.settings.detect_build_in_output_device_idx(self.p_audio)
+            input_dev_idx  = self.backend.device_index(settings.build_in_input_audio_device_name)
+            output_dev_idx = self.backend.device_index(settings.build_in_output_audio_device_name)
             enable_input, enable_output = False, True
-        elif stream_mode == StreamMode.BuildInIn2File:
+        elif stream_mode == StreamMode.VD2File:
             # (virtual device input) -> [process] -> (file)
             print "Opening (virtual device input) -> [process] -> (file) stream..."
-            input_dev_idx = self.settings.detect_virtual_audio_device_idx(self.p_audio)
-            output_dev_idx = self.settings.detect_build_in_output_device_idx(self.p_audio)
+            input_dev_idx = self.backend.device_index(settings.virtual_audio_device_name)
+            output_dev_idx = self.backend.device_index(settings.build_in_output_audio_device_name)
             enable_input, enable_output = True, False
-        elif stream_mode == StreamMode.File2BuildInOut:
+        elif stream_mode == StreamMode.File2VD:
             # (file) -> [process] -> (virtual device output)
             print "Opening (file) -> [process] -> (virtual device output) stream..."
-            input_dev_idx  = self.settings.detect_build_in_input_device_idx(self.p_audio)
-            output_dev_idx = self.settings.detect_virtual_audio_device_idx(self.p_audio)
+            input_dev_idx  = self.backend.device_index(settings.build_in_input_audio_device_name)
+            output_dev_idx = self.backend.device_index(settings.virtual_audio_device_name)
+            enable_input, enable_output = False, True
+        elif stream_mode == StreamMode.BuildInIn2Net:
+            # (build-in input) -> [process] -> (network)
+            print "Opening (build-in input) -> [process] -> (network) stream..."
+            input_dev_idx = self.backend.device_index(settings.build_in_input_audio_device_name)
+            output_dev_idx = self.backend.device_index(settings.build_in_output_audio_device_name)
+            enable_input, enable_output = True, False
+        elif stream_mode == StreamMode.VD2Net:
+            # (virtual device input) -> [process] -> (network)
+            print "Opening (virtual device input) -> [process] -> (network) stream..."
+            input_dev_idx = self.backend.device_index(settings.virtual_audio_device_name)
+            output_dev_idx = self.backend.device_index(settings.build_in_output_audio_device_name)
+            enable_input, enable_output = True, False
+        elif stream_mode == StreamMode.Net2BuildInOut:
+            # (network) -> [process] -> (build-in output)
+            print "Opening (network) -> [process] -> (build-in output) stream..."
+            input_dev_idx  = self.backend.device_index(settings.build_in_input_audio_device_name)
+            output_dev_idx = self.backend.device_index(settings.build_in_output_audio_device_name)
+            enable_input, enable_output = False, True
+        elif stream_mode == StreamMode.Net2VD:
+            # (network) -> [process] -> (virtual device output)
+            print "Opening (network) -> [process] -> (virtual device output) stream..."
+            input_dev_idx  = self.backend.device_index(settings.build_in_input_audio_device_name)
+            output_dev_idx = self.backend.device_index(settings.virtual_audio_device_name)
             enable_input, enable_output = False, True
         else:
             print "Unsupported stream mode! [{}]".format(stream_mode)
             raise ValueError("Unsupported stream mode! [{}]".format(stream_mode))
         
-        # standard L-R stereo
-        channel_map = (0, 1)
-        try:
-            stream_info = pyaudio.PaMacCoreStreamInfo(
-                flags=pyaudio.PaMacCoreStreamInfo.paMacCorePlayNice,  # default
-                channel_map=channel_map)
-        except AttributeError:
-            print "Sorry, couldn't find PaMacCoreStreamInfo. Make sure that you're running on OS X."
-            sys.exit(-1)
-
-        if self.settings.validate_audio_setup(self.p_audio, self.format, self.channels, self.rate, input_dev_idx):
-            self.stream = self.p_audio.open(format=self.format,
+        if self.backend.is_format_supported(self.format, self.channels, self.rate, input_dev_idx):
+            if self.settings.threaded_processing:
+                self.threaded_processor = ThreadedProcessor(self.__processing,
+                                                            self.settings.frame_size,
+                                                            self.channels, self.rate,
+                                                            np.float32,
+                                                            self.settings.worker_latency_frames,
+                                                            self.pool)
+                self.threaded_processor.start()
+            if self.meter:
+                self.meter.start()
+            if self.settings.stats_address:
+                self.stats_server = StatsServer(self.settings.stats_address, self.stats,
+                                                {'profile': self.toggle_profiling})
+                self.stats_server.start()
+            self.stream = self.backend.open(format=self.format,
                                             channels=self.channels,
                                             rate=self.rate,
                                             frames_per_buffer=self.settings.frame_size,
                                             input=enable_input,
                                             output=enable_output,
-                                            output_host_api_specific_stream_info=stream_info,
                                             input_device_index=input_dev_idx,
                                             output_device_index=output_dev_idx,
                                             stream_callback=self.__recording_callback)
@@ -237,14 +434,111 @@ class AudioSession:
             print "Unsupported audio configuration!"
             raise ValueError("Unsupported audio configuration!")
 
+    def process_offline(self):
+        """
+        Process (file) -> [process] -> (file) without opening audio devices
+        """
+        print "Processing (file) -> [process] -> (file) offline..."
+        if self.file_rate != self.rate:
+            print "Resampling {0} -> {1}".format(self.file_rate, self.rate)
+        self.offline_engine.run(self.file_source, self.output_wave_file)
+        self.offline_engine.print_stat()
+
+    def process_file(self, in_file, out_file):
+        """
+        Process (file) -> [process] -> (file) offline reusing this session
+        and its processing chain, e.g. by a batch worker
+        :param in_file: input wav file
+        :param out_file: output wav file
+        :return: OfflineEngine with statistics of the run
+        """
+        self.__configure_input_file(**{KEY_INPUT_FILE_NAME: in_file})
+        try:
+            self.__prepare_processing()
+            self.__configure_output_file(**{KEY_OUTPUT_FILE_NAME: out_file})
+            try:
+                self.offline_engine.run(self.file_source, self.output_wave_file)
+            finally:
+                self.output_wave_file.close()
+        finally:
+            self.file_source.close()
+        return self.offline_engine
+
+    def stats(self):
+        """
+        :return: dictionary with the session statistics
+        """
+        stats = self.callback_stats.to_dict()
+        if self.processing_graph:
+            stats['graph'] = self.processing_graph.timings()
+        if self.threaded_processor:
+            stats['worker'] = {
+                'latency_ms': 1000.0 * self.threaded_processor.latency_frames / self.rate,
+                'input_overflows': self.threaded_processor.input_overflow_count,
+                'output_underflows': self.threaded_processor.output_underflow_count}
+        if self.stream_mode in (StreamMode.BuildInIn2Net, StreamMode.VD2Net):
+            stats['network'] = self.network_sink.stats()
+        elif self.stream_mode in (StreamMode.Net2BuildInOut, StreamMode.Net2VD):
+            stats['network'] = self.network_source.stats()
+        if self.meter:
+            stats['meters'] = self.meter.readings
+        if self.profiler.enabled or self.profiler.stages:
+            stats['profile'] = self.profiler.to_dict()
+        error = self.error or (self.threaded_processor and self.threaded_processor.error)
+        if error:
+            stats['error'] = error
+        return stats
+
+    def toggle_profiling(self):
+        """
+        Start or stop profiling without interrupting the stream
+        :return: {'profiling': new state}
+        """
+        return self.profiler.toggle()
+
+    def dump_stats(self, force=False):
+        """
+        Dump statistics as JSON to `stats_file` every `stats_interval` seconds
+        :param force: dump regardless of the interval
+        """
+        if not self.settings.stats_file:
+            return
+        now = time.time()
+        if force or now - self.last_stats_dump >= self.settings.stats_interval:
+            self.last_stats_dump = now
+            dump_stats(self.stats(), self.settings.stats_file)
+
     def close_stream(self):
         print "Closing stream..."
         if self.stream:
             self.stream.stop_stream()
             self.stream.close()
 
-        print "Min processing time: %0.2f ms" % (self.min_elapsed_time * 1000)
-        print "Max processing time: %0.2f ms" % (self.max_elapsed_time * 1000)
+            self.backend.print_stat()
+            if self.error:
+                print "Stream stopped by an error:\n{}".format(self.error)
+            self.callback_stats.print_stat()
+            if self.processing_graph:
+                self.processing_graph.print_stat()
+            self.dump_stats(force=True)
+
+        if self.threaded_processor:
+            self.threaded_processor.stop()
+            if self.threaded_processor.error:
+                print "Processing stopped by an error:\n{}".format(self.threaded_processor.error)
+            print "Worker latency: %0.1f ms, input overflows: %i, output underflows: %i" % (
+                1000.0 * self.threaded_processor.latency_frames / self.rate,
+                self.threaded_processor.input_overflow_count,
+                self.threaded_processor.output_underflow_count)
+
+        if self.meter:
+            self.meter.stop()
+            self.meter.print_stat()
+        # prints the profile and writes the sampled stacks
+        self.profiler.disable()
+        if self.stats_server:
+            self.stats_server.stop()
+            self.stats_server = None
 
         stream_mode = self.stream_mode
         if stream_mode == StreamMode.BuildInIn2Out:
@@ -262,21 +556,33 @@ class AudioSession:
             self.output_wave_file.close()
         elif stream_mode == StreamMode.BuildInIn2File:
             # (build-in input) -> [process] -> (file)
-            self.output_wave_file.close()
+            self.output_writer.close()
+            self.output_writer.print_stat()
         elif stream_mode == StreamMode.File2BuildInOut:
             # (file) -> [process] -> (build-in output)
             self.file_source.close()
-        elif stream_mode == StreamMode.BuildInIn2File:
+        elif stream_mode == StreamMode.VD2File:
             # (virtual device input) -> [process] -> (file)
-            self.output_wave_file.close()
-        elif stream_mode == StreamMode.File2BuildInOut:
+            self.output_writer.close()
+            self.output_writer.print_stat()
+        elif stream_mode == StreamMode.File2VD:
             # (file) -> [process] -> (virtual device output)
             self.file_source.close()
+        elif stream_mode == StreamMode.BuildInIn2Net or \
+             stream_mode == StreamMode.VD2Net:
+            # (build-in input) -> [process] -> (network)
+            # (virtual device input) -> [process] -> (network)
+            self.network_sink.close()
+            self.network_sink.print_stat()
+        elif stream_mode == StreamMode.Net2BuildInOut or \
+             stream_mode == StreamMode.Net2VD:
+            # (network) -> [process] -> (build-in output)
+            # (network) -> [process] -> (virtual device output)
+            self.network_source.close()
+            self.network_source.print_stat()
         else:
             print "Unsupported stream mode! [{}]".format(stream_mode)
 
-        self.p_audio.terminate()
-
 def print_usage(name):
     print """
 Streaming audio processing template program.
@@ -285,13 +591,21 @@ Offers the following streaming modes:
     * 1. (build-in input) -> [process] -> (build-in output)
     * 2. (build-in input) -> [process] -> (virtual device output)
     * 3. (virtual device input) -> [process] -> (build-in output)
-    * 4. (file) -> [process] -> (file)
+    * 4. (file) -> [process] -> (file) (offline, faster than real time)
     * 5. (build-in input) -> [process] -> (file)
     * 6. (file) -> [process] -> (build-in output)
     * 7. (virtual device input) -> [process] -> (file)
     * 8. (file) -> [process] -> (virtual device output)
+    * 9. (build-in input) -> [process] -> (network)
+    * 10. (virtual device input) -> [process] -> (network)
+    * 11. (network) -> [process] -> (build-in output)
+    * 12. (network) -> [process] -> (virtual device output)
 
-python {0} [-h, -d, -v, -a, -b] [-i <in file>, -o <out file>]
+python {0} [-h, -d, -v, -a, -b, -t, -s, -m, --profile, --stats=<file>, --serve=<[host:]port>] [-i <in file>, -o <out file>] [-r <rate>] [-p [-j <processes>]]
+python {0} [-v, -t, -s, -m, --profile, --stats=<file>, --serve=<[host:]port>] --send=<host:port> | --receive=<[host:]port>
+python {0} --autotune [-a, -b, -s]
+python {0} --host=<sessions.json> [-s, -m, --profile, --stats=<file>, --serve=<[host:]port>]
+python {0} -I <in dir or glob> -O <out dir> [-r <rate>] [-j <processes>]
 
 To exit:
     Press `Ctrl+C`
@@ -308,8 +622,35 @@ Options:
        or built-in output (mode 1 or 2)
     -b use built-in output with virtual audio device 
        or built-in input (mode 1 or 3)
+    -t process on a worker thread decoupled from the audio callback
+       (adds `worker_latency_frames` of latency)
+    --autotune pick the smallest power-of-two `frame_size` whose p99 callback time
+       stays below `autotune_load` of the deadline in mode 1 (2 or 3 with -a/-b,
+       with -s on the simulated backend) and save it to `settings.json`
+    --host= run all sessions described by a JSON file in this process,
+       sharing PortAudio and a processing thread pool
+    -s, --simulate use a simulated clock-driven backend instead of audio devices
+       (see `simulation_*` in `settings.json`)
     -i, --ifile= provide input wav file
     -o, --ofile= provide output wav file
+    -r, --rate= sample rate of output files in mode 4 and -I
+       (default: `offline_rate` or the rate of the input file)
+    --stats= dump callback timing and xrun statistics as JSON
+       every `stats_interval` seconds and on exit
+    -m, --meter meter peak, RMS, loudness (LUFS) and spectrum of the processed stream
+       on a background thread (see `meter_*` in `settings.json`)
+    --serve= serve statistics and meters as JSON over HTTP on a local port (enables -m)
+    --profile profile callback stages, processing nodes and GC pauses from the start;
+       `kill -USR1 <pid>` or `POST /profile` (with --serve) toggles profiling at run time,
+       stacks of the processing threads are sampled into `profiling_stacks_file`
+    -I, --idir= batch process a directory (or glob) of wav files offline
+    -O, --odir= output directory for batch processing (subdirectories of the inputs are kept)
+    --send= stream the processed input to a receiver over UDP or TCP
+       (see `network_*` in `settings.json`, with -v activates mode 10)
+    --receive= play a stream received on a local port through an adaptive jitter buffer
+       (with -v activates mode 12)
+    -p process a single file (mode 4) in parallel segments
+    -j, --jobs= number of worker processes for -I or -p (default: number of cores)
 
 Use cases:
     * `python {0} -a -b` - to activate 1
@@ -320,6 +661,17 @@ Use cases:
     * `python {0} -i infile.wav` - to activate 6
     * `python {0} -v -o outfile.wav` - to activate 7
     * `python {0} -v -i infile.wav` - to activate 8
+    * `python {0} --send=192.168.1.20:5004` - to activate 9
+    * `python {0} -v --send=192.168.1.20:5004` - to activate 10
+    * `python {0} --receive=5004` - to activate 11
+    * `python {0} -v --receive=5004` - to activate 12
+    * `python {0} -a -b -s` - to load test 1 without audio devices
+    * `python {0} -a -b --serve=8000` - to activate 1 and poll `http://localhost:8000/meters`
+    * `python {0} -o outfile.wav --profile` - to activate 5 and print stage timings on exit
+    * `python {0} --autotune` - to choose `frame_size` for the processing chain
+    * `python {0} -I "in/*.wav" -O out` - to process many files as in 4
+    * `python {0} -I "in/*.wav" -O out -r 48000` - to convert many files to 48 kHz as in 4
+    * `python {0} -i infile.wav -o outfile.wav -p` - to process a long file as in 4 on all cores
 """.format(name)
 
 def main(opts):
@@ -328,6 +680,21 @@ def main(opts):
     use_virtual_device    = False
     use_build_in_input = False
     use_build_in_output = False
+    use_threaded_processing = False
+    use_simulation = False
+    use_autotune = False
+    host_config = ''
+    batch_source = ''
+    batch_output_dir = ''
+    batch_processes = None
+    stats_file = ''
+    stats_address = ''
+    use_metering = False
+    use_profiling = False
+    offline_rate = 0
+    send_address = ''
+    receive_address = ''
+    use_segments = False
     audio_session = None
 
     for opt, arg in opts:
@@ -335,7 +702,11 @@ def main(opts):
             print_usage(sys.argv[0])
             sys.exit(0)
         elif opt == '-d':
-            devices = AudioSettings.available_devices()
+            # the listing goes through the device cache of `settings.json`
+            settings = AudioSettings()
+            settings.deserialize()
+            devices = AudioSettings.available_devices(settings.device_cache_file)
+            settings.device_registry().terminate()
             print "Available audio devices:"
             for i, d in enumerate(devices):
                 print "\t{}. {}".format(i+1, d)
@@ -346,30 +717,154 @@ def main(opts):
             use_build_in_input = True
         elif opt == '-b':
             use_build_in_output = True
+        elif opt == '-t':
+            use_threaded_processing = True
+        elif opt in ("-s", "--simulate"):
+            use_simulation = True
+        elif opt == '--autotune':
+            use_autotune = True
+        elif opt == '--host':
+            host_config = arg
         elif opt in ("-i", "--ifile"):
             in_file = arg
         elif opt in ("-o", "--ofile"):
             out_file = arg
+        elif opt in ("-I", "--idir"):
+            batch_source = arg
+        elif opt in ("-O", "--odir"):
+            batch_output_dir = arg
+        elif opt == '--stats':
+            stats_file = arg
+        elif opt in ("-m", "--meter"):
+            use_metering = True
+        elif opt == '--serve':
+            stats_address = arg
+        elif opt == '--profile':
+            use_profiling = True
+        elif opt in ("-r", "--rate"):
+            offline_rate = int(arg)
+        elif opt == '--send':
+            send_address = arg
+        elif opt == '--receive':
+            receive_address = arg
+        elif opt == '-p':
+            use_segments = True
+        elif opt in ("-j", "--jobs"):
+            batch_processes = int(arg)
     
     settings = AudioSettings()
     settings.deserialize()
+    if use_threaded_processing:
+        settings.threaded_processing = True
+    if stats_file:
+        settings.stats_file = stats_file
+    if stats_address:
+        settings.stats_address = stats_address
+    if use_metering or stats_address:
+        settings.metering = True
+    if use_profiling:
+        settings.profiling = True
+    if offline_rate:
+        settings.offline_rate = offline_rate
+
+    backend = None
+    validate_stream_mode = settings.validate_stream_mode
+    if use_simulation:
+        backend = SimulatedBackend.from_settings(settings)
+        # every device is simulated
+        validate_stream_mode = lambda stream_mode: True
+
+    if host_config:
+        session_host = SessionHost(settings, SessionHost.load_config(host_config), use_simulation)
+        install_toggle_signal(session_host.toggle_profiling)
+        try:
+            if session_host.start():
+                session_host.run()
+        finally:
+            session_host.stop()
+            settings.device_registry().terminate()
+        session_host.print_stat()
+        sys.exit(0 if not any('error' in stats for stats in session_host.stats().values()) else 1)
+
+    if use_autotune:
+        if use_build_in_input and not use_build_in_output:
+            stream_mode = StreamMode.BuildInIn2VD
+        elif use_build_in_output and not use_build_in_input:
+            stream_mode = StreamMode.VD2BuildInOut
+        else:
+            stream_mode = StreamMode.BuildInIn2Out
+        if not validate_stream_mode(stream_mode):
+            print "There are no supported audio devices for current stream mode."
+            sys.exit(1)
+        tuner = FrameSizeTuner(settings, stream_mode, use_simulation)
+        try:
+            frame_size = tuner.run()
+        finally:
+            settings.device_registry().terminate()
+        tuner.print_stat()
+        if not frame_size:
+            print "No frame size keeps p99 below {:0.0f}% of the deadline.".format(100.0 * settings.autotune_load)
+            sys.exit(1)
+        # command-line overrides stay out of the file
+        saved_settings = AudioSettings()
+        saved_settings.deserialize()
+        saved_settings.frame_size = frame_size
+        saved_settings.serialize()
+        print "Frame size: {} (saved to settings)".format(frame_size)
+        sys.exit(0)
+
+    if batch_source or batch_output_dir:
+        if not batch_source or not batch_output_dir:
+            print_usage(sys.argv[0])
+            sys.exit(2)
+        batch_processor = BatchProcessor(settings, batch_processes)
+        try:
+            batch_processor.run(batch_source, batch_output_dir)
+        except KeyboardInterrupt:
+            pass
+        batch_processor.print_stat()
+        sys.exit(0 if not batch_processor.failed_count else 1)
 
-    if not in_file and not out_file:
+    if use_segments:
+        if not in_file or not out_file:
+            print_usage(sys.argv[0])
+            sys.exit(2)
+        segmented_processor = SegmentedProcessor(settings, batch_processes)
+        segmented_processor.run(in_file, out_file)
+        segmented_processor.print_stat()
+        sys.exit(0)
+
+    if send_address or receive_address:
+        if send_address and receive_address or in_file or out_file:
+            print_usage(sys.argv[0])
+            sys.exit(2)
+        if send_address:
+            stream_mode = StreamMode.VD2Net if use_virtual_device else StreamMode.BuildInIn2Net
+            kwargs = {KEY_NETWORK_ADDRESS: send_address}
+        else:
+            stream_mode = StreamMode.Net2VD if use_virtual_device else StreamMode.Net2BuildInOut
+            kwargs = {KEY_NETWORK_ADDRESS: receive_address}
+        if validate_stream_mode(stream_mode):
+            audio_session = AudioSession(stream_mode, settings, backend, **kwargs)
+            audio_session.open_stream()
+        else:
+            print "There are no supported audio devices for current stream mode."
+    elif not in_file and not out_file:
         if use_build_in_input and use_build_in_output:
-            if settings.validate_stream_mode(StreamMode.BuildInIn2Out):
-                audio_session = AudioSession(StreamMode.BuildInIn2Out, settings)
+            if validate_stream_mode(StreamMode.BuildInIn2Out):
+                audio_session = AudioSession(StreamMode.BuildInIn2Out, settings, backend)
                 audio_session.open_stream()
             else:
                 print "There are no supported audio devices for current stream mode."
         elif use_build_in_input and not use_build_in_output:
-            if settings.validate_stream_mode(StreamMode.BuildInIn2VD):
-                audio_session = AudioSession(StreamMode.BuildInIn2VD, settings)
+            if validate_stream_mode(StreamMode.BuildInIn2VD):
+                audio_session = AudioSession(StreamMode.BuildInIn2VD, settings, backend)
                 audio_session.open_stream()
             else:
                 print "There are no supported audio devices for current stream mode."
         elif use_build_in_output and not use_build_in_input:
-            if settings.validate_stream_mode(StreamMode.VD2BuildInOut):
-                audio_session = AudioSession(StreamMode.VD2BuildInOut, settings)
+            if validate_stream_mode(StreamMode.VD2BuildInOut):
+                audio_session = AudioSession(StreamMode.VD2BuildInOut, settings, backend)
                 audio_session.open_stream()
             else:
                 print "There are no supported audio devices for current stream mode."
@@ -378,45 +873,48 @@ def main(opts):
             sys.exit(0)
     elif in_file and not out_file:
         if use_virtual_device:
-            if settings.validate_stream_mode(StreamMode.File2VD):
-                audio_session = AudioSession(StreamMode.File2VD, settings, **{ KEY_INPUT_FILE_NAME:in_file})
+            if validate_stream_mode(StreamMode.File2VD):
+                audio_session = AudioSession(StreamMode.File2VD, settings, backend, **{ KEY_INPUT_FILE_NAME:in_file})
                 audio_session.open_stream()
             else:
                 print "There are no supported audio devices for current stream mode."
         else:
-            if settings.validate_stream_mode(StreamMode.File2BuildInOut):
-                audio_session = AudioSession(StreamMode.File2BuildInOut, settings, **{ KEY_INPUT_FILE_NAME:in_file})
+            if validate_stream_mode(StreamMode.File2BuildInOut):
+                audio_session = AudioSession(StreamMode.File2BuildInOut, settings, backend, **{ KEY_INPUT_FILE_NAME:in_file})
                 audio_session.open_stream()
             else:
                 print "There are no supported audio devices for current stream mode."
     elif out_file and not in_file:
         if use_virtual_device:
-            if settings.validate_stream_mode(StreamMode.VD2File):
-                audio_session = AudioSession(StreamMode.VD2File, settings, **{ KEY_OUTPUT_FILE_NAME:out_file})
+            if validate_stream_mode(StreamMode.VD2File):
+                audio_session = AudioSession(StreamMode.VD2File, settings, backend, **{ KEY_OUTPUT_FILE_NAME:out_file})
                 audio_session.open_stream()
             else:
                 print "There are no supported audio devices for current stream mode."
         else:
-            if settings.validate_stream_mode(StreamMode.BuildInIn2File):
-                audio_session = AudioSession(StreamMode.BuildInIn2File, settings, **{ KEY_OUTPUT_FILE_NAME:out_file})
+            if validate_stream_mode(StreamMode.BuildInIn2File):
+                audio_session = AudioSession(StreamMode.BuildInIn2File, settings, backend, **{ KEY_OUTPUT_FILE_NAME:out_file})
                 audio_session.open_stream()
             else:
                 print "There are no supported audio devices for current stream mode."
     elif in_file and out_file:
-        if settings.validate_stream_mode(StreamMode.File2File):
-            audio_session = AudioSession(StreamMode.File2File, settings, **{ KEY_INPUT_FILE_NAME:in_file,KEY_OUTPUT_FILE_NAME:out_file})
-            audio_session.open_stream()
+        if validate_stream_mode(StreamMode.File2File):
+            audio_session = AudioSession(StreamMode.File2File, settings, backend, **{ KEY_INPUT_FILE_NAME:in_file,KEY_OUTPUT_FILE_NAME:out_file})
+            audio_session.process_offline()
         else:
             print "There are no supported audio devices for current stream mode."
 
     if audio_session:
+        install_toggle_signal(audio_session.toggle_profiling)
         try:
-            while audio_session.stream.is_active():
+            while audio_session.stream and audio_session.stream.is_active():
                 time.sleep(0.1)
+                audio_session.dump_stats()
         except KeyboardInterrupt:
             pass
         finally:
             audio_session.close_stream()
+            settings.device_registry().terminate()
             print 'Done!'
         sys.exit(0)
     else:
@@ -425,7 +923,7 @@ def main(opts):
 
 if __name__ == "__main__":
     try:
-       opts, args = getopt.getopt(sys.argv[1:], "hdvabi:o:", ["ifile=", "ofile="])
+       opts, args = getopt.getopt(sys.argv[1:], "hdvabtsmi:o:r:I:O:pj:", ["simulate", "meter", "serve=", "profile", "autotune", "host=", "ifile=", "ofile=", "rate=", "idir=", "odir=", "jobs=", "stats=", "send=", "receive="])
     except getopt.GetoptError:
         print_usage(sys.argv[0])
         sys.exit(2)
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Ilya Shoshin (Galarius)'
+
+import os
+import struct
+import numpy as np
+from wave_mmap import WAVE_FORMAT_PCM, WAVE_FORMAT_IEEE_FLOAT
+
+# RIFF chunk sizes are 32 bit, larger recordings are written as RF64 (EBU Tech 3306)
+RIFF_MAX_SIZE = 0xFFFFFFFF
+# ds64 chunk body: RIFF size, data size, sample count (64 bit each), table length
+DS64_SIZE = 28
+# RIFF/RF64, JUNK/ds64, fmt and data chunk headers
+HEADER_SIZE = 12 + 8 + DS64_SIZE + 8 + 16 + 8
+# file extension step
+DEFAULT_PREALLOCATE_BYTES = 64 * 1048576
+
+
+def segment_filename(filename, index):
+    """
+    :return: name of the numbered segment, e.g. rec.wav -> rec_0001.wav
+    """
+    base, ext = os.path.splitext(filename)
+    return '{}_{:04d}{}'.format(base, index, ext or '.wav')
+
+
+class RecordingSink:
+    """
+    Wave file writer for long and unattended captures.
+    The header reserves room for a ds64 chunk (as JUNK), so a recording
+    that outgrows the 4 GB RIFF limit is turned into RF64 in place.
+    The file is extended by large preallocated steps instead of
+    one write at a time and trimmed to its data on close; `checkpoint`
+    writes a valid header for the data written so far and syncs the file,
+    so a crash loses at most the data after the last checkpoint.
+    Recordings roll over to numbered segment files by duration or size.
+    Not thread safe, used by the writer thread of AsyncWaveWriter.
+    """
+    def __init__(self, filename, channels, rate, dtype,
+                 preallocate_bytes=DEFAULT_PREALLOCATE_BYTES, segment_seconds=0, segment_bytes=0,
+                 riff_max_size=RIFF_MAX_SIZE):
+        """
+        Init sink
+        :param filename: output wave file (name pattern of the segments when rolling)
+        :param channels: number of channels
+        :param rate: sample rate
+        :param dtype: sample format
+        :param preallocate_bytes: file extension step (0 - grow with every write)
+        :param segment_seconds: start a new file after this duration (0 - disabled)
+        :param segment_bytes: start a new file before the data exceeds this size (0 - disabled)
+        :param riff_max_size: RIFF size from which the header is written as RF64
+        """
+        self.filename = filename
+        self.channels = channels
+        self.rate = rate
+        self.dtype = np.dtype(dtype)
+        self.block_align = channels * self.dtype.itemsize
+        self.preallocate_bytes = preallocate_bytes
+        self.riff_max_size = riff_max_size
+        limits = []
+        if segment_seconds:
+            limits.append(int(segment_seconds * rate))
+        if segment_bytes:
+            limits.append(segment_bytes // self.block_align)
+        self.segment_frames = max(min(limits), 1) if limits else 0
+        self.format_tag = WAVE_FORMAT_IEEE_FLOAT if self.dtype.kind == 'f' else WAVE_FORMAT_PCM
+        self.filenames = []
+        self.file = None
+        self.frames = 0
+        self.segment_index = 0
+        self.preallocation_count = 0
+        self.checkpoint_count = 0
+        self.rf64_segments = 0
+        self.__open_segment()
+
+    @staticmethod
+    def from_settings(filename, channels, rate, dtype, settings):
+        """
+        :param settings: AudioSettings with the `recording_*` fields
+        """
+        return RecordingSink(filename, channels, rate, dtype,
+                             int(settings.recording_preallocate_mb * 1048576),
+                             settings.recording_segment_seconds,
+                             int(settings.recording_segment_mb * 1048576))
+
+    def __open_segment(self):
+        if self.segment_frames:
+            self.segment_index += 1
+            filename = segment_filename(self.filename, self.segment_index)
+        else:
+            filename = self.filename
+        self.file = open(filename, 'wb')
+        self.filenames.append(filename)
+        self.segment_data_frames = 0
+        self.rf64 = False
+        self.allocated = 0
+        self.file.write(self.__header())
+        self.__reserve(HEADER_SIZE)
+
+    def __header(self):
+        data_size = self.segment_data_frames * self.block_align
+        riff_size = HEADER_SIZE - 8 + data_size + (data_size & 1)
+        if riff_size > self.riff_max_size and not self.rf64:
+            self.rf64 = True
+            self.rf64_segments += 1
+        fmt = struct.pack('<4sIHHIIHH', b'fmt ', 16, self.format_tag, self.channels, self.rate,
+                          self.rate * self.block_align, self.block_align, 8 * self.dtype.itemsize)
+        if self.rf64:
+            # sizes live in ds64, the 32 bit fields are set to -1
+            return struct.pack('<4sI4s', b'RF64', 0xFFFFFFFF, b'WAVE') + \
+                   struct.pack('<4sIQQQI', b'ds64', DS64_SIZE, riff_size, data_size,
+                               self.segment_data_frames, 0) + \
+                   fmt + struct.pack('<4sI', b'data', 0xFFFFFFFF)
+        return struct.pack('<4sI4s', b'RIFF', riff_size, b'WAVE') + \
+               struct.pack('<4sI', b'JUNK', DS64_SIZE) + b'\0' * DS64_SIZE + \
+               fmt + struct.pack('<4sI', b'data', data_size)
+
+    def __reserve(self, size):
+        """
+        Make sure the file has `size` bytes, extending it by `preallocate_bytes`
+        """
+        if size <= self.allocated or not self.preallocate_bytes:
+            return
+        size = max(size, self.allocated + self.preallocate_bytes)
+        self.file.flush()
+        fallocate = getattr(os, 'posix_fallocate', None)
+        if fallocate is not None:
+            # reserves the extents, writes don't have to allocate blocks
+            fallocate(self.file.fileno(), self.allocated, size - self.allocated)
+        else:
+            os.ftruncate(self.file.fileno(), size)
+        self.allocated = size
+        self.preallocation_count += 1
+
+    def write_frames(self, frames):
+        """
+        Append frames, starting new segments as needed
+        :param frames: C-contiguous (frames x channels) array of the sink format
+        """
+        start = 0
+        while start < len(frames):
+            count = len(frames) - start
+            if self.segment_frames:
+                if self.segment_data_frames == self.segment_frames:
+                    self.__close_segment()
+                    self.__open_segment()
+                count = min(count, self.segment_frames - self.segment_data_frames)
+            end = HEADER_SIZE + (self.segment_data_frames + count) * self.block_align
+            self.__reserve(end)
+            self.file.write(frames[start:start + count].data)
+            self.segment_data_frames += count
+            self.frames += count
+            start += count
+
+    def checkpoint(self):
+        """
+        Write a header for the data written so far and sync the file to disk
+        """
+        self.file.seek(0)
+        self.file.write(self.__header())
+        self.file.seek(HEADER_SIZE + self.segment_data_frames * self.block_align)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.checkpoint_count += 1
+
+    def __close_segment(self):
+        data_size = self.segment_data_frames * self.block_align
+        if data_size & 1:
+            # chunks are word aligned
+            self.file.write(b'\0')
+        self.checkpoint()
+        # drop the unused preallocated space
+        self.file.truncate(HEADER_SIZE + data_size + (data_size & 1))
+        self.file.close()
+        self.file = None
+
+    def close(self):
+        if self.file:
+            self.__close_segment()
+
+    @property
+    def bytes_written(self):
+        return self.frames * self.block_align
+
+    def print_stat(self):
+        print "Recording: {} ({} segment{}, {} RF64), {:0.1f} MB, {} preallocations, {} checkpoints".format(
+            self.filenames[-1] if self.filenames else self.filename, len(self.filenames),
+            '' if len(self.filenames) == 1 else 's', self.rf64_segments,
+            self.bytes_written / 1048576.0, self.preallocation_count, self.checkpoint_count)
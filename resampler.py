@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Ilya Shoshin (Galarius)'
+
+from fractions import gcd
+import numpy as np
+import audio_helper as ah
+
+# filter taps per polyphase branch (per input sample) when upsampling,
+# decimation scales them by down / up to keep the transition band narrow
+DEFAULT_TAPS_PER_PHASE = 32
+# Kaiser window shape, ~80 dB stopband attenuation
+KAISER_BETA = 8.0
+# passband edge relative to the lower Nyquist frequency
+ROLLOFF = 0.92
+
+# polyphase filters shared by all resamplers, keyed by (up, down, taps per phase)
+_FILTER_CACHE = {}
+
+
+def resampling_ratio(rate_in, rate_out):
+    """
+    :return: (up, down) reduced rational ratio rate_out / rate_in
+    """
+    divisor = gcd(rate_in, rate_out)
+    return rate_out // divisor, rate_in // divisor
+
+
+def polyphase_filter(up, down, taps_per_phase=DEFAULT_TAPS_PER_PHASE):
+    """
+    Kaiser-windowed sinc lowpass split into `up` branches.
+    The prototype spans `taps_per_phase` periods of its cutoff, so its length
+    grows with max(up, down): strong decimation gets as sharp an anti-aliasing
+    filter as interpolation.
+    :param up: interpolation factor
+    :param down: decimation factor
+    :param taps_per_phase: taps of each branch at up >= down
+    :return: (up x taps) read-only array, taps = ceil(taps_per_phase * max(up, down) / up),
+             branch p holds taps p, p + up, ...
+    """
+    key = (up, down, taps_per_phase)
+    filters = _FILTER_CACHE.get(key)
+    if filters is None:
+        taps = -(-taps_per_phase * max(up, down) // up)
+        length = up * taps
+        cutoff = ROLLOFF * 0.5 / max(up, down)
+        # centred on a whole upsampled sample, so that the delay can be compensated exactly
+        t = np.arange(length) - length // 2
+        prototype = 2 * cutoff * np.sinc(2 * cutoff * t) * np.kaiser(length, KAISER_BETA)
+        # unity gain for every branch
+        prototype *= up / prototype.sum()
+        filters = prototype.reshape(taps, up).T.copy()
+        filters.flags.writeable = False
+        _FILTER_CACHE[key] = filters
+    return filters
+
+
+class PolyphaseResampler:
+    """
+    Streaming rational sample-rate converter.
+    Output sample m is interpolated at input time m * down / up by the
+    polyphase branch of that fractional position; input history is kept
+    between blocks, so any block split yields the same output.
+    The filter delay is compensated: output starts in phase with the input
+    and `flush` returns the remaining tail at the end of a stream.
+    """
+    def __init__(self, rate_in, rate_out, channels, taps_per_phase=DEFAULT_TAPS_PER_PHASE, dtype=np.float32):
+        """
+        Init resampler
+        :param rate_in: input sample rate
+        :param rate_out: output sample rate
+        :param channels: number of channels
+        :param taps_per_phase: filter taps per input sample (quality), scaled by down / up when decimating
+        :param dtype: floating point type of the computation
+        """
+        self.rate_in = rate_in
+        self.rate_out = rate_out
+        self.channels = channels
+        self.up, self.down = resampling_ratio(rate_in, rate_out)
+        # taps in reversed order, so that they pair with the oldest-first history
+        self.filters = polyphase_filter(self.up, self.down, taps_per_phase)[:, ::-1].astype(dtype)
+        self.taps = self.filters.shape[1]
+        self.dtype = np.dtype(dtype)
+        self.__history = np.zeros((self.taps - 1, channels), dtype=self.dtype)
+        self.__buffer = np.zeros((0, channels), dtype=self.dtype)
+        self.__out = np.zeros((0, channels), dtype=self.dtype)
+        self.reset()
+
+    @property
+    def delay(self):
+        """
+        Filter delay in input frames
+        """
+        return float(self.up * self.taps // 2) / self.up
+
+    def reset(self):
+        self.__history[:] = 0
+        # position of the next output in upsampled units from the start of the next block
+        self.__time = self.up * self.taps // 2
+
+    def output_frames(self, input_frames):
+        """
+        :return: number of output frames produced by the next `input_frames`
+        """
+        end = input_frames * self.up
+        return max(-(-(end - self.__time) // self.down), 0)
+
+    def process(self, block):
+        """
+        Resample a block
+        :param block: (frames x channels) input of any length
+        :return: (frames x channels) view of the output buffer (valid until the next call)
+        """
+        frames = len(block)
+        count = self.output_frames(frames)
+        history = self.taps - 1
+        if len(self.__buffer) < history + frames:
+            self.__buffer = np.zeros((history + frames, self.channels), dtype=self.dtype)
+        if len(self.__out) < count:
+            self.__out = np.zeros((count, self.channels), dtype=self.dtype)
+        buf = self.__buffer[:history + frames]
+        buf[:history] = self.__history
+        buf[history:] = block
+        out = self.__out[:count]
+        if count:
+            times = self.__time + self.down * np.arange(count)
+            positions = times // self.up
+            coefficients = self.filters[times % self.up]
+            # the newest input of output i is buf[history + positions[i]]
+            out[:] = 0
+            for k in range(self.taps):
+                out += coefficients[:, k:k + 1] * buf[positions + k]
+            self.__time = int(times[-1]) + self.down
+        self.__time -= frames * self.up
+        self.__history[:] = buf[frames:]
+        return out
+
+    def flush(self):
+        """
+        Return the delayed tail of the stream
+        """
+        return self.process(np.zeros((self.taps, self.channels), dtype=self.dtype))
+
+
+class ResamplingReader:
+    """
+    Wave source converted to another sample rate on the fly.
+    Wraps MappedWaveReader with the same `read` interface,
+    so that a file of any rate can feed a device or an output file of any rate.
+    Samples are converted to float32 once and `read` returns the resampled
+    float32 frames, which AudioCodec passes through; the format getters
+    describe the source, the format of outputs fed by the reader.
+    """
+    def __init__(self, source, rate, taps_per_phase=DEFAULT_TAPS_PER_PHASE, block_size=4096):
+        """
+        Init reader
+        :param source: MappedWaveReader
+        :param rate: output sample rate
+        :param taps_per_phase: resampler quality
+        :param block_size: frames read from the source at once
+        """
+        self.source = source
+        self.rate = rate
+        self.channels = source.channels
+        self.dtype = source.dtype
+        self.sample_width = source.sample_width
+        self.block_size = block_size
+        self.converter = ah.SampleConverter(self.dtype)
+        self.resampler = PolyphaseResampler(source.rate, rate, self.channels, taps_per_phase)
+        self.nframes = -(-source.nframes * self.resampler.up // self.resampler.down)
+        self.__input = np.zeros((block_size, self.channels), dtype=np.float32)
+        self.__buffer = np.zeros((2 * block_size, self.channels), dtype=np.float32)
+        self.rewind()
+
+    def getnchannels(self):
+        return self.channels
+
+    def getsampwidth(self):
+        return self.sample_width
+
+    def getframerate(self):
+        return self.rate
+
+    def getnframes(self):
+        return self.nframes
+
+    def getformat(self):
+        """
+        :return: PyAudio sample format
+        """
+        return ah.numpy_to_py_audio_format(self.dtype)
+
+    def tell(self):
+        return self.position
+
+    def rewind(self):
+        self.source.rewind()
+        self.resampler.reset()
+        self.position = 0
+        self.__start = 0
+        self.__end = 0
+        self.__flushed = False
+
+    def __append(self, resampled):
+        available = self.__end - self.__start
+        if self.__end + len(resampled) > len(self.__buffer):
+            if available + len(resampled) > len(self.__buffer):
+                buffer = np.zeros((2 * (available + len(resampled)), self.channels), dtype=np.float32)
+                buffer[:available] = self.__buffer[self.__start:self.__end]
+                self.__buffer = buffer
+            else:
+                self.__buffer[:available] = self.__buffer[self.__start:self.__end]
+            self.__start, self.__end = 0, available
+        self.__buffer[self.__end:self.__end + len(resampled)] = resampled
+        self.__end += len(resampled)
+
+    def read(self, frame_count):
+        """
+        Read resampled frames
+        :param frame_count: maximum number of frames
+        :return: (frames x channels) float32 view (valid until the next call), empty at the end of the file
+        """
+        while self.__end - self.__start < frame_count and not self.__flushed:
+            frames = self.source.read(self.block_size)
+            if len(frames):
+                signal = self.__input[:len(frames)]
+                self.converter.to_float(frames, signal)
+                self.__append(self.resampler.process(signal))
+            else:
+                self.__append(self.resampler.flush())
+                self.__flushed = True
+        count = min(frame_count, self.__end - self.__start)
+        if not self.source.loop:
+            count = min(count, self.nframes - self.position)
+        start = self.__start
+        self.__start += count
+        self.position += count
+        return self.__buffer[start:start + count]
+
+    def close(self):
+        self.source.close()
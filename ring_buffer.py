@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Ilya Shoshin (Galarius)'
+
+import numpy as np
+
+
+class RingBuffer:
+    """
+    Single-producer/single-consumer ring buffer of multichannel frames.
+    The producer only advances `write_index` and the consumer only advances
+    `read_index`, both are published after the data is copied,
+    so no lock is required between the two threads.
+    """
+    def __init__(self, capacity, channels, dtype=np.float32):
+        """
+        Init ring buffer
+        :param capacity: maximum number of stored frames
+        :param channels: number of channels per frame
+        :param dtype: sample format
+        """
+        self.capacity = capacity
+        self.channels = channels
+        self.buffer = np.zeros((capacity, channels), dtype=dtype)
+        # monotonically increasing frame counters
+        self.write_index = 0
+        self.read_index = 0
+
+    def available(self):
+        """
+        Number of frames ready to be read
+        """
+        return self.write_index - self.read_index
+
+    def free(self):
+        """
+        Number of frames that can be written
+        """
+        return self.capacity - (self.write_index - self.read_index)
+
+    def write(self, frames):
+        """
+        Copy frames into the buffer (producer side)
+        :param frames: (frames x channels) array
+        :return: number of written frames
+        """
+        frame_count = min(len(frames), self.free())
+        start = self.write_index % self.capacity
+        first = min(frame_count, self.capacity - start)
+        self.buffer[start:start + first] = frames[:first]
+        self.buffer[:frame_count - first] = frames[first:frame_count]
+        self.write_index += frame_count
+        return frame_count
+
+    def read(self, out):
+        """
+        Copy frames out of the buffer (consumer side)
+        :param out: preallocated (frames x channels) array
+        :return: number of read frames
+        """
+        frame_count = min(len(out), self.available())
+        start = self.read_index % self.capacity
+        first = min(frame_count, self.capacity - start)
+        out[:first] = self.buffer[start:start + first]
+        out[first:frame_count] = self.buffer[:frame_count - first]
+        self.read_index += frame_count
+        return frame_count
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Ilya Shoshin (Galarius)'
+
+import multiprocessing
+import numpy as np
+import audio_helper as ah
+import batch_processing
+from wave_mmap import MappedWaveReader, create_wave_file
+from extensions import elapsed_timer
+
+
+def _process_segment(job):
+    in_file, out_file, data_offset, start, end, lead_in, crossfade = job
+    session = batch_processing.worker_session()
+    source = MappedWaveReader(in_file)
+    # the worker session was built for `settings.json`, every segment starts from a fresh state
+    session.prepare_for(source.channels, source.rate)
+    engine = session.offline_engine
+    out = np.memmap(out_file, dtype=source.dtype, mode='r+', offset=data_offset,
+                    shape=(source.nframes, source.channels))
+    # warm-up region lets stateful processing settle before the segment,
+    # the crossfade region (if any) follows it and is output of settled state
+    head = np.zeros((lead_in, source.channels), dtype=np.float32)
+    engine.process_frames(source.frames[start - lead_in:start], head)
+    engine.process_frames(source.frames[start:end], out[start:end])
+    out.flush()
+    del out
+    source.close()
+    return start, head[max(lead_in - crossfade, 0):] if crossfade else None
+
+
+class SegmentedProcessor:
+    """
+    Process a single large file (file) -> [process] -> (file) in parallel.
+    The file is cut into segments which are processed on worker processes
+    straight into a preallocated output file. Every segment is preceded by
+    a warm-up region of the input so that stateful processing settles,
+    its output is discarded. Optionally a crossfade region follows the
+    warm-up: its settled output is crossfaded with the end of the previous
+    segment. Seams are sample-exact.
+    """
+    def __init__(self, settings, processes=None):
+        """
+        Init segmented processor
+        :param settings: AudioSettings passed to the workers
+        :param processes: number of worker processes (default: number of cores)
+        """
+        self.settings = settings
+        self.processes = processes or multiprocessing.cpu_count()
+        self.warmup_frames = settings.segment_warmup_frames
+        self.crossfade_frames = settings.segment_crossfade_frames
+        self.frames = 0
+        self.rate = 0
+        self.segment_count = 0
+        self.elapsed_time = 0.0
+
+    def segments(self, nframes):
+        """
+        Split the file into segments
+        :param nframes: number of frames in the file
+        :return: list of (start, end, lead-in) tuples, the lead-in is the warm-up
+                 and crossfade regions preceding the segment
+        """
+        segment_frames = self.settings.segment_frames
+        if not segment_frames:
+            segment_frames = -(-nframes // self.processes)
+        lead_in = self.warmup_frames + self.crossfade_frames
+        # avoid segments dominated by their lead-in region
+        segment_frames = max(segment_frames, 4 * lead_in, 1)
+        return [(start, min(start + segment_frames, nframes), min(start, lead_in))
+                for start in range(0, nframes, segment_frames)]
+
+    def run(self, in_file, out_file):
+        """
+        Process the file
+        :param in_file: input wav file
+        :param out_file: output wav file
+        :return: number of processed frames
+        """
+        source = MappedWaveReader(in_file)
+        self.frames, self.rate = source.nframes, source.rate
+        channels, dtype = source.channels, source.dtype
+        source.close()
+        if self.settings.offline_rate and self.settings.offline_rate != self.rate:
+            raise ValueError("Segmented processing doesn't resample, convert the file first")
+        data_offset = create_wave_file(out_file, channels, self.rate, dtype, self.frames)
+        segments = self.segments(self.frames)
+        self.segment_count = len(segments)
+        jobs = [(in_file, out_file, data_offset, start, end, lead_in, self.crossfade_frames)
+                for start, end, lead_in in segments]
+        print "Processing {} segments on {} processes...".format(len(jobs), self.processes)
+
+        pool = multiprocessing.Pool(self.processes, batch_processing.init_worker, (self.settings,))
+        try:
+            with elapsed_timer() as elapsed:
+                heads = pool.map(_process_segment, jobs)
+                pool.close()
+                if self.crossfade_frames:
+                    out = np.memmap(out_file, dtype=dtype, mode='r+', offset=data_offset,
+                                    shape=(self.frames, channels))
+                    for start, head in heads:
+                        if len(head):
+                            self.__crossfade(out[start - len(head):start], head)
+                    out.flush()
+                    del out
+                self.elapsed_time = elapsed()
+        except BaseException:
+            # stop the workers, the original error propagates
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        return self.frames
+
+    @staticmethod
+    def __crossfade(tail, head):
+        """
+        Crossfade from the end of the previous segment to the output of
+        the crossfade region of the next one in place
+        :param tail: end of the previous segment (output file view)
+        :param head: float32 output of the crossfade region of the next segment
+        """
+        fade_in = np.linspace(0.0, 1.0, len(head) + 2)[1:-1, np.newaxis]
+        mixed = ah.to_float32(tail) * (1.0 - fade_in) + head * fade_in
+        ah.SampleConverter(tail.dtype).from_float(mixed, tail)
+
+    def print_stat(self):
+        duration = float(self.frames) / self.rate if self.rate else 0.0
+        print "Processed: %0.1f s of audio in %i segments in %0.2f s" % (
+            duration, self.segment_count, self.elapsed_time)
+        if self.elapsed_time:
+            print "Real-time factor: %0.4f (%0.1fx faster than real time)" % (
+                self.elapsed_time / duration, duration / self.elapsed_time)
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Ilya Shoshin (Galarius)'
+
+import copy
+import json
+import os
+import time
+import traceback
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from audio_settings import StreamMode
+from audio_backend import SimulatedBackend
+from callback_stats import dump_stats
+from stats_server import StatsServer
+
+HOST_KEY_SESSIONS = 'sessions'
+HOST_KEY_WORKERS  = 'workers'
+SESSION_KEY_NAME     = 'name'
+SESSION_KEY_MODE     = 'mode'
+SESSION_KEY_INPUT    = 'input'
+SESSION_KEY_OUTPUT   = 'output'
+SESSION_KEY_ADDRESS  = 'address'
+SESSION_KEY_SETTINGS = 'settings'
+
+
+class HostedSession:
+    def __init__(self, name, stream_mode, settings, in_file, out_file, address):
+        self.name = name
+        self.stream_mode = stream_mode
+        self.settings = settings
+        self.in_file = in_file
+        self.out_file = out_file
+        self.address = address
+        self.session = None
+        self.error = None
+
+    def is_active(self):
+        return self.session is not None and self.session.stream is not None and \
+               self.session.stream.is_active()
+
+    def stats(self):
+        stats = self.session.stats() if self.session else {}
+        if self.error:
+            stats['error'] = self.error
+        return stats
+
+
+class SessionHost:
+    """
+    Many audio sessions in one process.
+    Sessions are described by a JSON config, share the PortAudio instance
+    of the device registry and run their processing on one thread pool
+    (NumPy releases the GIL in heavy calls). Every session keeps its own
+    statistics; a session that fails to start or stops with an error
+    doesn't affect the others.
+    {"workers": 4,
+     "sessions": [{"name": ..., "mode": "BuildInIn2VD", "input": ..., "output": ...,
+                   "address": <host:port of the network modes>,
+                   "settings": {<settings.json overrides>}}, ...]}
+    """
+    def __init__(self, settings, config, simulate=False):
+        """
+        Init host
+        :param settings: AudioSettings shared by the sessions
+        :param config: host description
+        :param simulate: run every session on its own simulated backend
+        """
+        self.settings = settings
+        self.simulate = simulate
+        self.workers = config.get(HOST_KEY_WORKERS) or multiprocessing.cpu_count()
+        self.sessions = []
+        for i, spec in enumerate(config[HOST_KEY_SESSIONS]):
+            name = spec.get(SESSION_KEY_NAME, 'session{}'.format(i + 1))
+            if any(hosted.name == name for hosted in self.sessions):
+                raise ValueError("Duplicate session name '{}'".format(name))
+            stream_mode = getattr(StreamMode, spec[SESSION_KEY_MODE])
+            session_settings = copy.copy(settings)
+            # processing runs on the shared pool unless the session disables it
+            session_settings.threaded_processing = True
+            # the host dumps and serves the statistics of all sessions
+            session_settings.stats_file = ''
+            session_settings.stats_address = ''
+            session_settings.apply(spec.get(SESSION_KEY_SETTINGS, {}))
+            self.sessions.append(HostedSession(name, stream_mode, session_settings,
+                                               spec.get(SESSION_KEY_INPUT), spec.get(SESSION_KEY_OUTPUT),
+                                               spec.get(SESSION_KEY_ADDRESS)))
+        self.pool = None
+        self.stats_server = None
+
+    @staticmethod
+    def load_config(filename):
+        with open(filename, 'r') as in_file:
+            return json.load(in_file)
+
+    def start(self):
+        """
+        Open all streams
+        :return: number of running sessions
+        """
+        from py_streaming_dsp import AudioSession, KEY_INPUT_FILE_NAME, KEY_OUTPUT_FILE_NAME, KEY_NETWORK_ADDRESS
+        self.pool = ThreadPool(self.workers)
+        if self.settings.stats_address:
+            self.stats_server = StatsServer(self.settings.stats_address, self.stats,
+                                            {'profile': self.toggle_profiling})
+            self.stats_server.start()
+        for hosted in self.sessions:
+            print "Starting session '{}'...".format(hosted.name)
+            try:
+                if hosted.stream_mode == StreamMode.File2File:
+                    raise ValueError("File2File sessions are processed offline, use -I instead")
+                files = {}
+                if hosted.in_file:
+                    files[KEY_INPUT_FILE_NAME] = hosted.in_file
+                if hosted.out_file:
+                    files[KEY_OUTPUT_FILE_NAME] = hosted.out_file
+                if hosted.address:
+                    files[KEY_NETWORK_ADDRESS] = hosted.address
+                backend = SimulatedBackend.from_settings(hosted.settings) if self.simulate else None
+                stacks_file = hosted.settings.profiling_stacks_file
+                if stacks_file:
+                    # one stacks file per session, e.g. profile_mic.folded
+                    base, ext = os.path.splitext(stacks_file)
+                    stacks_file = '{}_{}{}'.format(base, hosted.name, ext)
+                hosted.session = AudioSession(hosted.stream_mode, hosted.settings, backend, self.pool,
+                                              stacks_file, **files)
+                hosted.session.open_stream()
+            except Exception:
+                hosted.error = traceback.format_exc()
+                print "Session '{}' failed to start:\n{}".format(hosted.name, hosted.error)
+        return sum(1 for hosted in self.sessions if hosted.is_active())
+
+    def run(self, poll_interval=0.1):
+        """
+        Wait until all streams stop (or Ctrl+C), dumping statistics periodically
+        """
+        last_dump = time.time()
+        try:
+            while any(hosted.is_active() for hosted in self.sessions):
+                time.sleep(poll_interval)
+                for hosted in self.sessions:
+                    if hosted.session:
+                        hosted.session.dump_stats()
+                if self.settings.stats_file and time.time() - last_dump >= self.settings.stats_interval:
+                    last_dump = time.time()
+                    dump_stats(self.stats(), self.settings.stats_file)
+        except KeyboardInterrupt:
+            pass
+
+    def stop(self):
+        for hosted in self.sessions:
+            if not hosted.session:
+                continue
+            print "Session '{}':".format(hosted.name)
+            try:
+                hosted.session.close_stream()
+            except Exception:
+                hosted.error = hosted.error or traceback.format_exc()
+                print "Session '{}' failed to close:\n{}".format(hosted.name, hosted.error)
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        if self.stats_server:
+            self.stats_server.stop()
+            self.stats_server = None
+        if self.settings.stats_file:
+            dump_stats(self.stats(), self.settings.stats_file)
+
+    def toggle_profiling(self):
+        """
+        Start or stop profiling of all sessions
+        :return: {session name: {'profiling': new state}}
+        """
+        return dict((hosted.name, hosted.session.toggle_profiling())
+                    for hosted in self.sessions if hosted.session)
+
+    def stats(self):
+        """
+        :return: statistics of every session by name
+        """
+        return dict((hosted.name, hosted.stats()) for hosted in self.sessions)
+
+    def print_stat(self):
+        failed = [hosted.name for hosted in self.sessions if hosted.stats().get('error')]
+        print "Sessions: {}, failed: {}{}".format(len(self.sessions), len(failed),
+                                                 ' ({})'.format(', '.join(failed)) if failed else '')
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Ilya Shoshin (Galarius)'
+
+import json
+import socket
+import threading
+from urlparse import urlparse
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from network_endpoint import parse_address
+
+
+class StatsRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET / returns all statistics, GET /a/b the value at stats['a']['b'],
+    POST /<command> runs a control command. Statistics may be read by pages
+    of any origin, commands are only accepted from the server's own origin.
+    """
+    def __path(self):
+        return [part for part in self.path.split('?')[0].split('/') if part]
+
+    def __same_origin(self):
+        host = self.headers.get('Host', '')
+        origin = self.headers.get('Origin')
+        # browsers send the origin of the page with every POST
+        if origin is not None and urlparse(origin).netloc != host:
+            return False
+        # a page of another origin whose DNS name was rebound to this address
+        # sends its own name as Host
+        return urlparse('//' + host).hostname in self.server.host_names
+
+    def do_GET(self):
+        value = self.server.provider()
+        for key in self.__path():
+            if not isinstance(value, dict) or key not in value:
+                self.send_error(404, "No statistics at '{}'".format(self.path))
+                return
+            value = value[key]
+        # dashboards on other origins may poll
+        self.__send_json(value, cross_origin=True)
+
+    def do_POST(self):
+        if not self.__same_origin():
+            self.send_error(403, "Commands are only accepted from the same origin")
+            return
+        path = self.__path()
+        command = self.server.commands.get(path[0]) if len(path) == 1 else None
+        if command is None:
+            self.send_error(404, "Unknown command '{}'".format(self.path))
+            return
+        self.__send_json(command())
+
+    def __send_json(self, value, cross_origin=False):
+        body = json.dumps(value, indent=4, sort_keys=True)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if cross_origin:
+            self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # polling would flood the console
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class StatsServer:
+    """
+    Local HTTP/JSON endpoint serving statistics to dashboards.
+    Requests are answered on server threads from `provider`, which
+    only reads the published statistics, so polling never touches
+    the audio thread.
+    """
+    def __init__(self, address, provider, commands=None):
+        """
+        Init server
+        :param address: '[host:]port' to listen on (host defaults to localhost)
+        :param provider: callable returning a JSON-serializable dictionary
+        :param commands: {name: callable returning a JSON-serializable result}
+        """
+        self.address = parse_address(address, 'localhost')
+        self.server = ThreadingHTTPServer(self.address, StatsRequestHandler)
+        self.server.provider = provider
+        self.server.commands = commands or {}
+        # names a same-origin request may use in its Host header
+        self.server.host_names = set(['localhost', '127.0.0.1', '::1', self.address[0].lower(),
+                                      socket.gethostname().lower()])
+        self.__thread = None
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.server.serve_forever, name='StatsServer')
+        self.__thread.daemon = True
+        self.__thread.start()
+        print "Serving statistics at http://{}:{}/".format(*self.server.server_address[:2])
+
+    def stop(self):
+        if self.__thread:
+            self.server.shutdown()
+            self.__thread.join()
+            self.__thread = None
+        self.server.server_close()
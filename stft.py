@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Ilya Shoshin (Galarius)'
+
+import importlib
+import numpy as np
+from processing_graph import Processor
+
+# periodic windows, so that overlapped copies sum to a constant
+WINDOW_FUNCTIONS = {
+    'rect': lambda n: np.ones(n),
+    'hann': lambda n: 0.5 - 0.5 * np.cos(2 * np.pi * np.arange(n) / n),
+    'sqrt_hann': lambda n: np.sqrt(0.5 - 0.5 * np.cos(2 * np.pi * np.arange(n) / n)),
+    'hamming': lambda n: 0.54 - 0.46 * np.cos(2 * np.pi * np.arange(n) / n),
+    'blackman': lambda n: 0.42 - 0.5 * np.cos(2 * np.pi * np.arange(n) / n) +
+                          0.08 * np.cos(4 * np.pi * np.arange(n) / n),
+}
+
+# analysis and synthesis windows shared by all STFT stages
+_WINDOW_CACHE = {}
+
+
+def stft_windows(name, fft_size, hop):
+    """
+    Analysis window and the matching synthesis window.
+    The synthesis window is normalized by the overlapped squared analysis window,
+    so that windowed overlap-add reconstructs the input exactly.
+    :param name: window name, see WINDOW_FUNCTIONS
+    :param fft_size: window length
+    :param hop: distance between frames
+    :return: (analysis, synthesis) read-only float32 arrays
+    """
+    key = (name, fft_size, hop)
+    windows = _WINDOW_CACHE.get(key)
+    if windows is None:
+        if name not in WINDOW_FUNCTIONS:
+            raise ValueError("Unknown window '{}'".format(name))
+        if fft_size % hop:
+            raise ValueError("FFT size must be a multiple of the hop")
+        analysis = WINDOW_FUNCTIONS[name](fft_size)
+        overlap = np.zeros(fft_size)
+        for shift in range(0, fft_size, hop):
+            overlap += np.roll(analysis ** 2, shift)
+        if overlap.min() < 1e-6:
+            raise ValueError("Window '{}' with hop {} can't reconstruct the signal".format(name, hop))
+        synthesis = analysis / overlap
+        windows = (analysis.astype(np.float32), synthesis.astype(np.float32))
+        for window in windows:
+            window.flags.writeable = False
+        _WINDOW_CACHE[key] = windows
+    return windows
+
+
+class StreamingStft:
+    """
+    Streaming short-time Fourier transform with overlap-add resynthesis.
+    Input of any block length is collected into frames of `fft_size` samples
+    every `hop` samples; each frame is windowed, transformed and passed to
+    `spectral_callback` as a (bins x channels) complex array which may be
+    changed in place. The result is transformed back, windowed and overlap-added.
+    Without changes the output equals the input delayed by `fft_size` frames.
+    """
+    def __init__(self, fft_size, hop, channels, window='sqrt_hann', spectral_callback=None):
+        """
+        Init STFT
+        :param fft_size: frame length, the number of bins is fft_size // 2 + 1
+        :param hop: distance between frames, fft_size must be a multiple of it
+        :param channels: number of channels
+        :param window: window name, see WINDOW_FUNCTIONS
+        :param spectral_callback: function(spectrum) called for each frame;
+                                  may return a new (bins x channels) array instead
+        """
+        self.fft_size = fft_size
+        self.hop = hop
+        self.channels = channels
+        self.bins = fft_size // 2 + 1
+        self.spectral_callback = spectral_callback
+        self.analysis, self.synthesis = stft_windows(window, fft_size, hop)
+        self.__analysis = self.analysis[:, np.newaxis]
+        self.__synthesis = self.synthesis[:, np.newaxis]
+        self.__input = np.zeros((fft_size, channels), dtype=np.float32)
+        self.__frame = np.zeros((fft_size, channels), dtype=np.float32)
+        self.__overlap = np.zeros((fft_size, channels), dtype=np.float32)
+        self.__out_block = np.zeros((hop, channels), dtype=np.float32)
+        self.__fill = 0
+        self.frame_count = 0
+
+    @property
+    def latency(self):
+        return self.fft_size
+
+    def reset(self):
+        self.__input[:] = 0
+        self.__overlap[:] = 0
+        self.__out_block[:] = 0
+        self.__fill = 0
+
+    def __process_frame(self):
+        np.multiply(self.__input, self.__analysis, out=self.__frame)
+        spectrum = np.fft.rfft(self.__frame, axis=0)
+        if self.spectral_callback is not None:
+            result = self.spectral_callback(spectrum)
+            if result is not None:
+                spectrum = result
+        self.frame_count += 1
+        np.multiply(np.fft.irfft(spectrum, self.fft_size, axis=0), self.__synthesis, out=self.__frame)
+        self.__overlap += self.__frame
+        hop = self.hop
+        self.__out_block[:] = self.__overlap[:hop]
+        self.__overlap[:-hop] = self.__overlap[hop:]
+        self.__overlap[-hop:] = 0
+        self.__input[:-hop] = self.__input[hop:]
+
+    def process(self, block, out):
+        """
+        Process a block
+        :param block: (frames x channels) input
+        :param out: (frames x channels) output, may be the input array
+        """
+        hop = self.hop
+        start = self.fft_size - hop
+        done = 0
+        while done < len(block):
+            count = min(len(block) - done, hop - self.__fill)
+            fill = self.__fill
+            self.__input[start + fill:start + fill + count] = block[done:done + count]
+            out[done:done + count] = self.__out_block[fill:fill + count]
+            self.__fill += count
+            done += count
+            if self.__fill == hop:
+                self.__process_frame()
+                self.__fill = 0
+
+
+def load_callback(path):
+    """
+    :param path: dotted path `module.function`
+    :return: function
+    """
+    module_name, function_name = path.rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+class Stft(Processor):
+    """
+    Processing graph node for spectral processing.
+    `callback` is a dotted path to `function(spectrum)` receiving
+    a (bins x channels) complex array for every hop.
+    """
+    def __init__(self, callback=None, fft_size=1024, hop=256, window='sqrt_hann'):
+        self.spectral_callback = load_callback(callback) if callback else None
+        self.fft_size = fft_size
+        self.hop = hop
+        self.window = window
+        self.stft = None
+
+    def prepare(self, frame_size, channels, rate, dtype):
+        self.stft = StreamingStft(self.fft_size, self.hop, channels, self.window, self.spectral_callback)
+        self.__out = np.zeros((frame_size, channels), dtype=np.float32)
+
+    def process(self, block):
+        if len(block) > len(self.__out):
+            self.__out = np.zeros((len(block), block.shape[1]), dtype=np.float32)
+        out = self.__out[:len(block)]
+        self.stft.process(block, out)
+        block[:] = out
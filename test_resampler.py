@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Ilya Shoshin (Galarius)'
+
+import unittest
+import numpy as np
+from resampler import PolyphaseResampler, polyphase_filter, DEFAULT_TAPS_PER_PHASE
+
+
+def resample(signal, rate_in, rate_out):
+    """
+    :return: whole resampled (frames x 1) signal including the flushed tail
+    """
+    resampler = PolyphaseResampler(rate_in, rate_out, 1)
+    out = np.concatenate([resampler.process(signal).copy(), resampler.flush().copy()])
+    return out[:len(signal) * rate_out // rate_in, 0]
+
+
+def tone(frequency, rate, seconds=1.0):
+    t = np.arange(int(rate * seconds)) / float(rate)
+    return (0.5 * np.sin(2 * np.pi * frequency * t))[:, np.newaxis].astype(np.float32)
+
+
+class DecimationTest(unittest.TestCase):
+    """
+    96 kHz -> 8 kHz, a down-ratio of 12
+    """
+    RATE_IN = 96000
+    RATE_OUT = 8000
+
+    def test_filter_grows_with_down_ratio(self):
+        filters = polyphase_filter(1, 12)
+        self.assertEqual(filters.shape, (1, 12 * DEFAULT_TAPS_PER_PHASE))
+
+    def test_passband_tone_is_kept(self):
+        out = resample(tone(1000, self.RATE_IN), self.RATE_IN, self.RATE_OUT)
+        expected = tone(1000, self.RATE_OUT)[:, 0]
+        # steady state away from the edges
+        error = np.abs(out - expected)[100:-100].max()
+        self.assertLess(error, 0.005)
+
+    def test_aliases_are_removed(self):
+        # 13 kHz would fold to 3 kHz at 8 kHz
+        out = resample(tone(13000, self.RATE_IN), self.RATE_IN, self.RATE_OUT)
+        level_db = 20 * np.log10(np.abs(out[100:-100]).max() / 0.5)
+        self.assertLess(level_db, -70.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
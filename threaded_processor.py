@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Ilya Shoshin (Galarius)'
+
+import threading
+import time
+import traceback
+import numpy as np
+from ring_buffer import RingBuffer
+
+
+class ThreadedProcessor:
+    """
+    Runs processing on a dedicated worker thread or on a shared thread pool.
+    The audio callback only copies blocks into the input ring buffer
+    and out of the output ring buffer. The output ring buffer is primed
+    with `latency_frames` of silence, which is the time budget the worker
+    has to catch up after a slow block before the callback underflows.
+    A processing error stops the worker and is kept in `error`,
+    the stream continues with silence.
+    """
+    def __init__(self, processing, frame_size, channels, rate,
+                 dtype=np.float32, latency_frames=None, pool=None):
+        """
+        Init processor
+        :param processing: callable with the signature of AudioSession.__processing
+        :param frame_size: number of frames processed at once
+        :param channels: number of channels
+        :param rate: sample rate, used to derive the polling interval
+        :param dtype: sample format
+        :param latency_frames: added latency (default: 2 * frame_size)
+        :param pool: ThreadPool shared with other processors (None - own thread)
+        """
+        if latency_frames is None:
+            latency_frames = 2 * frame_size
+        self.processing = processing
+        self.frame_size = frame_size
+        self.latency_frames = latency_frames
+        capacity = latency_frames + 4 * frame_size
+        self.input_ring = RingBuffer(capacity, channels, dtype)
+        self.output_ring = RingBuffer(capacity, channels, dtype)
+        self.output_ring.write(np.zeros((latency_frames, channels), dtype=dtype))
+        # callback could not push, the worker is behind
+        self.input_overflow_count = 0
+        # callback could not pull a whole block, the worker is behind
+        self.output_underflow_count = 0
+        self.poll_interval = 0.25 * frame_size / rate
+        self.__block = np.zeros((frame_size, channels), dtype=dtype)
+        self.__processed = np.zeros((frame_size, channels), dtype=dtype)
+        self.pool = pool
+        self.error = None
+        self.__finished = False
+        self.__busy = False
+        self.__running = False
+        self.__thread = None
+        # a drain task of this processor is queued or running on the pool
+        self.__scheduled = threading.Lock()
+
+    def start(self):
+        self.__running = True
+        if self.pool:
+            return
+        self.__thread = threading.Thread(target=self.__run, name='ProcessingWorker')
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        self.__running = False
+        if self.__thread:
+            self.__thread.join()
+            self.__thread = None
+
+    def push(self, frames):
+        """
+        Queue input frames for processing (audio callback side)
+        :param frames: (frames x channels) array
+        """
+        if self.input_ring.write(frames) < len(frames):
+            self.input_overflow_count += 1
+        self.__schedule()
+
+    def pull(self, out):
+        """
+        Fetch processed frames, missing frames are zero-filled (audio callback side)
+        :param out: preallocated (frames x channels) array
+        """
+        frame_count = self.output_ring.read(out)
+        if frame_count < len(out):
+            out[frame_count:] = 0
+            if not self.__finished:
+                self.output_underflow_count += 1
+
+    def finish(self):
+        """
+        Mark the end of input, the remaining partial block gets processed
+        """
+        self.__finished = True
+        self.__schedule()
+
+    def drained(self):
+        """
+        All queued input has been processed (or the worker failed, nothing
+        more will be processed) and the processed frames have been pulled
+        """
+        if self.output_ring.available():
+            return False
+        return self.error is not None or (self.input_ring.available() == 0 and not self.__busy)
+
+    def __ready(self):
+        available = self.input_ring.available()
+        return (available >= self.frame_size or (self.__finished and available > 0)) and \
+               self.output_ring.free() >= self.frame_size
+
+    def __process_block(self):
+        self.__busy = True
+        frame_count = self.input_ring.read(self.__block[:self.frame_size])
+        processed = self.__processed[:frame_count]
+        processed[:] = self.processing(self.__block[:frame_count])
+        self.output_ring.write(processed)
+        self.__busy = False
+
+    def __fail(self):
+        self.error = traceback.format_exc()
+        self.__running = False
+        self.__busy = False
+
+    def __run(self):
+        while self.__running:
+            if not self.__ready():
+                time.sleep(self.poll_interval)
+                continue
+            try:
+                self.__process_block()
+            except Exception:
+                self.__fail()
+
+    def __schedule(self):
+        if self.pool and self.__running and self.__scheduled.acquire(False):
+            self.pool.apply_async(self.__drain)
+
+    def __drain(self):
+        """
+        Pool task, process all complete blocks
+        """
+        try:
+            while self.__running and self.__ready():
+                self.__process_block()
+        except Exception:
+            self.__fail()
+        finally:
+            self.__scheduled.release()
+        # input pushed after the last check
+        if self.__running and self.__ready():
+            self.__schedule()
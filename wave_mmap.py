@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Ilya Shoshin (Galarius)'
+
+import os
+import wave
+import struct
+import numpy as np
+import audio_helper as ah
+
+WAVE_FORMAT_PCM        = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+CANONICAL_HEADER_SIZE  = 44
+
+
+def create_wave_file(filename, channels, rate, dtype, nframes):
+    """
+    Create a wave file with a canonical header and
+    a preallocated data chunk to be filled through a memmap
+    :param filename: wave file
+    :param channels: number of channels
+    :param rate: sample rate
+    :param dtype: sample format
+    :param nframes: number of frames
+    :return: offset of the sample data
+    """
+    dtype = np.dtype(dtype)
+    format_tag = WAVE_FORMAT_IEEE_FLOAT if dtype.kind == 'f' else WAVE_FORMAT_PCM
+    block_align = channels * dtype.itemsize
+    data_size = nframes * block_align
+    with open(filename, 'wb') as out_file:
+        out_file.write(struct.pack('<4sI4s4sIHHIIHH4sI',
+                                   b'RIFF', CANONICAL_HEADER_SIZE - 8 + data_size, b'WAVE',
+                                   b'fmt ', 16, format_tag, channels, rate,
+                                   rate * block_align, block_align, 8 * dtype.itemsize,
+                                   b'data', data_size))
+        out_file.truncate(CANONICAL_HEADER_SIZE + data_size)
+    return CANONICAL_HEADER_SIZE
+
+
+class FloatWaveWrite(wave.Wave_write):
+    """
+    wave.Wave_write that tags its data as IEEE float samples
+    """
+    def _write_header(self, initlength):
+        wave.Wave_write._write_header(self, initlength)
+        position = self._file.tell()
+        # format tag follows the RIFF size, 'WAVE', 'fmt ' and the fmt chunk size
+        self._file.seek(self._form_length_pos + 16)
+        self._file.write(struct.pack('<H', WAVE_FORMAT_IEEE_FLOAT))
+        self._file.seek(position)
+
+
+def open_wave_file(f, channels, rate, dtype):
+    """
+    Open a wave writer for samples of the given format
+    :param f: file name or file object
+    :param channels: number of channels
+    :param rate: sample rate
+    :param dtype: sample format (float32 data is tagged as IEEE float)
+    :return: wave.Wave_write
+    """
+    dtype = np.dtype(dtype)
+    wave_file = FloatWaveWrite(f) if dtype.kind == 'f' else wave.open(f, 'wb')
+    wave_file.setnchannels(channels)
+    wave_file.setsampwidth(dtype.itemsize)
+    wave_file.setframerate(rate)
+    return wave_file
+
+
+class MappedWaveReader:
+    """
+    Memory-mapped wave file reader.
+    The RIFF (or RF64)/fmt/data chunks are parsed once and the sample data
+    is exposed as a (frames x channels) NumPy memmap,
+    so blocks are sliced as zero-copy views and seeking is O(1).
+    """
+    def __init__(self, filename, loop=False):
+        """
+        Open wave file
+        :param filename: wave file
+        :param loop: start over at the end of the file
+        """
+        self.filename = filename
+        self.loop = loop
+        self.position = 0
+        with open(filename, 'rb') as in_file:
+            self.__parse_header(in_file, os.path.getsize(filename))
+        if self.nframes:
+            self.frames = np.memmap(filename, dtype=self.dtype, mode='r',
+                                    offset=self.data_offset,
+                                    shape=(self.nframes, self.channels))
+        else:
+            self.frames = np.zeros((0, self.channels), dtype=self.dtype)
+
+    def __parse_header(self, in_file, file_size):
+        header = in_file.read(12)
+        if len(header) < 12:
+            raise ValueError("{} is not a RIFF/WAVE file".format(self.filename))
+        riff, _, wave_id = struct.unpack('<4sI4s', header)
+        if riff not in (b'RIFF', b'RF64') or wave_id != b'WAVE':
+            raise ValueError("{} is not a RIFF/WAVE file".format(self.filename))
+        fmt = None
+        ds64_data_size = None
+        while True:
+            chunk_header = in_file.read(8)
+            if len(chunk_header) < 8:
+                raise ValueError("{} has no data chunk".format(self.filename))
+            chunk_id, chunk_size = struct.unpack('<4sI', chunk_header)
+            if chunk_id == b'ds64':
+                # 64 bit sizes of RF64 files
+                ds64_data_size = struct.unpack('<QQ', in_file.read(16))[1]
+                in_file.seek(chunk_size - 16 + (chunk_size & 1), os.SEEK_CUR)
+            elif chunk_id == b'fmt ':
+                fmt = in_file.read(chunk_size)
+                in_file.seek(chunk_size & 1, os.SEEK_CUR)
+            elif chunk_id == b'data':
+                if fmt is None:
+                    raise ValueError("{} has no fmt chunk".format(self.filename))
+                self.data_offset = in_file.tell()
+                if chunk_size == 0xFFFFFFFF and ds64_data_size is not None:
+                    chunk_size = ds64_data_size
+                # size of unfinished recordings may be unset or too large
+                data_size = min(chunk_size, file_size - self.data_offset)
+                break
+            else:
+                in_file.seek(chunk_size + (chunk_size & 1), os.SEEK_CUR)
+
+        format_tag, self.channels, self.rate, _, self.block_align, bits = \
+            struct.unpack('<HHIIHH', fmt[:16])
+        if format_tag == WAVE_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+            format_tag = struct.unpack('<H', fmt[24:26])[0]
+        self.sample_width = self.block_align // self.channels
+        self.dtype = self.__detect_dtype(format_tag, self.sample_width)
+        self.nframes = data_size // self.block_align
+
+    def __detect_dtype(self, format_tag, sample_width):
+        if format_tag == WAVE_FORMAT_IEEE_FLOAT and sample_width == 4:
+            return np.dtype('<f4')
+        elif format_tag == WAVE_FORMAT_PCM:
+            if sample_width == 1:
+                return np.dtype(np.uint8)
+            elif sample_width == 2:
+                return np.dtype('<i2')
+            elif sample_width == 3:
+                return ah.INT24
+            elif sample_width == 4:
+                return np.dtype('<i4')
+        raise TypeError("Unsupported wave format {} ({} bytes per sample).".format(
+            format_tag, sample_width))
+
+    def getnchannels(self):
+        return self.channels
+
+    def getsampwidth(self):
+        return self.sample_width
+
+    def getframerate(self):
+        return self.rate
+
+    def getnframes(self):
+        return self.nframes
+
+    def getformat(self):
+        """
+        :return: PyAudio sample format
+        """
+        return ah.numpy_to_py_audio_format(self.dtype)
+
+    def tell(self):
+        return self.position
+
+    def setpos(self, position):
+        if position < 0 or position > self.nframes:
+            raise ValueError("position not in range")
+        self.position = position
+
+    def rewind(self):
+        self.position = 0
+
+    def read(self, frame_count):
+        """
+        Read frames without copying
+        :param frame_count: maximum number of frames
+        :return: (frames x channels) view, empty at the end of the file
+        """
+        if self.loop and self.position == self.nframes:
+            self.position = 0
+        start = self.position
+        self.position = min(start + frame_count, self.nframes)
+        return self.frames[start:self.position]
+
+    def close(self):
+        self.frames = None
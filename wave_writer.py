@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Ilya Shoshin (Galarius)'
+
+import threading
+import time
+import numpy as np
+from ring_buffer import RingBuffer
+from extensions import elapsed_timer
+
+
+class AsyncWaveWriter:
+    """
+    Background writer of wave files for the *2File modes.
+    The audio callback only copies each block into a bounded ring buffer,
+    a writer thread coalesces queued blocks into large sequential writes
+    to a RecordingSink. The header is checkpointed together with fsync
+    every `fsync_interval` seconds and on close. Blocks that do not fit
+    into the queue are dropped and counted.
+    """
+    def __init__(self, sink, block_size, queue_blocks=256, batch_blocks=32, fsync_interval=1.0):
+        """
+        Init writer
+        :param sink: RecordingSink, its format is the format of the queued data
+        :param block_size: frames per callback block
+        :param queue_blocks: queue capacity in blocks
+        :param batch_blocks: blocks coalesced into one write
+        :param fsync_interval: seconds between header checkpoints and fsync
+        """
+        self.sink = sink
+        self.channels = sink.channels
+        self.dtype = sink.dtype
+        self.block_size = block_size
+        self.fsync_interval = fsync_interval
+        self.queue = RingBuffer(queue_blocks * block_size, self.channels, self.dtype)
+        self.batch = np.zeros((batch_blocks * block_size, self.channels), dtype=self.dtype)
+        self.poll_interval = 0.25 * block_size / sink.rate
+        self.queued_blocks = 0
+        self.dropped_blocks = 0
+        self.max_queue_depth = 0
+        self.write_count = 0
+        self.fsync_count = 0
+        self.bytes_written = 0
+        self.max_write_time = 0.0
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__run, name='WaveWriter')
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def write(self, data):
+        """
+        Queue interleaved data (audio callback side)
+        :param data: buffer with interleaved samples
+        """
+        frames = np.frombuffer(data, dtype=self.dtype).reshape(-1, self.channels)
+        if self.queue.free() < len(frames):
+            self.dropped_blocks += 1
+            return
+        self.queue.write(frames)
+        self.queued_blocks += 1
+        depth = (self.queue.available() + self.block_size - 1) // self.block_size
+        if depth > self.max_queue_depth:
+            self.max_queue_depth = depth
+
+    def close(self):
+        """
+        Flush queued data, finalize the header and close the file
+        """
+        self.__running = False
+        self.__thread.join()
+        while self.queue.available():
+            self.__write_batch()
+        self.sink.close()
+
+    def print_stat(self):
+        print "Writer: {} blocks queued, {} dropped, max queue depth: {}/{} blocks".format(
+            self.queued_blocks, self.dropped_blocks, self.max_queue_depth,
+            self.queue.capacity // self.block_size)
+        print "Writer: {} writes ({:0.1f} MB), {} fsyncs, max write time: {:0.2f} ms".format(
+            self.write_count, self.bytes_written / 1048576.0, self.fsync_count,
+            self.max_write_time * 1000)
+        self.sink.print_stat()
+
+    def __write_batch(self):
+        frame_count = self.queue.read(self.batch)
+        if not frame_count:
+            return
+        with elapsed_timer() as elapsed:
+            self.sink.write_frames(self.batch[:frame_count])
+            elapsed = elapsed()
+        self.write_count += 1
+        self.bytes_written += frame_count * self.channels * self.dtype.itemsize
+        if elapsed > self.max_write_time:
+            self.max_write_time = elapsed
+
+    def __flush(self):
+        while self.queue.available():
+            self.__write_batch()
+        self.__sync()
+
+    def __sync(self):
+        self.sink.checkpoint()
+        self.fsync_count += 1
+
+    def __run(self):
+        last_sync = time.time()
+        while self.__running:
+            if self.queue.available() >= len(self.batch):
+                self.__write_batch()
+            elif time.time() - last_sync >= self.fsync_interval:
+                self.__flush()
+                last_sync = time.time()
+            else:
+                time.sleep(self.poll_interval)